@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import contextlib
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from combine_reports import combine_reports
+from fetch_data import NdjsonResultWriter, RawResultWriter
+from process_data import (analyze_issues, generate_report, identify_non_compliant_apps,
+                          load_vulnerability_data, partition_paths, prepare_email_content)
+from run_metrics import peak_rss_bytes
+
+ISSUE_TYPES = ["AV TSS", "Cryptography", "Open Data", "TSS", "Vulnerability"]
+
+# Severity values as they appear in the index, including the null and empty
+# ones process_data.py infers from the issue type
+SEVERITIES = ["Critical", "High", "Medium", "Low", "Info", "", None, "null"]
+SEVERITY_WEIGHTS = [2, 8, 30, 35, 10, 5, 5, 5]
+
+# Named dataset sizes as (hits, app codes, custodians)
+SCALES = {
+    "1k": (1000, 10, 10),
+    "10k": (10000, 100, 100),
+    "100k": (100000, 1000, 1000),
+    "1m": (1000000, 10000, 10000),
+}
+
+# Operations timed for each dataset, in pipeline order
+OPERATIONS = [
+    "load_vulnerability_data",
+    "analyze_issues",
+    "identify_non_compliant_apps",
+    "generate_report",
+    "prepare_email_content",
+    "combine_reports",
+]
+
+DEFAULT_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "email_template.txt")
+
+def synthetic_hit(number, apps, custodians, rng):
+    """Build one ES-shaped hit with the _source fields process_data.py reads"""
+    app = rng.randrange(apps)
+    custodian = app % custodians
+    return {
+        "_index": "atu0-server-compliance-metrics-benchmark",
+        "_id": f"doc{number}",
+        "_source": {
+            "appCode": f"APP{app:05d}",
+            "issueType": ISSUE_TYPES[number % len(ISSUE_TYPES)],
+            "severity": rng.choices(SEVERITIES, SEVERITY_WEIGHTS)[0],
+            "priority": rng.choice(["P1", "P2"]),
+            "contact-info": {
+                "app_custodian_name": f"Custodian {custodian}",
+                "app_custodian_email": f"custodian{custodian}@example.com"
+            },
+            "affectedItemType": rng.choice(["server", "database", "container"]),
+            "affectedItemName": f"host{rng.randrange(apps * 20)}",
+            "remediationLink": f"https://remediation.example.com/{number % 997}",
+            "solution": rng.choice(["patch", "upgrade", "reconfigure"]),
+            "fixByDate": (datetime(2026, 1, 1) + timedelta(days=number % 365)).strftime("%Y-%m-%d")
+        }
+    }
+
+def dataset_spec(hits, apps, custodians, seed, raw_format):
+    """Describe a dataset; a directory holding the same spec is reused"""
+    return {"hits": hits, "apps": apps, "custodians": custodians, "seed": seed, "raw_format": raw_format}
+
+def generate_dataset(dataset_dir, spec):
+    """Write one raw data file per issue type, as fetch_data.py would
+    
+    Returns the raw file of each issue type. Generation is skipped if the
+    directory already holds a dataset with the same spec.
+    """
+    dataset_dir = Path(dataset_dir)
+    raw_files = {issue_type: str(dataset_dir / f"{issue_type}_report_raw.{spec['raw_format']}")
+                 for issue_type in ISSUE_TYPES}
+    spec_file = dataset_dir / "dataset.json"
+    if spec_file.exists():
+        with open(spec_file) as f:
+            if json.load(f) == spec:
+                return raw_files
+    
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(spec["seed"])
+    writer_class = NdjsonResultWriter if spec["raw_format"].startswith("ndjson") else RawResultWriter
+    per_type = spec["hits"] // len(ISSUE_TYPES)
+    totals = {
+        issue_type: per_type + (1 if index < spec["hits"] % len(ISSUE_TYPES) else 0)
+        for index, issue_type in enumerate(ISSUE_TYPES)
+    }
+    writers = {
+        issue_type: writer_class(raw_files[issue_type], {"value": totals[issue_type], "relation": "eq"},
+                                 spec["raw_format"], aggregations={})
+        for issue_type in ISSUE_TYPES
+    }
+    try:
+        for number in range(spec["hits"]):
+            hit = synthetic_hit(number, spec["apps"], spec["custodians"], rng)
+            writers[hit["_source"]["issueType"]].write_hit(hit)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    
+    with open(spec_file, 'w') as f:
+        json.dump(spec, f, indent=2)
+    return raw_files
+
+def load_all(raw_files):
+    """Load every hit of a dataset into one list"""
+    hits = []
+    for raw_file in raw_files.values():
+        hits.extend(load_vulnerability_data(raw_file)[0])
+    return hits
+
+def write_reports(raw_files, output_dir):
+    """Generate the processed report of every issue type, returning their paths"""
+    reports = []
+    for issue_type, raw_file in raw_files.items():
+        output_file = partition_paths(issue_type, output_dir)[1]
+        generate_report(raw_file, output_file)
+        reports.append(output_file)
+    return reports
+
+def prepare_operation(operation, raw_files, work_dir, template_file):
+    """Set up one operation, returning the callable to time
+    
+    Setup (loading hits, writing the reports an operation reads) is not
+    part of the timing.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    
+    if operation == "load_vulnerability_data":
+        return lambda: [load_vulnerability_data(raw_file) for raw_file in raw_files.values()]
+    if operation == "analyze_issues":
+        hits = load_all(raw_files)
+        return lambda: analyze_issues(hits)
+    if operation == "identify_non_compliant_apps":
+        hits = load_all(raw_files)
+        return lambda: identify_non_compliant_apps(hits)
+    if operation == "generate_report":
+        return lambda: write_reports(raw_files, work_dir)
+    if operation == "prepare_email_content":
+        reports = write_reports(raw_files, work_dir)
+        return lambda: [prepare_email_content(template_file, report) for report in reports]
+    if operation == "combine_reports":
+        write_reports(raw_files, work_dir)
+        return lambda: combine_reports(work_dir)
+    raise ValueError(f"Unknown operation {operation}")
+
+def run_operation(operation, raw_files, work_dir, template_file, repeat):
+    """Time an operation in this process, returning its seconds per run and peak RSS
+    
+    Meant to run in a fresh worker process so every operation starts from
+    the same memory state; the script's own output is discarded.
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        run = prepare_operation(operation, raw_files, work_dir, template_file)
+        rss_before = peak_rss_bytes()
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            seconds.append(time.perf_counter() - start)
+    rss_after = peak_rss_bytes()
+    return {
+        "seconds": seconds,
+        "peak_rss_bytes": rss_after,
+        "rss_growth_bytes": rss_after - rss_before if rss_after is not None else None
+    }
+
+def benchmark_dataset(scale, spec, data_dir, operations, template_file, repeat):
+    """Generate or reuse a dataset and time each operation on it in a fresh process"""
+    dataset_dir = os.path.join(data_dir, scale)
+    start = time.monotonic()
+    raw_files = generate_dataset(dataset_dir, spec)
+    print(f"Dataset {scale}: {spec['hits']} hits, {spec['apps']} app codes, {spec['custodians']} custodians "
+          f"({time.monotonic() - start:.1f}s to prepare)")
+    
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for operation in operations:
+        work_dir = os.path.join(dataset_dir, "work", operation)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            measured = executor.submit(run_operation, operation, raw_files, work_dir,
+                                       template_file, repeat).result()
+        best = min(measured["seconds"])
+        result = {
+            "scale": scale,
+            "hits": spec["hits"],
+            "apps": spec["apps"],
+            "custodians": spec["custodians"],
+            "operation": operation,
+            "runs": measured["seconds"],
+            "seconds": round(best, 4),
+            "median_seconds": round(statistics.median(measured["seconds"]), 4),
+            "hits_per_second": round(spec["hits"] / best, 1) if best > 0 else None,
+            "peak_rss_bytes": measured["peak_rss_bytes"],
+            "rss_growth_bytes": measured["rss_growth_bytes"]
+        }
+        results.append(result)
+        print(f"  {operation:<28} {best:9.3f}s {result['hits_per_second'] or 0:12,.0f} hits/s "
+              f"peak RSS {(result['peak_rss_bytes'] or 0) / 1048576:8.1f} MiB")
+    return results
+
+def compare_results(results, baseline, threshold=0.25):
+    """List the operations that got slower or used more memory than in the baseline by more than threshold"""
+    previous = {(entry["scale"], entry["operation"]): entry for entry in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        before = previous.get((result["scale"], result["operation"]))
+        if before is None:
+            continue
+        for metric in ("seconds", "peak_rss_bytes"):
+            if not before.get(metric) or result.get(metric) is None:
+                continue
+            change = (result[metric] - before[metric]) / before[metric]
+            if change > threshold:
+                regressions.append({
+                    "scale": result["scale"],
+                    "operation": result["operation"],
+                    "metric": metric,
+                    "baseline": before[metric],
+                    "current": result[metric],
+                    "change": round(change, 3)
+                })
+    return regressions
+
+def parse_scale(value):
+    """Parse a named scale or a HITS:APPS[:CUSTODIANS] custom one"""
+    if value in SCALES:
+        return value, SCALES[value]
+    try:
+        parts = [int(part) for part in value.split(":")]
+        hits, apps = parts[0], parts[1]
+        custodians = parts[2] if len(parts) > 2 else apps
+    except (ValueError, IndexError):
+        raise argparse.ArgumentTypeError(
+            f"{value} is not one of {', '.join(SCALES)} or HITS:APPS[:CUSTODIANS]")
+    return value, (hits, apps, custodians)
+
+def main():
+    """Main function to benchmark the report pipeline on synthetic datasets"""
+    parser = argparse.ArgumentParser(description='Benchmark the report pipeline on synthetic compliance datasets')
+    parser.add_argument('--scales', nargs='+', type=parse_scale, default=[parse_scale("1k"), parse_scale("10k")],
+                        help=f'Dataset sizes: {", ".join(SCALES)} or HITS:APPS[:CUSTODIANS] (default: 1k 10k)')
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=OPERATIONS,
+                        help='Operations to time (default: all)')
+    parser.add_argument('--data-dir', default='roles/files/output/benchmark',
+                        help='Directory for the generated datasets, reused across runs')
+    parser.add_argument('--raw-format', default='ndjson', choices=['json', 'json.gz', 'ndjson', 'ndjson.gz'],
+                        help='Raw data format of the datasets')
+    parser.add_argument('--email-template', default=DEFAULT_TEMPLATE, help='Email template file')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per operation; the fastest is reported')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for the datasets')
+    parser.add_argument('--output', help='Output file for the benchmark results')
+    parser.add_argument('--baseline', help='Results of a previous benchmark run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Relative slowdown or memory growth reported as a regression (default 0.25)')
+    
+    args = parser.parse_args()
+    
+    results = []
+    for scale, (hits, apps, custodians) in args.scales:
+        spec = dataset_spec(hits, apps, custodians, args.seed, args.raw_format)
+        results.extend(benchmark_dataset(scale, spec, args.data_dir, args.operations,
+                                         args.email_template, max(1, args.repeat)))
+    
+    report = {
+        "generated_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "raw_format": args.raw_format,
+        "repeat": args.repeat,
+        "results": results
+    }
+    
+    if args.baseline:
+        try:
+            with open(args.baseline) as f:
+                report["regressions"] = compare_results(results, json.load(f), args.threshold)
+        except Exception as e:
+            print(f"Warning: Could not compare with baseline {args.baseline}: {e}")
+        for regression in report.get("regressions", []):
+            print(f"REGRESSION: {regression['scale']} {regression['operation']} {regression['metric']} "
+                  f"{regression['baseline']} -> {regression['current']} (+{regression['change']:.0%})")
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Benchmark results saved to {args.output}")
+    
+    return 1 if report.get("regressions") else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+from pathlib import Path
+
+# Files are hashed in blocks of this many bytes, so memory stays flat
+DIGEST_BLOCK_SIZE = 1024 * 1024
+
+def file_digest(path):
+    """Get the SHA-256 hex digest of a file's contents, or None if it cannot be read"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(DIGEST_BLOCK_SIZE), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+def build_key(*parts):
+    """Hash the JSON-serializable parts describing an output's inputs into one cache key"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+class BuildCache:
+    """Record of the inputs each output file was last built from
+    
+    Each output gets a small JSON entry in the cache directory, named after
+    the output file, holding the key of its inputs and the digest of the
+    output as written. An output is fresh while its inputs still hash to
+    the same key and the file still has the recorded digest, so an output
+    replaced since (e.g. by a placeholder) is rebuilt. Entries are separate
+    files, so worker processes can record their outputs concurrently.
+    """
+    
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+    
+    def entry_path(self, output):
+        """Get the entry file of an output"""
+        return self.cache_dir / f"{Path(output).name}.json"
+    
+    def is_fresh(self, output, key):
+        """Check whether an output was built from inputs with this key and is unchanged since"""
+        try:
+            with open(self.entry_path(output)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return entry.get("key") == key and entry.get("output_digest") == file_digest(output)
+    
+    def record(self, output, key):
+        """Record that an output was just built from inputs with this key"""
+        entry = {"key": key, "output_digest": file_digest(output)}
+        path = self.entry_path(output)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Written aside and renamed, so a crash never leaves half an entry
+            temp_path = path.with_name(path.name + ".tmp")
+            with open(temp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Warning: Could not record {output} in the build cache: {e}")
+    
+    def forget(self, output):
+        """Drop an output's entry, so it is rebuilt next time"""
+        try:
+            os.remove(self.entry_path(output))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Warning: Could not drop {output} from the build cache: {e}")
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import itertools
+
+from process_data import (SEVERITY_LEVELS, IssueAccumulator, get_custodian, high_severity_entry, issue_row,
+                          make_custodian_key, resolve_severity)
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for ANALYSIS_BACKEND=numpy
+    np = None
+
+def factorize(values):
+    """Encode values as categorical codes numbered in order of first appearance
+    
+    Returns (categories, codes, first): the distinct values in first-seen
+    order, the code of every value and the position each category was
+    first seen at. Values are hashed rather than sorted, which is several
+    times faster than np.unique() on strings.
+    """
+    # Each value maps to the position it was first seen at; numbering the
+    # positions that map to themselves gives the categories in first-seen order
+    index = {}
+    first_positions = np.fromiter(map(index.setdefault, values, itertools.count()), dtype=np.intp,
+                                  count=len(values))
+    first = np.flatnonzero(first_positions == np.arange(len(values)))
+    rank = np.empty(len(values), dtype=np.intp)
+    rank[first] = np.arange(len(first))
+    return list(index), rank[first_positions], first.tolist()
+
+def first_seen_pairs(left, right, right_count):
+    """Get the distinct (left, right) code pairs in order of first appearance"""
+    pairs = left.astype(np.int64) * right_count + right
+    unique, first = np.unique(pairs, return_index=True)
+    unique = unique[np.argsort(first)]
+    return zip((unique // right_count).tolist(), (unique % right_count).tolist())
+
+def group_positions(codes, groups):
+    """Split the positions of codes into one ascending array per code"""
+    order = np.argsort(codes, kind='stable')
+    return np.split(order, np.cumsum(np.bincount(codes, minlength=groups))[:-1])
+
+class ColumnarAccumulator(IssueAccumulator):
+    """IssueAccumulator counting hits with NumPy group-bys instead of per-hit dict updates
+    
+    add() stores each hit's issue row and high severity entry as usual but
+    only queues its resolved severity, app code, issue type and custodian
+    in column lists, plus its fix-by date when the compliance rules have age
+    rules. When results are built the columns are encoded as categorical
+    codes and folded into the severity counts, per-app breakdowns, rule
+    counts and custodian groupings in one vectorized pass, and
+    compliance() checks every app against the rules at once. The
+    results are identical to IssueAccumulator's, entry order included.
+    
+    Aggregated raw data is counted with the inherited add_bucket(), as its
+    buckets are already grouped.
+    """
+    
+    def __init__(self, thresholds=None, rules=None):
+        super().__init__(thresholds, rules)
+        self.severity_column = []
+        # One entry per queued hit with an app code
+        self.hit_positions = []
+        self.issue_ids = []
+        self.app_column = []
+        self.issue_type_column = []
+        self.custodian_column = []
+        self.custodian_names = []
+        self.custodian_has_email = []
+        self.fix_by_date_column = []
+    
+    def add(self, hit):
+        """Store one hit's issue row and high severity entry and queue it for counting"""
+        source = hit.get('_source', {})
+        severity = resolve_severity(source)
+        app_code = source.get('appCode')
+        if app_code:
+            custodian_name, custodian_email = get_custodian(source)
+            self.hit_positions.append(len(self.severity_column))
+            self.issue_ids.append(len(self.issue_rows))
+            self.issue_rows.append(issue_row(hit, source))
+            self.app_column.append(app_code)
+            self.issue_type_column.append(source.get('issueType') or '')
+            self.custodian_column.append(make_custodian_key(custodian_name, custodian_email))
+            self.custodian_names.append(custodian_name)
+            self.custodian_has_email.append(bool(custodian_email))
+            if self.rules.uses_dates:
+                self.fix_by_date_column.append(source.get('fixByDate'))
+        self.severity_column.append(severity)
+        
+        if severity in ('critical', 'high'):
+            self.high_severity_issues.append(high_severity_entry(source, severity))
+    
+    def flush(self):
+        """Fold the queued hits into the accumulated state and empty the columns"""
+        if not self.severity_column:
+            return
+        
+        # Severities outside SEVERITY_LEVELS land in an extra column that is never counted
+        levels = len(SEVERITY_LEVELS)
+        severities, severity_codes, _ = factorize(self.severity_column)
+        level_codes = np.array([SEVERITY_LEVELS.index(severity) if severity in SEVERITY_LEVELS else levels
+                                for severity in severities], dtype=np.intp)[severity_codes]
+        for level, count in zip(SEVERITY_LEVELS, np.bincount(level_codes, minlength=levels + 1).tolist()):
+            self.severity_counts[level] += count
+        
+        if self.app_column:
+            self.flush_apps(level_codes[np.asarray(self.hit_positions, dtype=np.intp)])
+        
+        for column in (self.severity_column, self.hit_positions, self.issue_ids, self.app_column,
+                       self.issue_type_column, self.custodian_column, self.custodian_names,
+                       self.custodian_has_email, self.fix_by_date_column):
+            column.clear()
+    
+    def flush_apps(self, level_codes):
+        """Fold the queued hits with an app code into the app and custodian entries"""
+        levels = len(SEVERITY_LEVELS)
+        issue_ids = np.asarray(self.issue_ids, dtype=np.int64)
+        
+        apps, app_codes, _ = factorize(self.app_column)
+        app_entries = [self.app_entry(app_code) for app_code in apps]
+        severity_counts = np.bincount(app_codes * (levels + 1) + level_codes,
+                                      minlength=len(apps) * (levels + 1)).reshape(len(apps), levels + 1)
+        issue_counts = np.bincount(app_codes, minlength=len(apps))
+        for app, counts, issue_count, positions in zip(app_entries, severity_counts[:, :levels].tolist(),
+                                                       issue_counts.tolist(), group_positions(app_codes, len(apps))):
+            app['issue_count'] += issue_count
+            for level, count in zip(SEVERITY_LEVELS, counts):
+                app['severity_counts'][level] += count
+            app['issue_ids'].extend(issue_ids[positions].tolist())
+        
+        issue_types, issue_type_codes, _ = factorize(self.issue_type_column)
+        named = np.array([bool(issue_type) for issue_type in issue_types], dtype=bool)[issue_type_codes]
+        for app, issue_type in first_seen_pairs(app_codes[named], issue_type_codes[named], len(issue_types)):
+            app_entries[app]['issue_types'].add(issue_types[issue_type])
+            self.issue_types.add(issue_types[issue_type])
+        
+        if self.rules.names:
+            rule_counts = self.count_rules(level_codes, issue_types, issue_type_codes, app_codes, len(apps))
+            for app, counts in zip(app_entries, rule_counts.tolist()):
+                app['rule_counts'] = [total + count for total, count in zip(app['rule_counts'], counts)]
+        
+        keys, custodian_codes, first = factorize(self.custodian_column)
+        custodian_entries = [
+            self.custodian_key_entry(key, self.custodian_names[position], self.custodian_has_email[position])
+            for key, position in zip(keys, first)
+        ]
+        for custodian, app in first_seen_pairs(custodian_codes, app_codes, len(apps)):
+            custodian_entries[custodian]['app_codes'].add(apps[app])
+        for custodian, positions in zip(custodian_entries, group_positions(custodian_codes, len(keys))):
+            custodian['issue_ids'].extend(issue_ids[positions].tolist())
+    
+    def count_rules(self, level_codes, issue_types, issue_type_codes, app_codes, app_count):
+        """Count the queued hits with an app code against every rule, returning an apps x rules matrix
+        
+        Each rule's amount per severity and issue type comes from a small
+        lookup table indexed with the hits' codes; hits are masked out of
+        age rules by comparing their fix-by dates with each cutoff once.
+        """
+        levels = len(SEVERITY_LEVELS)
+        amounts = np.zeros((len(self.rules.names), levels + 1, len(issue_types)), dtype=np.int64)
+        for level, severity in enumerate(SEVERITY_LEVELS):
+            for code, issue_type in enumerate(issue_types):
+                for index, amount, _ in self.rules.increments(severity, issue_type or None):
+                    amounts[index, level, code] = amount
+        hit_amounts = amounts[:, level_codes, issue_type_codes]
+        
+        overdue = {}
+        for index, rule in enumerate(self.rules.rules):
+            if rule.cutoff is not None:
+                if rule.cutoff not in overdue:
+                    overdue[rule.cutoff] = np.fromiter(
+                        (bool(fix_by_date) and str(fix_by_date) < rule.cutoff
+                         for fix_by_date in self.fix_by_date_column),
+                        dtype=bool, count=len(self.fix_by_date_column))
+                hit_amounts[index] *= overdue[rule.cutoff]
+        
+        return np.stack([np.bincount(app_codes, weights=row, minlength=app_count) for row in hit_amounts],
+                        axis=1).astype(np.int64)
+    
+    def analysis(self):
+        """Build the analyze_issues() result"""
+        self.flush()
+        return super().analysis()
+    
+    def compliance(self):
+        """Build the identify_non_compliant_apps() result, checking every app against the rules at once"""
+        self.flush()
+        if not self.app_codes:
+            return {}
+        
+        counts = np.array([[details['severity_counts'][level] for level in SEVERITY_LEVELS]
+                           for details in self.app_codes.values()], dtype=np.int64)
+        rule_counts = np.array([details['rule_counts'] for details in self.app_codes.values()],
+                               dtype=np.int64).reshape(len(self.app_codes), len(self.rules.names))
+        # Rules an app has turned off get an infinite limit
+        limits = np.array([[np.inf if limit is None else limit for limit in self.rules.limits(app_code)]
+                           for app_code in self.app_codes], dtype=float).reshape(rule_counts.shape)
+        exceeded = rule_counts > limits
+        compliant = ~exceeded.any(axis=1)
+        
+        app_compliance = {}
+        for app_code, app_counts, app_rule_counts, app_exceeded, is_compliant in zip(
+                self.app_codes, counts.tolist(), rule_counts.tolist(), exceeded.tolist(), compliant.tolist()):
+            data = dict(zip(SEVERITY_LEVELS, app_counts))
+            data["is_compliant"] = is_compliant
+            data["reasons"] = [
+                rule.reason(count, limit)
+                for rule, count, limit, over in zip(self.rules.rules, app_rule_counts,
+                                                    self.rules.limits(app_code), app_exceeded)
+                if over
+            ]
+            app_compliance[app_code] = data
+        return app_compliance
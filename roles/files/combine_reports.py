@@ -2,52 +2,304 @@
 
 import json
 import sys
+import argparse
 from pathlib import Path
 
-def combine_reports(output_dir):
-    """Combine all processed reports into a single file for notifications"""
+from build_cache import BuildCache, build_key, file_digest
+from compliance_rules import RuleSet
+from process_data import REPORT_ISSUE_FIELDS, describe_partial, end_date_of, load_compliance_rules, resolve_severity
+from run_metrics import StageMetrics
+
+COMBINED_REPORT = 'combined_report_processed.json'
+
+def normalize_issue_rows(issues):
+    """Get a report's issue rows laid out as REPORT_ISSUE_FIELDS"""
+    fields = issues.get('fields', REPORT_ISSUE_FIELDS)
+    rows = issues.get('rows', [])
+    if fields == REPORT_ISSUE_FIELDS:
+        return rows
+    return [
+        [dict(zip(fields, row)).get(field) for field in REPORT_ISSUE_FIELDS]
+        for row in rows
+    ]
+
+def add_unique(items, seen, values):
+    """Append the values not already in seen, keeping first-seen order"""
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            items.append(value)
+
+class ReportMerger:
+    """Merge processed reports one at a time into a single combined report
+    
+    Issue rows are deduplicated on their document id, so a document in
+    several reports is stored once and the issue ids of every report are
+    remapped onto the combined table. Custodians are merged on their key
+    and apps on their app code, unioning app codes, issue types and issue
+    ids and summing severity, issue and rule counts. The counts of a
+    document an earlier report already added are taken out of a report's
+    app counts before they are summed, so each document is counted once.
+    Each merged app is then checked against the compliance rules, so the
+    combined report carries the one verdict every notification uses. The
+    partial markers of reports built from incomplete data are collected
+    under "partial". Only the merged state is kept, so memory grows with
+    unique data rather than with input files.
+    """
+    
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else load_compliance_rules()
+        self.issue_rows = []
+        self.row_ids = {}
+        self.custodians = {}
+        self.apps = {}
+        self.partial = []
+        self.reports = 0
+        self._dated_rules = {}
+    
+    def merge_issue_rows(self, issues):
+        """Add a report's issue rows to the combined table
+        
+        Returns the combined id of each row, and the combined ids of the
+        rows whose document an earlier report already added.
+        """
+        remap = []
+        merged = set()
+        for row in normalize_issue_rows(issues):
+            document_id = row[0]
+            issue_id = self.row_ids.get(document_id) if document_id is not None else None
+            if issue_id is None:
+                issue_id = len(self.issue_rows)
+                self.issue_rows.append(row)
+                if document_id is not None:
+                    self.row_ids[document_id] = issue_id
+            else:
+                merged.add(issue_id)
+            remap.append(issue_id)
+        return remap, merged
+    
+    def rules_as_of(self, end_date):
+        """Get the rules with age rules counting back from a report's end date, as process_data.py compiled them"""
+        as_of = end_date_of(end_date)
+        if as_of is None or not self.rules.uses_dates:
+            return self.rules
+        rules = self._dated_rules.get(as_of)
+        if rules is None:
+            rules = self._dated_rules[as_of] = RuleSet(self.rules.config, as_of)
+        return rules
+    
+    def unmerged_counts(self, entry, rows, rules):
+        """Get an app entry's severity, issue and rule counts without those of the given rows"""
+        severity_counts = dict(entry.get('severity_counts', {}))
+        issue_count = entry.get('issue_count')
+        rule_counts = dict(entry['rule_counts']) if entry.get('rule_counts') is not None else None
+        for row in rows:
+            source = dict(zip(REPORT_ISSUE_FIELDS, row))
+            severity = resolve_severity(source)
+            if severity in severity_counts:
+                severity_counts[severity] -= 1
+            if issue_count is not None:
+                issue_count -= 1
+            if rule_counts is not None:
+                counts = [0] * len(rules.names)
+                rules.count(counts, severity, source.get('issueType'), source.get('fixByDate'))
+                for name, count in zip(rules.names, counts):
+                    if count and name in rule_counts:
+                        rule_counts[name] -= count
+        return severity_counts, issue_count, rule_counts
+    
+    def merge_custodian(self, key, entry, remap):
+        """Merge one report's custodian entry into the custodian with the same key"""
+        custodian = self.custodians.get(key)
+        if custodian is None:
+            custodian = self.custodians[key] = {
+                'app_codes': [],
+                'issue_ids': [],
+                'custodian_name': entry.get('custodian_name'),
+                'has_email': False,
+                '_app_codes': set(),
+                '_issue_ids': set()
+            }
+        add_unique(custodian['app_codes'], custodian['_app_codes'], entry.get('app_codes', []))
+        add_unique(custodian['issue_ids'], custodian['_issue_ids'],
+                   (remap[issue_id] for issue_id in entry.get('issue_ids', [])))
+        if 'issues' in entry:
+            # Reports written before the issue table embed the issues directly
+            custodian.setdefault('issues', []).extend(entry['issues'])
+        if not custodian['custodian_name']:
+            custodian['custodian_name'] = entry.get('custodian_name')
+        custodian['has_email'] = custodian['has_email'] or entry.get('has_email', False)
+    
+    def merge_app(self, entry, remap, merged=(), rules=None):
+        """Fold one report's summary.app_codes entry into the single entry of its app code
+        
+        The issues with a combined id in merged were counted by an earlier
+        report, so their counts, worked out with rules, are left out.
+        """
+        app = self.apps.get(entry['app_code'])
+        if app is None:
+            app = self.apps[entry['app_code']] = {
+                'app_code': entry['app_code'],
+                'issue_types': [],
+                'severity_counts': {},
+                'issue_count': 0,
+                'issue_ids': [],
+                'rule_counts': {},
+                '_issue_types': set(),
+                '_issue_ids': set()
+            }
+        add_unique(app['issue_types'], app['_issue_types'], entry.get('issue_types', []))
+        counted = [self.issue_rows[remap[issue_id]] for issue_id in entry.get('issue_ids', [])
+                   if remap[issue_id] in merged]
+        severity_counts, issue_count, rule_counts = self.unmerged_counts(entry, counted, rules or self.rules)
+        for level, count in severity_counts.items():
+            app['severity_counts'][level] = app['severity_counts'].get(level, 0) + count
+        if app['issue_count'] is not None and issue_count is not None:
+            app['issue_count'] += issue_count
+        else:
+            app['issue_count'] = None
+        add_unique(app['issue_ids'], app['_issue_ids'],
+                   (remap[issue_id] for issue_id in entry.get('issue_ids', [])))
+        # Reports written before rules were counted only have severity counts
+        if app['rule_counts'] is not None and rule_counts is not None:
+            for name, count in rule_counts.items():
+                app['rule_counts'][name] = app['rule_counts'].get(name, 0) + count
+        else:
+            app['rule_counts'] = None
+    
+    def app_compliance(self, app):
+        """Check one merged app against the compliance rules"""
+        counts = self.rules.counts_from_report(app['rule_counts'], app['severity_counts'])
+        is_compliant, reasons = self.rules.evaluate(app['app_code'], counts)
+        return {'is_compliant': is_compliant, 'reasons': reasons}
+    
+    def add(self, report):
+        """Merge one processed report"""
+        remap, merged = self.merge_issue_rows(report.get('issues', {}))
+        rules = self.rules_as_of(report.get('summary', {}).get('end_date')) if merged else self.rules
+        for key, custodian in (report.get('custodian') or {}).items():
+            self.merge_custodian(key, custodian, remap)
+        for app in report.get('summary', {}).get('app_codes') or []:
+            self.merge_app(app, remap, merged, rules)
+        if report.get('partial'):
+            self.partial.append(report['partial'])
+        self.reports += 1
+    
+    def result(self):
+        """Build the combined report"""
+        def public(entry):
+            return {key: value for key, value in entry.items() if not key.startswith('_')}
+        
+        combined = {
+            'custodian': {key: public(custodian) for key, custodian in self.custodians.items()},
+            'summary': {'app_codes': [dict(public(app), compliance=self.app_compliance(app))
+                                      for app in self.apps.values()]},
+            'issues': {'fields': REPORT_ISSUE_FIELDS, 'rows': self.issue_rows}
+        }
+        if self.partial:
+            combined['partial'] = self.partial
+        return combined
+
+def combined_cache_key(report_files, rules_file=None):
+    """Get the build cache key of the combined report: its processed reports, its rules and the code merging them"""
+    code_dir = Path(__file__).resolve().parent
+    return build_key("combined", [(report_file.name, file_digest(report_file)) for report_file in report_files],
+                     rules_file and file_digest(rules_file), file_digest(code_dir / 'combine_reports.py'),
+                     file_digest(code_dir / 'process_data.py'), file_digest(code_dir / 'compliance_rules.py'))
+
+def combine_reports(output_dir, metrics=None, cache=None, rules_file=None):
+    """Combine all processed reports into a single file for notifications
+    
+    Apps are checked against the compliance rules of rules_file, which
+    should be the rules the reports were processed with, or the default
+    thresholds without one. Parse, merge and write times are recorded in
+    metrics when one is given. With a build cache, the merge is skipped
+    when no processed report changed since the combined report was last
+    built. A change to any report re-merges them all: the issue ids of the
+    combined table and the documents each report is credited with depend on
+    the order the reports are merged in.
+    """
+    if metrics is None:
+        metrics = StageMetrics("combine")
     
     output_path = Path(output_dir)
-    combined_data = {
-        'custodian': {}, 
-        'summary': {'app_codes': []}
-    }
-    reports_processed = 0
-    
-    # Find all processed report files
-    for report_file in output_path.glob('*_report_processed.json'):
-        if report_file.exists():
-            try:
+    combined_file = output_path / COMBINED_REPORT
+    merger = ReportMerger(load_compliance_rules(rules_file))
+    
+    # Find all processed report files, skipping the output of a previous run
+    report_files = [report_file for report_file in sorted(output_path.glob('*_report_processed.json'))
+                    if report_file.name != COMBINED_REPORT]
+    
+    key = None
+    if cache is not None:
+        with metrics.timer("cache"):
+            key = combined_cache_key(report_files, rules_file)
+            if cache.is_fresh(combined_file, key):
+                metrics.count("cached_outputs")
+                metrics.record_output(combined_file)
+                print(f'Combined report is up to date with its {len(report_files)} reports, skipping')
+                return True
+            cache.forget(combined_file)
+    
+    # Each report is released once merged
+    for report_file in report_files:
+        try:
+            with metrics.timer("parse"):
                 with open(report_file) as f:
                     data = json.load(f)
-                    reports_processed += 1
-                    
-                    # Merge custodian data (skip empty ones)
-                    if 'custodian' in data and data['custodian']:
-                        combined_data['custodian'].update(data['custodian'])
-                    
-                    # Merge app codes (skip empty ones)
-                    if ('summary' in data and 
-                        'app_codes' in data['summary'] and 
-                        data['summary']['app_codes']):
-                        combined_data['summary']['app_codes'].extend(
-                            data['summary']['app_codes'])
-                            
-            except Exception as e:
-                print(f'Warning: Could not process {report_file}: {e}')
+            with metrics.timer("merge"):
+                merger.add(data)
+        except Exception as e:
+            print(f'Warning: Could not process {report_file}: {e}')
     
     # Save combined report (even if empty)
-    combined_file = output_path / 'combined_report_processed.json'
-    with open(combined_file, 'w') as f:
-        json.dump(combined_data, f, indent=2)
+    combined_data = merger.result()
+    with metrics.timer("write"):
+        with open(combined_file, 'w') as f:
+            json.dump(combined_data, f, indent=2)
+    metrics.record_output(combined_file)
+    if key is not None:
+        cache.record(combined_file, key)
+    metrics.count("reports", merger.reports)
+    metrics.count("documents", len(combined_data["issues"]["rows"]))
     
-    print(f'Combined {reports_processed} reports successfully')
+    print(f'Combined {merger.reports} reports successfully')
     print(f'Total custodians: {len(combined_data["custodian"])}')
     print(f'Total app codes: {len(combined_data["summary"]["app_codes"])}')
+    print(f'Total issues: {len(combined_data["issues"]["rows"])}')
+    print(f'Non-compliant app codes: '
+          f'{sum(1 for app in combined_data["summary"]["app_codes"] if not app["compliance"]["is_compliant"])}')
+    if merger.partial:
+        metrics.count("partial_reports", len(merger.partial))
+        print(f'Warning: {len(merger.partial)} reports were built from partial data: '
+              f'{describe_partial(merger.partial)}')
     
     return True
 
+def main():
+    """Main function to combine processed reports"""
+    parser = argparse.ArgumentParser(description='Combine processed reports for notifications')
+    parser.add_argument('output_dir', nargs='?', default='roles/files/output',
+                        help='Directory holding the *_report_processed.json files')
+    parser.add_argument('--metrics', help='Output file for the stage timing and memory metrics')
+    parser.add_argument('--build-cache',
+                        help='Build cache directory; the merge is skipped if no processed report changed')
+    parser.add_argument('--rules', help='JSON compliance rules file (default: the built-in severity thresholds)')
+    
+    args = parser.parse_args()
+    metrics = StageMetrics("combine")
+    
+    try:
+        success = combine_reports(args.output_dir, metrics,
+                                  BuildCache(args.build_cache) if args.build_cache else None, args.rules)
+    except ValueError as e:
+        print(f"ERROR: {str(e)}")
+        success = False
+    
+    if args.metrics:
+        metrics.write(args.metrics, success)
+    
+    return 0 if success else 1
+
 if __name__ == "__main__":
-    output_dir = sys.argv[1] if len(sys.argv) > 1 else 'roles/files/output'
-    success = combine_reports(output_dir)
-    sys.exit(0 if success else 1) 
\ No newline at end of file
+    sys.exit(main())
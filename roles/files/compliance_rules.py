@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import os
+import json
+from datetime import date, timedelta
+
+# Same order as process_data.SEVERITY_LEVELS, which imports this module
+SEVERITY_LEVELS = ("critical", "high", "medium", "low", "info")
+
+# Weight of each severity in score rules, unless the rules file sets its own
+DEFAULT_SEVERITY_WEIGHTS = {"critical": 10, "high": 5, "medium": 2, "low": 1, "info": 0}
+
+class RulesError(ValueError):
+    """Raised when a rules file is not valid"""
+
+def thresholds_rules(thresholds):
+    """Build the rules config of plain severity thresholds, e.g. {"critical": 0, "high": 0, "medium": 10}"""
+    return {"rules": [{"name": severity, "severities": [severity], "max": limit}
+                      for severity, limit in thresholds.items()]}
+
+class Rule:
+    """One compiled rule: which findings it counts, how much each adds and the most an app may have"""
+    
+    def __init__(self, name, base_name, severities, issue_types, excluded_types, metric, weights,
+                 overdue_days, cutoff, limit, reason):
+        self.name = name
+        self.base_name = base_name
+        self.severities = severities
+        self.issue_types = issue_types
+        self.excluded_types = excluded_types
+        self.metric = metric
+        self.overdue_days = overdue_days
+        self.cutoff = cutoff
+        self.max = limit
+        self.reason_format = reason
+        self.amounts = {severity: (weights.get(severity, 0) if metric == "score" else 1)
+                        for severity in (severities or SEVERITY_LEVELS)}
+    
+    def amount(self, severity, issue_type):
+        """Get how much a finding of this severity and issue type adds to the rule's count, before its date"""
+        if self.issue_types is not None and issue_type not in self.issue_types:
+            return 0
+        if issue_type in self.excluded_types:
+            return 0
+        return self.amounts.get(severity, 0)
+    
+    def label(self):
+        """Describe the findings the rule counts, e.g. "critical/high Cryptography" """
+        words = []
+        if self.severities is not None:
+            words.append("/".join(self.severities))
+        if self.issue_types is not None:
+            words.append("/".join(sorted(self.issue_types)))
+        return " ".join(words)
+    
+    def reason(self, count, limit):
+        """Explain why an app's count breaks the rule"""
+        if self.reason_format:
+            return self.reason_format.format(count=count, max=limit, name=self.name)
+        label = self.label()
+        if self.metric == "score":
+            subject = f"a weighted {label + ' ' if label else ''}severity score of {count}"
+        else:
+            subject = f"{count} {label + ' ' if label else ''}findings"
+        if self.overdue_days is not None:
+            subject += " past their fix-by date" if self.overdue_days == 0 else \
+                f" more than {self.overdue_days} days past their fix-by date"
+        return f"Has {subject} (threshold: {limit})"
+
+class RuleSet:
+    """Compliance rules compiled from a declarative config
+    
+    The config is a dict (a JSON rules file) with:
+    
+    - rules: list of rules, checked in order. Each has a unique name, the
+      most findings an app may have (max), and optionally the severities
+      and issue_types it counts (default all), metric "count" (default) or
+      "score" to sum severity_weights, overdue_days to only count findings
+      whose fixByDate is more than that many days before the as-of date,
+      and a reason format string with {count}, {max} and {name}.
+    - severity_weights: weight of each severity for score rules.
+    - issue_types: per-issue-type overrides, {issue type: {rule name: max}};
+      the issue type's findings are counted by a separate copy of the rule
+      named "<rule>/<issue type>" with that max.
+    - apps: per-app overrides, {app code: {rule name: max}}, applying to a
+      rule and its issue type copies; a max of null turns the rule off.
+    
+    Compiling resolves the overrides and the overdue cutoff date once, and
+    increments() caches the rule increments of each severity and issue
+    type, so counting a finding against every rule is one dict lookup and
+    a date comparison for age rules, within the same pass as the rest of
+    the analysis.
+    """
+    
+    def __init__(self, config, as_of=None):
+        as_of = as_of or date.today()
+        self.config = config
+        weights = config.get("severity_weights", DEFAULT_SEVERITY_WEIGHTS)
+        issue_type_overrides = config.get("issue_types", {})
+        self.app_overrides = config.get("apps", {})
+        self.rules = []
+        self._increments = {}
+        self._limits = {}
+        self._uncounted = set()
+        
+        names = set()
+        for spec in config.get("rules", []):
+            name = spec.get("name")
+            if not name or name in names:
+                raise RulesError(f"Every rule needs a unique name: {spec}")
+            names.add(name)
+            severities = spec.get("severities")
+            for severity in severities or ():
+                if severity not in SEVERITY_LEVELS:
+                    raise RulesError(f"Rule {name}: unknown severity {severity}")
+            metric = spec.get("metric", "count")
+            if metric not in ("count", "score"):
+                raise RulesError(f"Rule {name}: unknown metric {metric}")
+            if not isinstance(spec.get("max"), int):
+                raise RulesError(f"Rule {name}: max must be an integer")
+            overdue_days = spec.get("overdue_days")
+            cutoff = (as_of - timedelta(days=overdue_days)).isoformat() if overdue_days is not None else None
+            severities = tuple(severity for severity in SEVERITY_LEVELS if severity in severities) \
+                if severities else None
+            issue_types = frozenset(spec["issue_types"]) if spec.get("issue_types") else None
+            overridden = {issue_type: overrides[name] for issue_type, overrides in issue_type_overrides.items()
+                          if name in overrides and (issue_types is None or issue_type in issue_types)}
+            for issue_type, limit in overridden.items():
+                if not isinstance(limit, int):
+                    raise RulesError(f"Issue type {issue_type}: max of rule {name} must be an integer")
+            
+            def compile_rule(rule_name, scope, excluded, limit):
+                return Rule(rule_name, name, severities, scope, excluded, metric, weights,
+                            overdue_days, cutoff, limit, spec.get("reason"))
+            
+            self.rules.append(compile_rule(name, issue_types, frozenset(overridden), spec["max"]))
+            for issue_type, limit in overridden.items():
+                self.rules.append(compile_rule(f"{name}/{issue_type}", frozenset([issue_type]), frozenset(), limit))
+        
+        for app_code, overrides in self.app_overrides.items():
+            for name, limit in overrides.items():
+                if name not in names:
+                    raise RulesError(f"App {app_code} overrides unknown rule {name}")
+                if limit is not None and not isinstance(limit, int):
+                    raise RulesError(f"App {app_code}: max of rule {name} must be an integer or null")
+        
+        self.names = [rule.name for rule in self.rules]
+        self.uses_dates = any(rule.cutoff is not None for rule in self.rules)
+    
+    def increments(self, severity, issue_type):
+        """Get the (rule index, amount, cutoff) of every rule a finding of this severity and issue type adds to
+        
+        A cutoff of None means the finding counts whatever its fixByDate;
+        otherwise it only counts if its fixByDate is before the cutoff.
+        """
+        key = (severity, issue_type)
+        increments = self._increments.get(key)
+        if increments is None:
+            increments = self._increments[key] = tuple(
+                (index, amount, rule.cutoff)
+                for index, rule in enumerate(self.rules)
+                for amount in (rule.amount(severity, issue_type),)
+                if amount
+            )
+        return increments
+    
+    def count(self, counts, severity, issue_type, fix_by_date=None, doc_count=1):
+        """Add doc_count findings of this severity, issue type and fixByDate to a list of rule counts"""
+        for index, amount, cutoff in self.increments(severity, issue_type):
+            if cutoff is None or (fix_by_date and str(fix_by_date) < cutoff):
+                counts[index] += amount * doc_count
+    
+    def limits(self, app_code):
+        """Get the max of every rule for one app, None where the app has the rule turned off"""
+        limits = self._limits.get(app_code)
+        if limits is None:
+            overrides = self.app_overrides.get(app_code, {})
+            limits = self._limits[app_code] = tuple(
+                overrides[rule.base_name] if rule.base_name in overrides else rule.max for rule in self.rules
+            )
+        return limits
+    
+    def evaluate(self, app_code, counts):
+        """Check an app's rule counts, returning (is_compliant, reasons)"""
+        reasons = [
+            rule.reason(count, limit)
+            for rule, count, limit in zip(self.rules, counts, self.limits(app_code))
+            if limit is not None and count > limit
+        ]
+        return not reasons, reasons
+    
+    def counts_from_report(self, rule_counts, severity_counts):
+        """Get an app's rule counts from a report entry
+        
+        Reports written before rules were counted only have severity
+        counts; the rules that need nothing else are worked out from those
+        and the others are left at 0. So are rules the report has no count
+        for, such as rules added since it was processed; see warn_uncounted().
+        """
+        if rule_counts is not None:
+            self.warn_uncounted((name for name in self.names if name not in rule_counts),
+                                "the report was processed without it")
+            return [rule_counts.get(name, 0) for name in self.names]
+        uncounted = {
+            rule.name for rule in self.rules
+            if rule.issue_types is not None or rule.excluded_types or rule.cutoff is not None
+            or any(amount and severity not in severity_counts for severity, amount in rule.amounts.items())
+        }
+        self.warn_uncounted(uncounted, "the report only has severity counts")
+        return [
+            sum(amount * severity_counts.get(severity, 0) for severity, amount in rule.amounts.items())
+            if rule.name not in uncounted else 0
+            for rule in self.rules
+        ]
+    
+    def warn_uncounted(self, names, why):
+        """Warn that rules are counted as 0 for a report entry, once per rule"""
+        for name in names:
+            if name not in self._uncounted:
+                self._uncounted.add(name)
+                print(f"Warning: Rule {name} counted as 0 because {why}")
+
+_rules_cache = {}
+
+def load_rules(rules_file, as_of=None):
+    """Compile the rules of a JSON rules file, with age rules counting back from as_of (default today)
+    
+    The compiled rules are reused for the same as-of date until the file
+    changes.
+    """
+    as_of = as_of or date.today()
+    try:
+        mtime = os.path.getmtime(rules_file)
+        cached = _rules_cache.get((rules_file, as_of))
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(rules_file) as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        raise RulesError(f"Could not read rules file {rules_file}: {e}")
+    if not isinstance(config, dict):
+        raise RulesError(f"Rules file {rules_file} must hold a JSON object")
+    rules = RuleSet(config, as_of)
+    _rules_cache[(rules_file, as_of)] = (mtime, rules)
+    return rules
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, timedelta
+
+from process_data import SEVERITY_LEVELS
+from render_emails import build_custodian_index, get_issues_for_app, merge_app_entries
+
+# Delta statuses of an app; every one but unchanged is a material change
+APP_STATUSES = ("new", "changed", "resolved", "unchanged")
+
+def app_snapshot(report):
+    """Get the severity counts, issue document ids and custodian of each app in a combined report"""
+    custodians = report.get('custodian', {})
+    custodian_index = build_custodian_index(custodians)
+    snapshot = {}
+    for app_code, app in merge_app_entries(report.get('summary', {}).get('app_codes', [])).items():
+        custodian_key = custodian_index.get(app_code)
+        custodian = custodians.get(custodian_key, {})
+        issues = get_issues_for_app(report, app, custodian_key)
+        snapshot[app_code] = {
+            "severity_counts": app['severity_counts'],
+            "issues": sorted({issue['_id'] for issue in issues if issue.get('_id') is not None}),
+            "custodian_name": custodian.get('custodian_name'),
+            "custodian_email": custodian_key if custodian.get('has_email') else None
+        }
+    return snapshot
+
+def plural(count, noun):
+    """Format a count with its noun"""
+    return f"{count} {noun}{'' if count == 1 else 's'}"
+
+def describe_change(entry):
+    """Describe an app's changes since the baseline in one line for its email"""
+    if entry['status'] == "new":
+        return "first report for this application"
+    parts = []
+    if entry['new_issues']:
+        parts.append(plural(len(entry['new_issues']), 'new issue'))
+    if entry['resolved_issues']:
+        parts.append(f"{plural(len(entry['resolved_issues']), 'issue')} resolved")
+    parts.extend(f"{level} {change:+d}" for level, change in entry['severity_changes'].items())
+    return ", ".join(parts) or "no changes"
+
+def diff_app(before, now, complete=True):
+    """Compare one app's baseline and current snapshot entries, either of which may be None
+    
+    Issues missing from incomplete data may just not have been fetched, so
+    they are only reported resolved when complete is true.
+    """
+    before_issues = set(before['issues']) if before else set()
+    now_issues = set(now['issues']) if now else set()
+    before_counts = before['severity_counts'] if before else {}
+    now_counts = now['severity_counts'] if now else {}
+    
+    entry = {
+        "new_issues": sorted(now_issues - before_issues),
+        "resolved_issues": sorted(before_issues - now_issues) if complete else [],
+        "unchanged_issues": len(now_issues & before_issues),
+        "severity_counts": {level: now_counts.get(level, 0) for level in SEVERITY_LEVELS},
+        "severity_changes": {
+            level: now_counts.get(level, 0) - before_counts.get(level, 0)
+            for level in SEVERITY_LEVELS
+            if now_counts.get(level, 0) != before_counts.get(level, 0)
+        },
+        "custodian_name": (now or before).get('custodian_name'),
+        "custodian_email": (now or before).get('custodian_email')
+    }
+    if before is None:
+        entry["status"] = "new"
+    elif now is None:
+        entry["status"] = "resolved"
+    elif entry["new_issues"] or entry["resolved_issues"] or entry["severity_changes"]:
+        entry["status"] = "changed"
+    else:
+        entry["status"] = "unchanged"
+    entry["material"] = entry["status"] != "unchanged"
+    entry["summary"] = describe_change(entry)
+    return entry
+
+def diff_snapshots(previous, current, complete=True):
+    """Compare every app of the baseline and current snapshots, in current report order
+    
+    Apps only in the baseline are resolved, unless the current data is
+    incomplete, in which case they are left out.
+    """
+    apps = {app_code: diff_app(previous.get(app_code), now, complete) for app_code, now in current.items()}
+    if complete:
+        for app_code, before in previous.items():
+            if app_code not in current:
+                apps[app_code] = diff_app(before, None)
+    return apps
+
+def load_baseline(baseline_file):
+    """Load the baseline of the last notified run, or an empty one before the first"""
+    if not os.path.exists(baseline_file):
+        return {"accepted_at": None, "last_digest": None, "apps": {}}
+    with open(baseline_file) as f:
+        return json.load(f)
+
+def digest_due(baseline, digest_days, today):
+    """Check whether the periodic full digest is due: digest_days after the last one, never with 0"""
+    if not digest_days:
+        return False
+    if not baseline.get('last_digest'):
+        return True
+    last_digest = datetime.strptime(baseline['last_digest'], "%Y-%m-%d").date()
+    return today - last_digest >= timedelta(days=digest_days)
+
+def write_delta(report_file, baseline_file, delta_file, digest_days=7):
+    """Diff a combined report against the baseline and save the per-app delta, returning it"""
+    with open(report_file) as f:
+        report = json.load(f)
+    baseline = load_baseline(baseline_file)
+    complete = not report.get('partial')
+    apps = diff_snapshots(baseline['apps'], app_snapshot(report), complete)
+    
+    delta = {
+        "generated_at": datetime.now().isoformat(),
+        "baseline_at": baseline.get('accepted_at'),
+        "complete": complete,
+        "digest": digest_due(baseline, digest_days, datetime.now().date()),
+        "counts": {status: sum(1 for entry in apps.values() if entry['status'] == status)
+                   for status in APP_STATUSES},
+        "apps": apps
+    }
+    with open(delta_file, 'w') as f:
+        json.dump(delta, f, indent=2)
+    
+    counts = delta["counts"]
+    print(f"Compared {len(apps)} apps with the baseline from {delta['baseline_at'] or 'no previous run'}: "
+          f"{counts['new']} new, {counts['changed']} changed, {counts['resolved']} resolved, "
+          f"{counts['unchanged']} unchanged")
+    if not complete:
+        print("Warning: Report was built from partial data; no issues are reported resolved")
+    if delta["digest"]:
+        print("Full digest due: every app will be notified")
+    print(f"Delta saved to {delta_file}")
+    return delta
+
+def undelivered_apps(delivery_report_file):
+    """Get the app codes whose notification send_emails.py could not deliver"""
+    with open(delivery_report_file) as f:
+        delivery_report = json.load(f)
+    return {result['app_code'] for result in delivery_report.get('results', []) if result['status'] != "sent"}
+
+def accept_report(report_file, baseline_file, delta_file=None, delivery_report_file=None):
+    """Record a combined report as the baseline once its notifications were sent
+    
+    The baseline is kept as it was if the report was built from partial
+    data, so the next complete run is compared with complete data; the
+    digest date still moves on if the delta was a digest. Apps whose
+    notification was not delivered keep their previous baseline entry, so
+    the next run notifies them of the same changes again.
+    """
+    baseline = load_baseline(baseline_file)
+    delta = {}
+    if delta_file:
+        with open(delta_file) as f:
+            delta = json.load(f)
+    undelivered = undelivered_apps(delivery_report_file) if delivery_report_file else set()
+    with open(report_file) as f:
+        report = json.load(f)
+    
+    today = datetime.now().strftime("%Y-%m-%d")
+    if delta.get('digest'):
+        baseline['last_digest'] = today
+    if report.get('partial'):
+        print("Warning: Report was built from partial data, keeping the previous baseline")
+    else:
+        apps = app_snapshot(report)
+        for app_code in undelivered:
+            if app_code in baseline['apps']:
+                apps[app_code] = baseline['apps'][app_code]
+            else:
+                apps.pop(app_code, None)
+        if undelivered:
+            print(f"Warning: Keeping the previous baseline of {len(undelivered)} app(s) whose notification "
+                  f"was not delivered")
+        baseline['accepted_at'] = datetime.now().isoformat()
+        baseline['apps'] = apps
+    
+    os.makedirs(os.path.dirname(baseline_file) or ".", exist_ok=True)
+    temp_file = f"{baseline_file}.tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(baseline, f)
+    os.replace(temp_file, baseline_file)
+    print(f"Baseline of {len(baseline['apps'])} apps saved to {baseline_file}")
+
+def main():
+    """Main function to diff a combined report against the last notified run"""
+    parser = argparse.ArgumentParser(description='Diff per-app issues against the last notified run')
+    parser.add_argument('--report', required=True, help='Combined processed report JSON file')
+    parser.add_argument('--baseline', required=True, help='Baseline file of the last notified run')
+    parser.add_argument('--delta', help='Output file for the per-app delta (input with --accept)')
+    parser.add_argument('--digest-days', type=int, default=7,
+                        help='Days between full digests notifying every app (0 to never send one)')
+    parser.add_argument('--accept', action='store_true',
+                        help='Record --report as the baseline once its notifications were sent')
+    parser.add_argument('--delivery-report',
+                        help='Delivery report of send_emails.py; with --accept, undelivered apps keep their baseline')
+    
+    args = parser.parse_args()
+    
+    try:
+        if args.accept:
+            accept_report(args.report, args.baseline, args.delta, args.delivery_report)
+        else:
+            if not args.delta:
+                parser.error('--delta is required without --accept')
+            write_delta(args.report, args.baseline, args.delta, args.digest_days)
+    except Exception as e:
+        print(f"ERROR: Failed to diff reports: {str(e)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
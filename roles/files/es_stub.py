@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+
+import sys
+import gzip
+import json
+import time
+import random
+import argparse
+import threading
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from benchmark import synthetic_hit
+
+# Error kinds --errors can inject into search, msearch and point-in-time requests
+ERROR_KINDS = ["429", "500", "502", "503", "truncated", "reset"]
+
+ERROR_TYPES = {
+    429: "es_rejected_execution_exception",
+    500: "internal_server_error",
+    502: "bad_gateway",
+    503: "no_shard_available_action_exception",
+}
+
+# Corpus timestamps start here and advance one second per document, so a
+# timestamp sort walks documents in number order
+CORPUS_EPOCH = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+def as_list(value):
+    """Wrap a single query clause in a list"""
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def get_field(source, field):
+    """Read a dotted field from a _source dict, treating .keyword as the field itself"""
+    if field.endswith(".keyword"):
+        field = field[:-len(".keyword")]
+    value = source
+    for part in field.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+def matches(source, clause):
+    """Evaluate the subset of the query DSL fetch_data.py sends against one _source"""
+    if not clause or "match_all" in clause:
+        return True
+    if "bool" in clause:
+        query = clause["bool"]
+        if not all(matches(source, sub) for sub in as_list(query.get("must")) + as_list(query.get("filter"))):
+            return False
+        if any(matches(source, sub) for sub in as_list(query.get("must_not"))):
+            return False
+        should = as_list(query.get("should"))
+        if should:
+            minimum = query.get("minimum_should_match", 1)
+            return sum(1 for sub in should if matches(source, sub)) >= minimum
+        return True
+    if "terms" in clause:
+        (field, values), = clause["terms"].items()
+        return get_field(source, field) in values
+    if "term" in clause:
+        (field, value), = clause["term"].items()
+        if isinstance(value, dict):
+            value = value.get("value")
+        return get_field(source, field) == value
+    if "exists" in clause:
+        return get_field(source, clause["exists"]["field"]) is not None
+    if "range" in clause:
+        (field, bounds), = clause["range"].items()
+        value = get_field(source, field)
+        if value is None:
+            return False
+        checks = {"gte": lambda v, b: v >= b, "gt": lambda v, b: v > b,
+                  "lte": lambda v, b: v <= b, "lt": lambda v, b: v < b}
+        return all(check(value, bounds[op]) for op, check in checks.items() if op in bounds)
+    raise ValueError(f"Unsupported query clause: {json.dumps(clause)[:200]}")
+
+def terms_aggregation(documents, spec, sub_aggs):
+    """Evaluate a terms aggregation: buckets by doc count, then key"""
+    counts = {}
+    for number, source in documents:
+        key = get_field(source, spec["field"])
+        if key is not None:
+            counts.setdefault(key, []).append((number, source))
+    keys = sorted(counts, key=lambda key: (-len(counts[key]), str(key)))[:spec.get("size", 10)]
+    buckets = []
+    for key in keys:
+        bucket = {"key": key, "doc_count": len(counts[key])}
+        bucket.update(aggregate(counts[key], sub_aggs))
+        buckets.append(bucket)
+    return {
+        "doc_count_error_upper_bound": 0,
+        "sum_other_doc_count": sum(len(docs) for key, docs in counts.items() if key not in keys),
+        "buckets": buckets
+    }
+
+def composite_key(values):
+    """Sort key of a composite bucket: missing values first, then by value"""
+    return tuple((value is not None, value if value is not None else "") for value in values)
+
+def composite_aggregation(documents, spec):
+    """Evaluate a composite aggregation of terms sources, one page after spec's after key"""
+    names = [next(iter(source)) for source in spec["sources"]]
+    fields = [next(iter(source.values()))["terms"]["field"] for source in spec["sources"]]
+    counts = {}
+    for number, source in documents:
+        key = tuple(get_field(source, field) for field in fields)
+        counts[key] = counts.get(key, 0) + 1
+    
+    keys = sorted(counts, key=composite_key)
+    if "after" in spec:
+        after = composite_key(tuple(spec["after"].get(name) for name in names))
+        keys = [key for key in keys if composite_key(key) > after]
+    keys = keys[:spec.get("size", 10)]
+    
+    result = {"buckets": [{"key": dict(zip(names, key)), "doc_count": counts[key]} for key in keys]}
+    if keys:
+        result["after_key"] = dict(zip(names, keys[-1]))
+    return result
+
+def aggregate(documents, aggs):
+    """Evaluate the terms, filters and composite aggregations fetch_data.py sends"""
+    results = {}
+    for name, spec in (aggs or {}).items():
+        sub_aggs = spec.get("aggs") or spec.get("aggregations")
+        if "terms" in spec:
+            results[name] = terms_aggregation(documents, spec["terms"], sub_aggs)
+        elif "filters" in spec:
+            buckets = {}
+            for key, clause in spec["filters"]["filters"].items():
+                matching = [(number, source) for number, source in documents if matches(source, clause)]
+                buckets[key] = {"doc_count": len(matching)}
+                buckets[key].update(aggregate(matching, sub_aggs))
+            results[name] = {"buckets": buckets}
+        elif "composite" in spec:
+            results[name] = composite_aggregation(documents, spec["composite"])
+        else:
+            raise ValueError(f"Unsupported aggregation {name}: {json.dumps(spec)[:200]}")
+    return results
+
+def filter_source(source, includes):
+    """Keep only the included fields of a _source, following one level of nesting"""
+    if not includes:
+        return source
+    filtered = {}
+    for path in includes:
+        top, _, sub = path.partition(".")
+        if top not in source:
+            continue
+        if not sub:
+            filtered[top] = source[top]
+        elif isinstance(source[top], dict) and sub in source[top]:
+            filtered.setdefault(top, {})[sub] = source[top][sub]
+    return filtered
+
+def parse_keep_alive(value):
+    """Convert a keep_alive like 30s, 1m or 1h to seconds"""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+    for unit in sorted(units, key=len, reverse=True):
+        if value.endswith(unit) and value[:-len(unit)].isdigit():
+            return int(value[:-len(unit)]) * units[unit]
+    return 60
+
+class Corpus:
+    """A generated compliance index held in memory
+    
+    Documents come from benchmark.synthetic_hit() with a timestamp one
+    second apart and every tenth document at priority P3, so the P1/P2
+    filter has something to drop. Matching documents and aggregations are
+    cached per distinct query, so paging through a point-in-time only
+    scans the corpus once. Memory is roughly 2 GB per million documents.
+    """
+    
+    def __init__(self, documents, apps, custodians, seed=42):
+        rng = random.Random(seed)
+        self.hits = []
+        for number in range(documents):
+            hit = synthetic_hit(number, apps, custodians, rng)
+            hit["_source"]["timestamp"] = (CORPUS_EPOCH + timedelta(seconds=number)).strftime("%Y-%m-%dT%H:%M:%SZ")
+            if number % 10 == 9:
+                hit["_source"]["priority"] = "P3"
+            self.hits.append(hit)
+        self.next_timestamp = CORPUS_EPOCH + timedelta(seconds=documents)
+        self._cache = {}
+        self._lock = threading.Lock()
+    
+    def sort_values(self, number, sort):
+        """Get a document's sort values for a sort spec: field values, then _shard_doc"""
+        values = []
+        for spec in sort:
+            field = next(iter(spec)) if isinstance(spec, dict) else spec
+            if field == "_shard_doc":
+                continue
+            values.append(get_field(self.hits[number]["_source"], field))
+        values.append(number)
+        return tuple(values)
+    
+    def search(self, query, sort, slice_spec):
+        """Get the (sort values, document number) list of a query in sort order, plus its total"""
+        cache_key = json.dumps([query, sort, slice_spec], sort_keys=True)
+        with self._lock:
+            cached = self._cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        numbers = [number for number, hit in enumerate(self.hits) if matches(hit["_source"], query)]
+        if slice_spec:
+            numbers = [number for number in numbers if number % slice_spec["max"] == slice_spec["id"]]
+        ordered = sorted((self.sort_values(number, sort), number) for number in numbers)
+        
+        with self._lock:
+            if len(self._cache) >= 64:
+                self._cache.clear()
+            self._cache[cache_key] = ordered
+        return ordered
+    
+    def aggregations(self, query, aggs):
+        """Evaluate aggregations over the documents matching a query"""
+        cache_key = json.dumps(["aggs", query, aggs], sort_keys=True)
+        with self._lock:
+            cached = self._cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        documents = [(number, hit["_source"]) for number, hit in enumerate(self.hits)
+                     if matches(hit["_source"], query)]
+        result = aggregate(documents, aggs)
+        with self._lock:
+            self._cache[cache_key] = result
+        return result
+    
+    def update(self, ids, source):
+        """Apply a partial _source update to documents and move their timestamp forward"""
+        ids = set(ids)
+        updated = 0
+        with self._lock:
+            for hit in self.hits:
+                if hit["_id"] in ids:
+                    hit["_source"].update(source)
+                    self.next_timestamp += timedelta(seconds=1)
+                    hit["_source"]["timestamp"] = self.next_timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+                    updated += 1
+            self._cache.clear()
+        return updated
+
+class StubState:
+    """Corpus, point-in-times, fault settings and request counters shared by every handler"""
+    
+    def __init__(self, corpus, latency=0.0, jitter=0.0, error_rate=0.0, errors=None,
+                 fail_every=0, seed=42):
+        self.corpus = corpus
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.errors = errors or ["429", "503"]
+        self.fail_every = fail_every
+        self.rng = random.Random(seed)
+        self.pits = {}
+        self.stats = {"requests": 0, "searches": 0, "hits_returned": 0, "errors_injected": {}}
+        self.lock = threading.Lock()
+    
+    def pick_error(self):
+        """Decide whether the next faultable request fails, and how"""
+        with self.lock:
+            self.stats["requests"] += 1
+            if self.fail_every and self.stats["requests"] % self.fail_every == 0:
+                kind = self.errors[(self.stats["requests"] // self.fail_every - 1) % len(self.errors)]
+            elif self.error_rate and self.rng.random() < self.error_rate:
+                kind = self.rng.choice(self.errors)
+            else:
+                return None
+            self.stats["errors_injected"][kind] = self.stats["errors_injected"].get(kind, 0) + 1
+            return kind
+    
+    def delay(self):
+        """Sleep for the configured latency plus jitter"""
+        with self.lock:
+            seconds = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+        if seconds > 0:
+            time.sleep(seconds)
+    
+    def open_pit(self, keep_alive):
+        """Open a point-in-time and return its id"""
+        with self.lock:
+            pit_id = f"stub-pit-{len(self.pits) + 1}-{self.rng.randrange(1 << 30):x}"
+            self.pits[pit_id] = time.monotonic() + parse_keep_alive(keep_alive)
+        return pit_id
+    
+    def touch_pit(self, pit_id, keep_alive):
+        """Extend a point-in-time, returning False if it is closed or expired"""
+        with self.lock:
+            expires = self.pits.get(pit_id)
+            if expires is None or expires < time.monotonic():
+                self.pits.pop(pit_id, None)
+                return False
+            if keep_alive:
+                self.pits[pit_id] = time.monotonic() + parse_keep_alive(keep_alive)
+            return True
+    
+    def close_pit(self, pit_id):
+        """Close a point-in-time, returning whether it was open"""
+        with self.lock:
+            return self.pits.pop(pit_id, None) is not None
+    
+    def search(self, body):
+        """Run one search body against the corpus"""
+        query = body.get("query", {"match_all": {}})
+        if "pit" in body and not self.touch_pit(body["pit"].get("id"), body["pit"].get("keep_alive")):
+            return 404, error_body(404, "search_context_missing_exception",
+                                   f"No search context found for id [{body['pit'].get('id')}]")
+        
+        sort = as_list(body.get("sort")) or [{"_shard_doc": "asc"}]
+        ordered = self.corpus.search(query, sort, body.get("slice"))
+        start = 0
+        if body.get("search_after") is not None:
+            start = bisect_right(ordered, (tuple(body["search_after"]), float("inf")))
+        page = ordered[start:start + body.get("size", 10)]
+        
+        includes = (body.get("_source") or {}).get("includes") if isinstance(body.get("_source"), dict) else None
+        hits = []
+        for sort_values, number in page:
+            hit = self.corpus.hits[number]
+            hits.append({
+                "_index": hit["_index"],
+                "_id": hit["_id"],
+                "_score": None,
+                "_source": filter_source(hit["_source"], includes),
+                "sort": list(sort_values)
+            })
+        
+        result = {
+            "took": 1,
+            "timed_out": False,
+            "hits": {"total": {"value": len(ordered), "relation": "eq"}, "max_score": None, "hits": hits}
+        }
+        if "pit" in body:
+            result["pit_id"] = body["pit"]["id"]
+        aggs = body.get("aggs") or body.get("aggregations")
+        if aggs:
+            result["aggregations"] = self.corpus.aggregations(query, aggs)
+        
+        with self.lock:
+            self.stats["searches"] += 1
+            self.stats["hits_returned"] += len(hits)
+        return 200, result
+
+def error_body(status, error_type, reason):
+    """Build an Elasticsearch-style error response body"""
+    return {"error": {"root_cause": [{"type": error_type, "reason": reason}],
+                      "type": error_type, "reason": reason}, "status": status}
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serve the Elasticsearch endpoints fetch_data.py uses from a StubState"""
+    
+    protocol_version = "HTTP/1.1"
+    state = None
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def read_body(self):
+        """Read the request body, decompressing it if the client gzipped it"""
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if body and self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return body
+    
+    def send_json(self, status, payload, truncate=False):
+        """Send a JSON response, gzipped if the client accepts it and cut in half when truncate is set"""
+        data = json.dumps(payload).encode()
+        if truncate:
+            data = data[:max(1, len(data) // 2)]
+        compress = "gzip" in (self.headers.get("Accept-Encoding") or "") and not truncate
+        if compress:
+            data = gzip.compress(data, compresslevel=1)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def inject_error(self):
+        """Fail the request if the fault settings say so, returning whether it failed"""
+        kind = self.state.pick_error()
+        if kind is None:
+            return False
+        if kind == "reset":
+            self.close_connection = True
+            return True
+        if kind == "truncated":
+            # A complete-looking 200 response whose JSON stops halfway
+            self.send_json(200, {"took": 1, "hits": {"total": {"value": 0, "relation": "eq"},
+                                                     "hits": [{"_id": "x" * 64}] * 8}}, truncate=True)
+            return True
+        status = int(kind)
+        self.send_json(status, error_body(status, ERROR_TYPES[status], f"Injected {status} by es_stub"))
+        return True
+    
+    def do_GET(self):
+        """Serve cluster info and the stub's counters"""
+        self.read_body()
+        path = urlsplit(self.path).path
+        if path == "/_stub/stats":
+            with self.state.lock:
+                stats = json.loads(json.dumps(self.state.stats))
+                stats["open_pits"] = len(self.state.pits)
+            return self.send_json(200, stats)
+        if path == "/":
+            return self.send_json(200, {
+                "name": "es-stub",
+                "cluster_name": "es-stub",
+                "version": {"number": "8.17.2", "build_flavor": "default"},
+                "tagline": "You Know, for Search"
+            })
+        self.send_json(404, error_body(404, "resource_not_found_exception", f"No handler for {path}"))
+    
+    def do_DELETE(self):
+        """Close a point-in-time"""
+        body = self.read_body()
+        if urlsplit(self.path).path != "/_pit":
+            return self.send_json(404, error_body(404, "resource_not_found_exception", self.path))
+        pit_id = json.loads(body or b"{}").get("id")
+        closed = self.state.close_pit(pit_id)
+        self.send_json(200 if closed else 404, {"succeeded": closed, "num_freed": 1 if closed else 0})
+    
+    def do_POST(self):
+        """Serve _pit, _search, _msearch and the stub's own update endpoint"""
+        url = urlsplit(self.path)
+        body = self.read_body()
+        params = parse_qs(url.query)
+        
+        if url.path == "/_stub/update":
+            update = json.loads(body)
+            return self.send_json(200, {"updated": self.state.corpus.update(update["ids"], update["source"])})
+        
+        if not (url.path.endswith("/_pit") or url.path.endswith("/_search") or url.path.endswith("/_msearch")):
+            return self.send_json(404, error_body(404, "resource_not_found_exception", url.path))
+        
+        self.state.delay()
+        if self.inject_error():
+            return
+        
+        try:
+            if url.path.endswith("/_pit"):
+                keep_alive = params.get("keep_alive", ["1m"])[0]
+                return self.send_json(200, {"id": self.state.open_pit(keep_alive)})
+            if url.path.endswith("/_msearch"):
+                lines = [json.loads(line) for line in body.decode().splitlines() if line.strip()]
+                responses = []
+                for index in range(0, len(lines) - 1, 2):
+                    status, result = self.state.search(lines[index + 1])
+                    result["status"] = status
+                    responses.append(result)
+                return self.send_json(200, {"took": 1, "responses": responses})
+            status, result = self.state.search(json.loads(body or b"{}"))
+            self.send_json(status, result)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, error_body(400, "parsing_exception", str(e)))
+
+def serve(state, host="127.0.0.1", port=9200):
+    """Create a threaded HTTP server for a StubState; call serve_forever() to run it"""
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    return ThreadingHTTPServer((host, port), handler)
+
+def main():
+    """Main function to run the Elasticsearch stand-in"""
+    parser = argparse.ArgumentParser(description='Serve a generated compliance index over the Elasticsearch API')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=9200, help='Port to listen on')
+    parser.add_argument('--documents', type=int, default=10000, help='Documents in the generated index')
+    parser.add_argument('--apps', type=int, default=100, help='Distinct app codes')
+    parser.add_argument('--custodians', type=int, default=100, help='Distinct custodians')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for the corpus and the injected faults')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every search request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra seconds, uniformly random')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of search, msearch and PIT requests that fail')
+    parser.add_argument('--fail-every', type=int, default=0,
+                        help='Fail every Nth search, msearch or PIT request (deterministic)')
+    parser.add_argument('--errors', nargs='+', choices=ERROR_KINDS, default=["429", "503"],
+                        help='Failures to inject: HTTP statuses, truncated JSON or a dropped connection')
+    
+    args = parser.parse_args()
+    
+    start = time.monotonic()
+    corpus = Corpus(args.documents, args.apps, args.custodians, args.seed)
+    state = StubState(corpus, args.latency, args.jitter, args.error_rate, args.errors, args.fail_every, args.seed)
+    server = serve(state, args.host, args.port)
+    print(f"Serving {args.documents} documents on http://{args.host}:{args.port} "
+          f"(generated in {time.monotonic() - start:.1f}s)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
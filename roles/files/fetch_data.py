@@ -1,15 +1,83 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
 import json
+import gzip
+import time
+import random
+import threading
 import requests
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
 import urllib3
 
+try:
+    import elastic_transport
+    import elasticsearch
+except ImportError:  # Only needed for FETCH_BACKEND=elasticsearch
+    elasticsearch = None
+
+from process_data import bucket_source, resolve_severity
+from run_metrics import StageMetrics, instrument_session
+from snapshot_store import SnapshotStore
+
 # Disable SSL warnings - use only in development or with self-signed certificates
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# _source fields read by process_data.py; nothing else is transferred unless
+# ES_FULL_SOURCE is set
+SOURCE_FIELDS = [
+    "appCode",
+    "issueType",
+    "severity",
+    "contact-info.app_custodian_name",
+    "contact-info.app_custodian_email",
+    "custodian_email",
+    "affectedItemType",
+    "affectedItemName",
+    "remediationLink",
+    "solution",
+    "fixByDate",
+]
+
+# Response fields kept by filter_path; error and status survive so failures
+# are still reported
+SEARCH_FILTER_PATH = [
+    "hits.total",
+    "hits.hits._id",
+    "hits.hits._source",
+    "hits.hits.sort",
+    "aggregations",
+    "pit_id",
+    "error",
+    "status",
+]
+
+# Fields the issue_buckets composite aggregation groups on in aggregate
+# mode: everything process_data.py counts issues by. Each source is named
+# after its field so the bucket keys read like _source fields.
+COMPOSITE_FIELDS = [
+    "appCode",
+    "issueType",
+    "severity",
+    "contact-info.app_custodian_name",
+    "contact-info.app_custodian_email",
+    "custodian_email",
+]
+
+# Response statuses worth retrying: rejected under load, or a node or proxy
+# that is briefly unavailable
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# fetch_data.py exit status when every output file was written but some
+# only hold part of their documents; they carry a "partial" section saying why
+PARTIAL_EXIT_CODE = 2
+
 def get_env_var(var_name, default=None, required=False):
     """Get environment variable or return default value"""
     value = os.environ.get(var_name, default)
@@ -18,6 +86,149 @@ def get_env_var(var_name, default=None, required=False):
         sys.exit(1)
     return value
 
+def get_fetch_workers():
+    """Get the number of concurrent Elasticsearch requests from FETCH_WORKERS"""
+    return max(1, int(get_env_var("FETCH_WORKERS", "4")))
+
+# Request timings, response sizes, documents written and output sizes of
+# this run, saved to METRICS_FILE when it is set
+metrics = StageMetrics("fetch")
+
+# Variables the shared session, client, backend and circuit breaker are
+# built from; start_run() rebuilds them when any of these changed
+CONNECTION_SETTINGS = (
+    "ES_HOST", "ES_USERNAME", "ES_PASSWORD", "FETCH_BACKEND", "FETCH_WORKERS", "ES_SNIFF",
+    "ES_READ_TIMEOUT", "ES_CIRCUIT_THRESHOLD", "ES_CIRCUIT_COOLDOWN",
+)
+
+_connection_settings = None
+
+_session = None
+
+def get_session():
+    """Get the HTTP session shared by every Elasticsearch request
+    
+    Reusing one session keeps connections (and their TLS handshakes) alive
+    across requests; its pool holds a connection for each of FETCH_WORKERS.
+    Every request made through it is logged in metrics.
+    """
+    global _session
+    if _session is None:
+        workers = get_fetch_workers()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        _session = requests.Session()
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+        instrument_session(_session, metrics)
+    return _session
+
+def get_timeout():
+    """Get the (connect, read) timeout of each request from ES_CONNECT_TIMEOUT and ES_READ_TIMEOUT"""
+    return (float(get_env_var("ES_CONNECT_TIMEOUT", "10")), float(get_env_var("ES_READ_TIMEOUT", "120")))
+
+class RequestError(Exception):
+    """An Elasticsearch request that failed, with the response status and error type when there was one"""
+    
+    def __init__(self, message, status=None, error_type=None):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+
+class TransientError(RequestError):
+    """A failed request worth retrying: a 429 or 5xx status or a truncated response"""
+    
+    def __init__(self, message, status=None, error_type=None, retry_after=None):
+        super().__init__(message, status, error_type)
+        self.retry_after = retry_after
+
+class CircuitOpenError(RequestError):
+    """Raised instead of sending a request while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Stop sending requests to a cluster that keeps failing
+    
+    After threshold consecutive failed attempts, from any thread, the
+    circuit opens and every request fails at once with CircuitOpenError
+    instead of adding to the load. Once cooldown seconds have passed one
+    trial request is let through; success closes the circuit again.
+    """
+    
+    def __init__(self, threshold=10, cooldown=60.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+    
+    def before_request(self):
+        """Raise CircuitOpenError unless a request may be sent now"""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(f"Circuit breaker open after {self.failures} consecutive failed "
+                                       f"requests, next attempt in {remaining:.0f}s")
+            # This request is the trial; the others wait out another cooldown
+            self.opened_at = time.monotonic()
+    
+    def record_success(self):
+        """Close the circuit after a request got an answer"""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+    
+    def record_failure(self):
+        """Count a failed attempt, opening the circuit at the threshold"""
+        with self._lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                if self.opened_at is None:
+                    print(f"WARNING: {self.failures} consecutive failed requests, "
+                          f"pausing Elasticsearch requests for {self.cooldown:.0f}s")
+                self.opened_at = time.monotonic()
+
+_circuit_breaker = None
+
+def get_circuit_breaker():
+    """Get the circuit breaker shared by every Elasticsearch request
+    
+    It opens after ES_CIRCUIT_THRESHOLD consecutive failed attempts (0
+    disables it) for ES_CIRCUIT_COOLDOWN seconds.
+    """
+    global _circuit_breaker
+    if _circuit_breaker is None:
+        _circuit_breaker = CircuitBreaker(int(get_env_var("ES_CIRCUIT_THRESHOLD", "10")),
+                                          float(get_env_var("ES_CIRCUIT_COOLDOWN", "60")))
+    return _circuit_breaker
+
+def parse_retry_after(value):
+    """Convert a Retry-After header, in seconds or as an HTTP date, to seconds"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def retry_delay(attempt, retry_after=None):
+    """Get the wait in seconds before retrying a request for the attempt-th time
+    
+    The response's Retry-After is used when it gave one. Otherwise the wait
+    is ES_RETRY_BACKOFF * 2 ** (attempt - 1) seconds, half of it random so
+    concurrent retries spread out. Both are capped at ES_RETRY_MAX_WAIT.
+    """
+    backoff = float(get_env_var("ES_RETRY_BACKOFF", "0.5"))
+    max_wait = float(get_env_var("ES_RETRY_MAX_WAIT", "30"))
+    if retry_after is not None:
+        return min(retry_after, max_wait)
+    wait = min(max_wait, backoff * 2 ** (attempt - 1))
+    return wait / 2 + random.uniform(0, wait / 2)
+
 def get_date_range():
     """Calculate the date range"""
     present_date = datetime.now()
@@ -29,32 +240,43 @@ def get_date_range():
     
     return start_date_str, end_date_str
 
-def query_elasticsearch():
-    """Query Elasticsearch using environment variables for configuration
+def get_issue_types():
+    """Get the issue types to fetch from ISSUE_TYPES (JSON list or comma-separated)"""
+    value = get_env_var("ISSUE_TYPES", "").strip()
+    if not value:
+        return []
+    if value.startswith("["):
+        return [issue_type for issue_type in json.loads(value) if issue_type]
+    return [issue_type.strip() for issue_type in value.split(",") if issue_type.strip()]
+
+def get_output_files(issue_types):
+    """Map each issue type to its raw output file
     
-    PRIORITY FILTER: This query only fetches P1 and P2 priority issues.
-    All other priorities (P3, P4, etc.) will be excluded from results.
+    Without issue types the single OUTPUT_FILE is keyed on None.
     """
+    if not issue_types:
+        output_file = get_env_var("OUTPUT_FILE", "")
+        return {None: output_file} if output_file else {}
     
-    # Get environment variables
-    es_host = get_env_var("ES_HOST", required=True)
-    es_index = get_env_var("ES_INDEX", required=True)
-    
-    # date range for last week
-    start_date, end_date = get_date_range()
-    print(f"Fetching P1/P2 priority data from {start_date} to {end_date}")
-    
-    # Get authentication if provided
-    username = get_env_var("ES_USERNAME", "")
-    password = get_env_var("ES_PASSWORD", "")
-    auth = None
-    if username and password:
-        auth = (username, password)
-    
-    # Build the search URL
-    search_url = f"{es_host}/{es_index}/_search"
-    
-    # Prepare the query - simplified to match actual data structure
+    output_dir = get_env_var("OUTPUT_DIR", "roles/files/output")
+    raw_format = get_raw_format()
+    return {
+        issue_type: os.path.join(output_dir, f"{issue_type}_report_raw.{raw_format}")
+        for issue_type in issue_types
+    }
+
+def use_full_source():
+    """Whether source filtering is disabled for debugging via ES_FULL_SOURCE"""
+    return get_env_var("ES_FULL_SOURCE", "false").lower() in ("1", "true", "yes")
+
+def search_params(prefix=""):
+    """Build the filter_path request parameter trimming search responses to what we read"""
+    if use_full_source():
+        return {}
+    return {"filter_path": ",".join(f"{prefix}{path}" for path in SEARCH_FILTER_PATH)}
+
+def build_query(issue_types=None):
+    """Build the P1/P2 search body, optionally restricted to the given issue types"""
     query = {
         "query": {
             "bool": {
@@ -109,137 +331,1535 @@ def query_elasticsearch():
         "size": 1000  # Increase size to get more actual documents
     }
     
-    headers = {
-        "Content-Type": "application/json"
+    if not use_full_source():
+        query["_source"] = {"includes": SOURCE_FIELDS}
+    
+    if issue_types:
+        query["query"]["bool"]["must"].append({
+            "terms": {
+                "issueType.keyword": list(issue_types)
+            }
+        })
+    
+    return query
+
+def partition_aggregations(query, issue_types):
+    """Nest the query aggregations under a per-issue-type filters aggregation
+    
+    Lets one search over several issue types return the same aggregations
+    each type would get from its own query.
+    """
+    query["aggs"] = {
+        "per_issue_type": {
+            "filters": {
+                "filters": {
+                    issue_type: {"term": {"issueType.keyword": issue_type}}
+                    for issue_type in issue_types
+                }
+            },
+            "aggs": query["aggs"]
+        }
     }
+    return query
+
+def summarize_aggregations(result):
+    """Extract app code, issue type and priority summaries from the aggregations"""
+    app_codes_with_issues = []
+    all_issue_types = set()
+    priority_distribution = {}
+    
+    if "aggregations" in result:
+        if "all_issue_types" in result["aggregations"]:
+            for bucket in result["aggregations"]["all_issue_types"]["buckets"]:
+                all_issue_types.add(bucket["key"])
+        
+        if "priority_distribution" in result["aggregations"]:
+            for bucket in result["aggregations"]["priority_distribution"]["buckets"]:
+                priority_distribution[bucket["key"]] = bucket["doc_count"]
+        
+        if "by_app_code" in result["aggregations"]:
+            for app_bucket in result["aggregations"]["by_app_code"]["buckets"]:
+                if app_bucket["doc_count"] > 0:
+                    app_code = app_bucket["key"]
+                    app_issue_types = []
+                    app_priorities = []
+                    
+                    if "issue_types" in app_bucket:
+                        for type_bucket in app_bucket["issue_types"]["buckets"]:
+                            app_issue_types.append(type_bucket["key"])
+                    
+                    if "priorities" in app_bucket:
+                        for priority_bucket in app_bucket["priorities"]["buckets"]:
+                            app_priorities.append(f"{priority_bucket['key']}({priority_bucket['doc_count']})")
+                    
+                    app_codes_with_issues.append({
+                        "app_code": app_code,
+                        "issue_types": app_issue_types,
+                        "priorities": app_priorities,
+                        "count": app_bucket["doc_count"]
+                    })
+    
+    return app_codes_with_issues, all_issue_types, priority_distribution
+
+def print_fetch_summary(result, output_file, total, retrieved, sample_hit):
+    """Print the summary lines shown in the Ansible fetch output"""
+    app_codes_with_issues, all_issue_types, priority_distribution = summarize_aggregations(result)
+    
+    print(f"Query results saved to {output_file}")
+    print(f"PRIORITY FILTER: Only fetching P1 and P2 priority issues")
+    print(f"Found {len(app_codes_with_issues)} app codes with P1/P2 issues")
+    print(f"Total issue types found: {len(all_issue_types)}")
+    print(f"Issue types: {', '.join(sorted(all_issue_types))}")
+    
+    if priority_distribution:
+        print(f"Priority distribution: {priority_distribution}")
+    
+    # Print sample of actual documents for debugging
+    print(f"Total P1/P2 documents: {total}")
+    print(f"Retrieved {retrieved} documents")
+    
+    if sample_hit:
+        print("Sample document structure:")
+        sample_source = sample_hit.get("_source", {})
+        print(f"Available fields: {list(sample_source.keys())}")
+    else:
+        print("No documents returned, but continuing with empty result set")
+
+def parse_response(response):
+    """Parse an Elasticsearch response, raising RequestError on invalid JSON or a non-200 status
     
+    TransientError is raised for the failures worth retrying: 429 and 5xx
+    statuses, and a 200 response whose JSON was cut short.
+    """
     try:
-        response = requests.post(
-            search_url,
-            headers=headers,
-            json=query,
-            auth=auth,
-            verify=False
+        with metrics.timer("parse"):
+            result = response.json()
+    except ValueError as json_error:
+        print(f"ERROR: Invalid JSON response from Elasticsearch: {json_error}")
+        print(f"Response text: {response.text[:500]}...")
+        error = TransientError if response.status_code == 200 or response.status_code in RETRY_STATUSES else RequestError
+        raise error(f"Invalid JSON response: {json_error}", response.status_code)
+    
+    if response.status_code != 200:
+        error = result.get("error") if isinstance(result, dict) else None
+        error_type = error.get("type") if isinstance(error, dict) else None
+        message = f"HTTP {response.status_code}: {result}"
+        if response.status_code in RETRY_STATUSES:
+            raise TransientError(message, response.status_code, error_type,
+                                 parse_retry_after(response.headers.get("Retry-After")))
+        raise RequestError(message, response.status_code, error_type)
+    
+    return result
+
+def with_retries(description, send):
+    """Call send() and return its parsed response, retrying transient failures
+    
+    Timeouts, dropped connections, 429 and 5xx statuses and truncated
+    responses are retried up to ES_MAX_RETRIES times with retry_delay()
+    between attempts. A retried page request carries the same search_after
+    cursor, so a walk resumes from its last page rather than starting over.
+    Every attempt goes through the circuit breaker.
+    """
+    max_retries = int(get_env_var("ES_MAX_RETRIES", "5"))
+    breaker = get_circuit_breaker()
+    attempt = 0
+    
+    while True:
+        attempt += 1
+        breaker.before_request()
+        try:
+            result = send()
+        except (TransientError, requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            breaker.record_failure()
+            if attempt > max_retries:
+                raise
+            delay = retry_delay(attempt, getattr(e, "retry_after", None))
+            metrics.count("retries")
+            print(f"Warning: {description} failed ({str(e)[:200]}), "
+                  f"retry {attempt} of {max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        except RequestError:
+            # The cluster answered; the request itself is wrong
+            breaker.record_success()
+            raise
+        
+        breaker.record_success()
+        return result
+
+def request_json(method, url, auth, **kwargs):
+    """Send a request over the requests session and return the parsed response, retrying transient failures"""
+    def send():
+        response = get_session().request(method, url, auth=auth, verify=False, timeout=get_timeout(), **kwargs)
+        return parse_response(response)
+    
+    return with_retries(f"{method} {urlsplit(url).path}", send)
+
+def post_json(url, body, auth, params=None):
+    """POST a JSON body to Elasticsearch and return the parsed response"""
+    return request_json(
+        "POST",
+        url,
+        auth,
+        headers={"Content-Type": "application/json"},
+        json=body,
+        params=params
+    )
+
+_fetch_backend = None
+
+def get_fetch_backend():
+    """Get the HTTP backend from FETCH_BACKEND: requests, or elasticsearch for the official client"""
+    global _fetch_backend
+    if _fetch_backend is None:
+        _fetch_backend = get_env_var("FETCH_BACKEND", "requests").lower()
+        if _fetch_backend not in ("requests", "elasticsearch"):
+            print(f"WARNING: Unknown FETCH_BACKEND {_fetch_backend}, falling back to requests")
+            _fetch_backend = "requests"
+    return _fetch_backend
+
+_client = None
+
+def get_client(es_host, auth):
+    """Get the official Elasticsearch client shared by every request when FETCH_BACKEND=elasticsearch
+    
+    Its transport keeps a pool of FETCH_WORKERS connections per node and
+    gzip-compresses request and response bodies. With ES_SNIFF set it also
+    discovers the cluster's other nodes on start and whenever a node fails;
+    leave it off behind a proxy such as an ECE endpoint, whose nodes cannot
+    be reached directly. The transport does not retry: with_retries() does,
+    so both backends share the backoff and circuit breaker.
+    """
+    global _client
+    if _client is None:
+        if elasticsearch is None:
+            raise RequestError("FETCH_BACKEND=elasticsearch needs the elasticsearch package")
+        sniff = get_env_var("ES_SNIFF", "false").lower() in ("1", "true", "yes")
+        _client = elasticsearch.Elasticsearch(
+            es_host,
+            basic_auth=auth,
+            verify_certs=False,
+            ssl_show_warn=False,
+            http_compress=True,
+            connections_per_node=get_fetch_workers(),
+            request_timeout=get_timeout()[1],
+            max_retries=0,
+            retry_on_timeout=False,
+            sniff_on_start=sniff,
+            sniff_on_node_failure=sniff,
+            min_delay_between_sniffing=60
         )
+    return _client
+
+def close_connections():
+    """Close the shared session and client, so the next request builds them from the current settings"""
+    global _session, _client, _fetch_backend, _circuit_breaker
+    if _session is not None:
+        _session.close()
+    if _client is not None:
+        _client.close()
+    _session = _client = _fetch_backend = _circuit_breaker = None
+
+def start_run():
+    """Reset the per-run state of a fetch
+    
+    The metrics and partial outputs of a previous fetch in this process are
+    dropped. Its pooled connections are kept while CONNECTION_SETTINGS are
+    unchanged, so a long-running process such as pipeline_daemon.py fetches
+    over warm connections.
+    """
+    global _connection_settings
+    settings = {name: os.environ.get(name) for name in CONNECTION_SETTINGS}
+    if settings != _connection_settings:
+        close_connections()
+        _connection_settings = settings
+    metrics.reset()
+    partial_outputs.clear()
+    staging.close()
+
+def call_client(method, path, call):
+    """Make one official client call, logging it in metrics and raising the errors parse_response() raises"""
+    start = time.monotonic()
+    try:
+        response = call()
+    except elasticsearch.ApiError as e:
+        metrics.record_request(method, path, e.meta.status, time.monotonic() - start, None)
+        message = f"HTTP {e.meta.status}: {e.body}"
+        if e.meta.status in RETRY_STATUSES:
+            raise TransientError(message, e.meta.status, e.error,
+                                 parse_retry_after(e.meta.headers.get("Retry-After")))
+        raise RequestError(message, e.meta.status, e.error)
+    except (elastic_transport.ConnectionError, elastic_transport.ConnectionTimeout,
+            elastic_transport.SerializationError) as e:
+        metrics.record_request(method, path, None, time.monotonic() - start, 0, type(e).__name__)
+        raise TransientError(f"{type(e).__name__}: {e}")
+    
+    # The transport decompresses the body, so this is the compressed size when known
+    length = response.meta.headers.get("Content-Length")
+    metrics.record_request(method, path, response.meta.status, time.monotonic() - start,
+                           int(length) if length else None)
+    return response.body
+
+def client_request(es_host, auth, method, path, call):
+    """Make an official client call with the same retries as request_json()"""
+    client = get_client(es_host, auth)
+    return with_retries(f"{method} {path}", lambda: call_client(method, path, lambda: call(client)))
+
+def search(es_host, es_index, body, auth):
+    """Run one search on the index, or on the point-in-time in body when es_index is None"""
+    if get_fetch_backend() == "elasticsearch":
+        filter_path = search_params().get("filter_path")
+        return client_request(es_host, auth, "POST", f"/{es_index}/_search" if es_index else "/_search",
+                              lambda client: client.search(index=es_index, body=body, filter_path=filter_path))
+    url = f"{es_host}/{es_index}/_search" if es_index else f"{es_host}/_search"
+    return post_json(url, body, auth, params=search_params())
+
+def msearch(es_host, es_index, queries, auth):
+    """Run several searches in one _msearch round trip and return their responses
+    
+    Searches rejected with a retryable status, typically 429 under load, are
+    sent again in a smaller _msearch after retry_delay(), up to
+    ES_MAX_RETRIES times; their last response is returned either way.
+    """
+    max_retries = int(get_env_var("ES_MAX_RETRIES", "5"))
+    responses = [None] * len(queries)
+    pending = list(range(len(queries)))
+    attempt = 0
+    
+    while pending:
+        attempt += 1
+        if get_fetch_backend() == "elasticsearch":
+            searches = []
+            for position in pending:
+                searches.extend([{"index": es_index}, queries[position]])
+            filter_path = search_params("responses.").get("filter_path")
+            results = client_request(es_host, auth, "POST", "/_msearch",
+                                     lambda client: client.msearch(searches=searches, filter_path=filter_path))
+        else:
+            lines = []
+            for position in pending:
+                lines.append(json.dumps({"index": es_index}))
+                lines.append(json.dumps(queries[position]))
+            
+            results = request_json(
+                "POST",
+                f"{es_host}/_msearch",
+                auth,
+                headers={"Content-Type": "application/x-ndjson"},
+                data="\n".join(lines) + "\n",
+                params=search_params("responses.")
+            )
+        results = results["responses"]
+        
+        retry = []
+        for position, result in zip(pending, results):
+            responses[position] = result
+            if result.get("status", 200) in RETRY_STATUSES:
+                retry.append(position)
+        if not retry or attempt > max_retries:
+            break
         
-        # Parse response with error handling
+        delay = retry_delay(attempt)
+        metrics.count("retries", len(retry))
+        print(f"Warning: {len(retry)} of {len(pending)} searches rejected, "
+              f"retry {attempt} of {max_retries} in {delay:.1f}s")
+        time.sleep(delay)
+        pending = retry
+    
+    return responses
+
+def open_point_in_time(es_host, es_index, auth, keep_alive):
+    """Open a point-in-time on the index and return its id"""
+    if get_fetch_backend() == "elasticsearch":
+        result = client_request(es_host, auth, "POST", f"/{es_index}/_pit",
+                                lambda client: client.open_point_in_time(index=es_index, keep_alive=keep_alive))
+    else:
+        result = post_json(f"{es_host}/{es_index}/_pit", None, auth, params={"keep_alive": keep_alive})
+    return result["id"]
+
+def close_point_in_time(es_host, pit_id, auth):
+    """Close a point-in-time, ignoring failures since it expires on its own"""
+    try:
+        if get_fetch_backend() == "elasticsearch":
+            client = get_client(es_host, auth)
+            call_client("DELETE", "/_pit", lambda: client.close_point_in_time(id=pit_id))
+            return
+        get_session().delete(
+            f"{es_host}/_pit",
+            headers={"Content-Type": "application/json"},
+            json={"id": pit_id},
+            auth=auth,
+            verify=False,
+            timeout=get_timeout()
+        )
+    except Exception as e:
+        print(f"Warning: Failed to close point-in-time: {e}")
+
+def iter_search_pages(es_host, es_index, query, auth, page_size=1000, max_pages=0, keep_alive="1m",
+                      pit_id=None, slice_id=0, slices=1, sort=None):
+    """Walk the full result set with a point-in-time and search_after
+    
+    Yields (page_number, response, elapsed_seconds) for each non-empty page.
+    Aggregations are only requested on the first page. Pages are sorted on
+    _shard_doc, the cheapest stable sort available within a point-in-time,
+    unless sort is given; it must end with _shard_doc as a tiebreaker.
+    When pit_id is given the caller owns the point-in-time; with slices > 1
+    only slice slice_id of it is walked.
+    """
+    owns_pit = pit_id is None
+    if owns_pit:
+        pit_id = open_point_in_time(es_host, es_index, auth, keep_alive)
+    search_after = None
+    page_number = 0
+    
+    try:
+        while not max_pages or page_number < max_pages:
+            body = {
+                "query": query["query"],
+                "size": page_size,
+                "sort": sort or [{"_shard_doc": "asc"}],
+                "pit": {"id": pit_id, "keep_alive": keep_alive},
+                "track_total_hits": True
+            }
+            if "_source" in query:
+                body["_source"] = query["_source"]
+            if slices > 1:
+                body["slice"] = {"id": slice_id, "max": slices}
+            if page_number == 0 and "aggs" in query:
+                body["aggs"] = query["aggs"]
+            if search_after is not None:
+                body["search_after"] = search_after
+            
+            page_start = time.monotonic()
+            result = search(es_host, None, body, auth)
+            elapsed = time.monotonic() - page_start
+            
+            # The PIT id may change between requests; always use the latest one
+            pit_id = result.get("pit_id", pit_id)
+            hits = result.get("hits", {}).get("hits", [])
+            if not hits and page_number > 0:
+                break
+            
+            # Read the cursor before yielding; consumers may drop the sort values
+            last_page = len(hits) < page_size
+            if hits:
+                search_after = hits[-1]["sort"]
+            
+            page_number += 1
+            yield page_number, result, elapsed
+            
+            if last_page:
+                break
+    finally:
+        if owns_pit:
+            close_point_in_time(es_host, pit_id, auth)
+
+def get_raw_format():
+    """Get the raw output format from RAW_FORMAT: json or ndjson, with an optional .gz suffix"""
+    raw_format = get_env_var("RAW_FORMAT", "json").lower()
+    if raw_format not in ("json", "json.gz", "ndjson", "ndjson.gz"):
+        print(f"WARNING: Unknown RAW_FORMAT {raw_format}, falling back to json")
+        raw_format = "json"
+    return raw_format
+
+def open_output(output_file, raw_format):
+    """Open a raw output file for writing text, gzip-compressed for .gz formats"""
+    if raw_format.endswith(".gz"):
+        return gzip.open(output_file, 'wt')
+    return open(output_file, 'w')
+
+class SnapshotStaging:
+    """Stage the hits of a full fetch in the SNAPSHOT_DB store as they are written
+    
+    Hits are buffered and staged in batches of batch_size per output file.
+    update_snapshot_store() loads the staged hits of the complete output
+    files into the store, so the files are never read back.
+    """
+    
+    batch_size = 1000
+    
+    def __init__(self):
+        self.store = None
+        self.error = None
+        self.pending = {}
+        self.lock = threading.Lock()
+    
+    def start(self, snapshot_db):
+        """Open the store and stage every hit written from now on"""
+        self.close()
         try:
-            result = response.json()
-        except ValueError as json_error:
-            print(f"ERROR: Invalid JSON response from Elasticsearch: {json_error}")
-            print(f"Response text: {response.text[:500]}...")
-            raise Exception(f"Invalid JSON response: {json_error}")
-        
-        if response.status_code == 200:
-            app_codes_with_issues = []
-            all_issue_types = set()
-            priority_distribution = {}
+            self.store = SnapshotStore(snapshot_db, shared=True)
+        except Exception as e:
+            self.error = f"Failed to open snapshot store {snapshot_db}: {str(e)}"
+            print(f"WARNING: {self.error}")
+    
+    def open(self, output_file):
+        """Drop the hits staged for an output file that is being written again"""
+        if self.store is None:
+            return
+        with self.lock:
+            self.pending.pop(output_file, None)
+            self.store.discard_staged(output_file)
+    
+    def add(self, output_file, hit):
+        """Stage one hit written to an output file"""
+        if self.store is None:
+            return
+        with self.lock:
+            hits = self.pending.setdefault(output_file, [])
+            hits.append(hit)
+            if len(hits) >= self.batch_size:
+                self.flush(output_file)
+    
+    def flush(self, output_file):
+        """Stage the buffered hits of an output file; the caller holds the lock"""
+        with metrics.timer("snapshot_store"):
+            self.store.stage(output_file, self.pending.pop(output_file))
+    
+    def finish(self):
+        """Stage the buffered hits and hand over the store, which the caller closes"""
+        with self.lock:
+            if self.store is None:
+                raise RuntimeError(self.error or "No fetched hits were staged")
+            for output_file in list(self.pending):
+                self.flush(output_file)
+            store, self.store = self.store, None
+            return store
+    
+    def close(self):
+        """Stop staging, dropping the staged hits"""
+        with self.lock:
+            if self.store is not None:
+                self.store.close()
+            self.store = self.error = None
+            self.pending.clear()
+
+# Hits of the current full fetch, staged for the snapshot store
+staging = SnapshotStaging()
+
+class RawResultWriter:
+    """Stream hits into a raw result file shaped like a single _search response"""
+    
+    def __init__(self, output_file, total, raw_format="json", **header):
+        staging.open(output_file)
+        self.output_file = output_file
+        self.documents = 0
+        self.sample_hit = None
+        self.f = open_output(output_file, raw_format)
+        self.f.write('{')
+        for key, value in header.items():
+            self.f.write(f'"{key}": ')
+            json.dump(value, self.f)
+            self.f.write(', ')
+        self.f.write('"hits": {"total": ')
+        json.dump(total, self.f)
+        self.f.write(', "hits": [')
+    
+    def write_hit(self, hit):
+        """Append one hit to the hits array"""
+        self.f.write(",\n" if self.documents else "\n")
+        json.dump(hit, self.f)
+        staging.add(self.output_file, hit)
+        self.documents += 1
+        if self.sample_hit is None:
+            self.sample_hit = hit
+    
+    def close(self, **sections):
+        """Close the hits array, append the remaining top-level sections and close the file"""
+        self.f.write('\n]}')
+        for key, value in sections.items():
+            self.f.write(f', "{key}": ')
+            json.dump(value, self.f)
+        self.f.write('}\n')
+        self.f.close()
+        metrics.count("documents", self.documents)
+        metrics.record_output(self.output_file)
+
+class NdjsonResultWriter(RawResultWriter):
+    """Stream hits into an NDJSON raw result file, one hit per line
+    
+    The first line is a {"_header": {...}} record carrying the total and the
+    header sections; sections passed to close() go in a final
+    {"_trailer": {...}} record.
+    """
+    
+    def __init__(self, output_file, total, raw_format="ndjson", **header):
+        staging.open(output_file)
+        self.output_file = output_file
+        self.documents = 0
+        self.sample_hit = None
+        self.f = open_output(output_file, raw_format)
+        header["total"] = total
+        json.dump({"_header": header}, self.f)
+        self.f.write('\n')
+    
+    def write_hit(self, hit):
+        """Append one hit as its own line"""
+        json.dump(hit, self.f)
+        self.f.write('\n')
+        staging.add(self.output_file, hit)
+        self.documents += 1
+        if self.sample_hit is None:
+            self.sample_hit = hit
+    
+    def close(self, **sections):
+        """Write the trailer record if there is one and close the file"""
+        if sections:
+            json.dump({"_trailer": sections}, self.f)
+            self.f.write('\n')
+        self.f.close()
+        metrics.count("documents", self.documents)
+        metrics.record_output(self.output_file)
+
+def open_raw_writer(output_file, total, **header):
+    """Open a streaming writer for the configured RAW_FORMAT"""
+    raw_format = get_raw_format()
+    if raw_format.startswith("ndjson"):
+        return NdjsonResultWriter(output_file, total, raw_format, **header)
+    return RawResultWriter(output_file, total, raw_format, **header)
+
+def write_result(result, output_file, start_date, end_date):
+    """Save a complete _search response as a raw result file"""
+    hits = result.get("hits", {}).get("hits", [])
+    total = result.get("hits", {}).get("total", {"value": 0})
+    
+    writer = open_raw_writer(
+        output_file, total,
+        aggregations=result.get("aggregations", {}),
+        date_range={"start_date": start_date, "end_date": end_date}
+    )
+    for hit in hits:
+        writer.write_hit(hit)
+    writer.close()
+    
+    print_fetch_summary(result, output_file, total.get("value", 0), len(hits), hits[0] if hits else None)
+
+# Partial markers of the output files written this run without all their
+# documents, by output file
+partial_outputs = {}
+
+def partial_marker(issue_type, error, documents=0, expected=None):
+    """Build the "partial" section of a raw result file that is missing documents
+    
+    process_data.py and combine_reports.py carry it into their reports, so
+    a failed fetch is reported as incomplete data rather than as no issues.
+    """
+    return {
+        "issue_type": issue_type,
+        "error": str(error),
+        "documents": documents,
+        "expected": expected,
+        "fetched_at": datetime.now().isoformat()
+    }
+
+def close_partial(writer, issue_type, error, expected=None, **sections):
+    """Close a raw writer whose fetch failed part way, keeping its hits and marking the file partial"""
+    marker = partial_marker(issue_type, error, writer.documents, expected)
+    writer.close(partial=marker, **sections)
+    partial_outputs[writer.output_file] = marker
+    print(f"WARNING: {writer.output_file} holds {writer.documents} of "
+          f"{expected if expected is not None else 'unknown'} documents: {error}")
+
+def write_empty_result(output_file, error, start_date, end_date, issue_type=None):
+    """Save an empty raw result file recording why no data was fetched"""
+    marker = partial_marker(issue_type, error)
+    writer = open_raw_writer(
+        output_file, {"value": 0},
+        aggregations={},
+        error=error,
+        partial=marker,
+        date_range={"start_date": start_date, "end_date": end_date}
+    )
+    writer.close()
+    partial_outputs[output_file] = marker
+
+def fetch_paginated(es_host, es_index, query, auth, output_files, start_date, end_date):
+    """Fetch every matching document page by page and stream it to the output files
+    
+    The output files are written in the configured RAW_FORMAT as each page
+    arrives, so only one page of hits is held in memory at a time. When
+    output_files is keyed on issue type, a single point-in-time walk is
+    split into one file per issue type; the query must then carry the
+    per_issue_type aggregation from partition_aggregations(). If a page
+    still fails after its retries, the files keep the pages already fetched
+    and are marked partial. Returns the keys of the partial files.
+    """
+    page_size = int(get_env_var("ES_PAGE_SIZE", "1000"))
+    max_pages = int(get_env_var("ES_MAX_PAGES", "0"))
+    keep_alive = get_env_var("ES_PIT_KEEP_ALIVE", "1m")
+    by_issue_type = None not in output_files
+    
+    print(f"PAGINATED FETCH: page size {page_size}, page cap {max_pages or 'none'}")
+    
+    writers = {}
+    aggregations = {}
+    totals = {}
+    documents = 0
+    page_timings = []
+    error = None
+    fetch_start = time.monotonic()
+    
+    try:
+        for page_number, result, elapsed in iter_search_pages(
+                es_host, es_index, query, auth, page_size, max_pages, keep_alive):
+            hits = result.get("hits", {}).get("hits", [])
             
-            if "aggregations" in result:
-                if "all_issue_types" in result["aggregations"]:
-                    for bucket in result["aggregations"]["all_issue_types"]["buckets"]:
-                        all_issue_types.add(bucket["key"])
-                
-                if "priority_distribution" in result["aggregations"]:
-                    for bucket in result["aggregations"]["priority_distribution"]["buckets"]:
-                        priority_distribution[bucket["key"]] = bucket["doc_count"]
+            if page_number == 1:
+                if by_issue_type:
+                    buckets = result.get("aggregations", {}).get("per_issue_type", {}).get("buckets", {})
+                    for issue_type in output_files:
+                        bucket = dict(buckets.get(issue_type, {}))
+                        totals[issue_type] = {"value": bucket.pop("doc_count", 0), "relation": "eq"}
+                        aggregations[issue_type] = bucket
+                else:
+                    totals[None] = result.get("hits", {}).get("total", {"value": 0})
+                    aggregations[None] = result.get("aggregations", {})
                 
-                if "by_app_code" in result["aggregations"]:
-                    for app_bucket in result["aggregations"]["by_app_code"]["buckets"]:
-                        if app_bucket["doc_count"] > 0:
-                            app_code = app_bucket["key"]
-                            app_issue_types = []
-                            app_priorities = []
-                            
-                            if "issue_types" in app_bucket:
-                                for type_bucket in app_bucket["issue_types"]["buckets"]:
-                                    app_issue_types.append(type_bucket["key"])
-                            
-                            if "priorities" in app_bucket:
-                                for priority_bucket in app_bucket["priorities"]["buckets"]:
-                                    app_priorities.append(f"{priority_bucket['key']}({priority_bucket['doc_count']})")
-                            
-                            app_codes_with_issues.append({
-                                "app_code": app_code,
-                                "issue_types": app_issue_types,
-                                "priorities": app_priorities,
-                                "count": app_bucket["doc_count"]
-                            })
+                for key, output_file in output_files.items():
+                    writers[key] = open_raw_writer(
+                        output_file, totals[key],
+                        aggregations=aggregations[key],
+                        date_range={"start_date": start_date, "end_date": end_date}
+                    )
             
-            output_file = get_env_var("OUTPUT_FILE", "")
-            if output_file:
-                result["date_range"] = {
-                    "start_date": start_date,
-                    "end_date": end_date
-                }
-                
-                with open(output_file, 'w') as f:
-                    json.dump(result, f, indent=2)
-                print(f"Query results saved to {output_file}")
-                print(f"PRIORITY FILTER: Only fetching P1 and P2 priority issues")
-                print(f"Found {len(app_codes_with_issues)} app codes with P1/P2 issues")
-                print(f"Total issue types found: {len(all_issue_types)}")
-                print(f"Issue types: {', '.join(sorted(all_issue_types))}")
-                
-                if priority_distribution:
-                    print(f"Priority distribution: {priority_distribution}")
-                
-                # Print sample of actual documents for debugging
+            for hit in hits:
+                # Drop the search_after sort values; they are only needed to page
+                hit.pop("sort", None)
+                key = hit.get("_source", {}).get("issueType") if by_issue_type else None
+                if key in writers:
+                    writers[key].write_hit(hit)
+                    documents += 1
+            
+            page_timings.append(round(elapsed, 3))
+            print(f"Page {page_number}: {len(hits)} documents in {elapsed:.2f}s")
+    except Exception as e:
+        if not writers:
+            raise
+        error = str(e)
+        print(f"ERROR: Fetch failed after page {len(page_timings)}: {error}")
+    
+    fetch_stats = {
+        "mode": "paginated",
+        "page_size": page_size,
+        "max_pages": max_pages,
+        "pages": len(page_timings),
+        "documents": documents,
+        "page_seconds": page_timings,
+        "total_seconds": round(time.monotonic() - fetch_start, 3)
+    }
+    
+    for key, writer in writers.items():
+        if error is None:
+            writer.close(fetch_stats=fetch_stats)
+        else:
+            close_partial(writer, key, error, totals[key].get("value", 0), fetch_stats=fetch_stats)
+        if key is not None:
+            print(f"Issue type: {key}")
+        print_fetch_summary({"aggregations": aggregations[key]}, writer.output_file,
+                            totals[key].get("value", 0), writer.documents, writer.sample_hit)
+    
+    print(f"Fetched {documents} documents in {fetch_stats['pages']} pages "
+          f"({fetch_stats['total_seconds']:.2f}s total)")
+    total = sum(total.get("value", 0) for total in totals.values())
+    if max_pages and documents < total and error is None:
+        print(f"WARNING: Page cap of {max_pages} reached, {total - documents} documents not fetched")
+    return list(writers) if error is not None else []
+
+def fetch_multi_type(es_host, es_index, issue_types, auth, output_files, start_date, end_date):
+    """Fetch each issue type with its own filtered search in a single _msearch round trip
+    
+    Returns the issue types Elasticsearch returned an error for.
+    """
+    queries = [build_query([issue_type]) for issue_type in issue_types]
+    responses = msearch(es_host, es_index, queries, auth)
+    failed = []
+    
+    for issue_type, result in zip(issue_types, responses):
+        output_file = output_files[issue_type]
+        print(f"Issue type: {issue_type}")
+        if "error" in result or result.get("status", 200) != 200:
+            print(f"ERROR: Elasticsearch returned an error for {issue_type}: {result.get('error')}")
+            write_empty_result(output_file, f"HTTP {result.get('status')}: {result.get('error')}",
+                               start_date, end_date, issue_type)
+            print(f"Created empty result file at {output_file} due to HTTP error")
+            failed.append(issue_type)
+        else:
+            write_result(result, output_file, start_date, end_date)
+    
+    return failed
+
+def open_concurrent_fetch(es_host, es_index, auth, issue_type, output_file, keep_alive, start_date, end_date):
+    """Open the point-in-time and raw writer for one concurrently fetched output file
+    
+    A size-0 search on the new point-in-time gets the total and aggregations
+    for the file header before any slice starts writing hits.
+    """
+    query = build_query([issue_type] if issue_type else None)
+    pit_id = open_point_in_time(es_host, es_index, auth, keep_alive)
+    try:
+        summary = search(es_host, None, {
+            "query": query["query"],
+            "size": 0,
+            "aggs": query.pop("aggs"),
+            "pit": {"id": pit_id, "keep_alive": keep_alive},
+            "track_total_hits": True
+        }, auth)
+        total = summary.get("hits", {}).get("total", {"value": 0})
+        aggregations = summary.get("aggregations", {})
+        writer = open_raw_writer(
+            output_file, total,
+            aggregations=aggregations,
+            date_range={"start_date": start_date, "end_date": end_date}
+        )
+    except Exception:
+        close_point_in_time(es_host, pit_id, auth)
+        raise
+    
+    return {
+        "query": query,
+        "pit_id": summary.get("pit_id", pit_id),
+        "total": total,
+        "aggregations": aggregations,
+        "writer": writer
+    }
+
+def fetch_slice(es_host, es_index, auth, fetch, slice_id, slices, page_size, max_pages, keep_alive,
+                start_date, end_date):
+    """Stream one slice of a concurrent fetch into its raw writer
+    
+    The first slice of an output file to start opens its point-in-time and
+    raw writer. Its other slices are queued right behind it, so the
+    point-in-time is searched at least once per page request from opening
+    until its last slice ends, and never sits idle in the queue long enough
+    for ES_PIT_KEEP_ALIVE to expire it.
+    """
+    with fetch["lock"]:
+        if fetch["error"] is None and fetch["writer"] is None:
+            try:
+                fetch.update(open_concurrent_fetch(es_host, es_index, auth, fetch["key"], fetch["output_file"],
+                                                   keep_alive, start_date, end_date))
+            except Exception as e:
+                fetch["error"] = e
+        if fetch["error"] is not None:
+            raise fetch["error"]
+    
+    for page_number, result, elapsed in iter_search_pages(
+            es_host, es_index, fetch["query"], auth, page_size, max_pages, keep_alive,
+            pit_id=fetch["pit_id"], slice_id=slice_id, slices=slices):
+        hits = result.get("hits", {}).get("hits", [])
+        with fetch["lock"]:
+            for hit in hits:
+                # Drop the search_after sort values; they are only needed to page
+                hit.pop("sort", None)
+                fetch["writer"].write_hit(hit)
+            fetch["page_seconds"].append(round(elapsed, 3))
+
+def fetch_concurrent(es_host, es_index, auth, output_files, start_date, end_date):
+    """Fetch every output file at once over the shared HTTP session
+    
+    Each issue type is walked with its own point-in-time, split into
+    FETCH_SLICES sliced searches, and at most FETCH_WORKERS requests run at a
+    time, so the fetch takes about as long as the slowest walk instead of the
+    sum of all of them. A point-in-time is only opened once a worker starts
+    on its issue type, however many slices are queued ahead of it. Returns
+    the issue types that failed; their output files keep the pages fetched
+    before the failure and are marked partial.
+    """
+    workers = get_fetch_workers()
+    slices = max(1, int(get_env_var("FETCH_SLICES", "1")))
+    page_size = int(get_env_var("ES_PAGE_SIZE", "1000"))
+    max_pages = int(get_env_var("ES_MAX_PAGES", "0"))
+    keep_alive = get_env_var("ES_PIT_KEEP_ALIVE", "1m")
+    
+    print(f"CONCURRENT FETCH: {len(output_files)} queries, {workers} workers, {slices} slice(s) per query, "
+          f"page size {page_size}, page cap {max_pages or 'none'}")
+    
+    fetches = {
+        key: {"key": key, "output_file": output_file, "writer": None, "error": None,
+              "lock": threading.Lock(), "page_seconds": []}
+        for key, output_file in output_files.items()
+    }
+    failed = {}
+    fetch_start = time.monotonic()
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Slices of one output file are queued together; the first to start opens the point-in-time
+        walking = {
+            executor.submit(fetch_slice, es_host, es_index, auth, fetch, slice_id, slices, page_size,
+                            max_pages, keep_alive, start_date, end_date): key
+            for key, fetch in fetches.items()
+            for slice_id in range(slices)
+        }
+        
+        for future in as_completed(walking):
+            try:
+                future.result()
+            except Exception as e:
+                failed.setdefault(walking[future], str(e))
+        
+        list(executor.map(lambda fetch: close_point_in_time(es_host, fetch["pit_id"], auth),
+                          [fetch for fetch in fetches.values() if fetch["writer"] is not None]))
+    
+    total_seconds = round(time.monotonic() - fetch_start, 3)
+    documents = 0
+    request_seconds = 0
+    
+    for key, output_file in output_files.items():
+        if key is not None:
+            print(f"Issue type: {key}")
+        
+        fetch = fetches[key]
+        if key in failed:
+            print(f"ERROR: Failed to fetch {output_file}: {failed[key]}")
+            if fetch["writer"] is None:
+                write_empty_result(output_file, failed[key], start_date, end_date, key)
+                print(f"Created empty result file at {output_file} due to error")
+                continue
+        
+        writer = fetch["writer"]
+        total = fetch["total"].get("value", 0)
+        fetch_stats = {
+            "mode": "concurrent",
+            "workers": workers,
+            "slices": slices,
+            "page_size": page_size,
+            "max_pages": max_pages,
+            "pages": len(fetch["page_seconds"]),
+            "documents": writer.documents,
+            "page_seconds": fetch["page_seconds"],
+            "total_seconds": total_seconds
+        }
+        if key in failed:
+            close_partial(writer, key, failed[key], total, fetch_stats=fetch_stats)
+        else:
+            writer.close(fetch_stats=fetch_stats)
+        print_fetch_summary({"aggregations": fetch["aggregations"]}, output_file,
+                            total, writer.documents, writer.sample_hit)
+        
+        if max_pages and writer.documents < total and key not in failed:
+            print(f"WARNING: Page cap of {max_pages} reached, {total - writer.documents} documents not fetched")
+        documents += writer.documents
+        request_seconds += sum(fetch["page_seconds"])
+    
+    print(f"Fetched {documents} documents in {total_seconds:.2f}s "
+          f"({request_seconds:.2f}s of page requests across {workers} workers)")
+    return list(failed)
+
+def get_snapshot_db(output_files):
+    """Get the path of the snapshot store from SNAPSHOT_DB
+    
+    Defaults to compliance_snapshot.db in FETCH_STATE_DIR, or in the
+    directory of the output files.
+    """
+    snapshot_db = get_env_var("SNAPSHOT_DB", "")
+    if snapshot_db:
+        return snapshot_db
+    state_dir = get_env_var("FETCH_STATE_DIR", "")
+    if not state_dir:
+        state_dir = os.path.dirname(next(iter(output_files.values()))) or "."
+    os.makedirs(state_dir, exist_ok=True)
+    return os.path.join(state_dir, "compliance_snapshot.db")
+
+def load_checkpoint(store, scope):
+    """Load the incremental fetch checkpoint, or None if there is none for this scope
+    
+    A checkpoint written for another index, issue type list or timestamp
+    field does not apply, so the next fetch starts over.
+    """
+    checkpoint = store.get_meta("checkpoint")
+    if checkpoint is None:
+        return None
+    if checkpoint.get("scope") != scope:
+        print(f"Checkpoint in {store.path} was written for {checkpoint.get('scope')}, starting over")
+        return None
+    return checkpoint
+
+def timestamp_key(value):
+    """Get a comparable (UTC datetime, nanoseconds) key of a timestamp sort value
+    
+    Sort values are strict_date_optional_time_nanos strings, whose fraction
+    may have any number of digits, or epoch milliseconds.
+    """
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000, timezone.utc).replace(microsecond=0), int(value % 1000) * 1000000
+    base, fraction, zone = re.match(r"(.*?)(?:\.(\d+))?(Z|[+-]\d{2}:?\d{2})?$", str(value)).groups()
+    moment = datetime.fromisoformat(base + ("+00:00" if zone in (None, "Z") else zone))
+    return moment.astimezone(timezone.utc), int((fraction or "0")[:9].ljust(9, "0"))
+
+def lag_window_start(since, lag_seconds):
+    """Get the lower bound of an incremental fetch: lag_seconds before the checkpoint, in whole seconds"""
+    if not lag_seconds:
+        return since
+    moment = timestamp_key(since)[0] - timedelta(seconds=lag_seconds)
+    return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def build_incremental_query(issue_types, timestamp_field, since=None):
+    """Build the incremental fetch body
+    
+    Without since it matches every P1/P2 document. With since it matches
+    every document changed at or after since whatever its priority, so
+    documents that left P1/P2 can be dropped from the snapshot. Documents
+    without timestamp_field are never matched: they cannot be ordered
+    against the checkpoint.
+    """
+    query = build_query(issue_types)
+    del query["aggs"]
+    must = query["query"]["bool"]["must"]
+    must.append({"exists": {"field": timestamp_field}})
+    if since is not None:
+        must[:] = [clause for clause in must if "priority.keyword" not in clause.get("terms", {})]
+        must.append({"range": {timestamp_field: {"gte": since}}})
+    if "_source" in query:
+        query["_source"]["includes"] = SOURCE_FIELDS + ["priority", timestamp_field]
+    return query
+
+def write_store_outputs(store, output_files, fetch_stats, start_date, end_date, error=None):
+    """Write the raw output files from the snapshot store, one issue type per file when keyed on it
+    
+    With an error the files are marked partial: the store missed some of
+    the changes since the last run.
+    """
+    for key, output_file in output_files.items():
+        total = store.count(key)
+        aggregations = store.aggregations(key)
+        writer = open_raw_writer(
+            output_file, {"value": total, "relation": "eq"},
+            aggregations=aggregations,
+            date_range={"start_date": start_date, "end_date": end_date}
+        )
+        for hit in store.iter_hits(key):
+            writer.write_hit(hit)
+        if error is None:
+            writer.close(fetch_stats=fetch_stats)
+        else:
+            close_partial(writer, key, error, fetch_stats=fetch_stats)
+        
+        if key is not None:
+            print(f"Issue type: {key}")
+        print_fetch_summary({"aggregations": aggregations}, output_file, total,
+                            writer.documents, writer.sample_hit)
+
+def load_snapshot_store(store, output_files, partial=None):
+    """Replace the stored documents of each fetched output file with the hits staged for it
+    
+    Used after a full fetch. The output files in partial, keyed like
+    output_files, were not fetched in full: their stored documents are kept
+    from the last complete fetch and flagged with the file's partial marker
+    in the store's "partial" metadata, keyed on issue type ("" without one).
+    The incremental checkpoint no longer describes the stored documents, so
+    it is dropped and the next incremental fetch starts over.
+    """
+    partial = partial or {}
+    markers = store.get_meta("partial", {})
+    for key, output_file in output_files.items():
+        if key in partial:
+            markers[key or ""] = dict(partial[key], stale=True)
+            continue
+        markers.pop(key or "", None)
+        store.clear(key)
+        store.load_staged(output_file)
+    store.discard_staged()
+    store.set_meta("partial", markers or None)
+    store.set_meta("checkpoint", None)
+    store.commit()
+    print(f"Snapshot store {store.path} updated: {store.count()} documents")
+
+def fetch_incremental(es_host, es_index, issue_types, auth, output_files, start_date, end_date):
+    """Fetch only the documents changed since the last run and merge them into the snapshot store
+    
+    The checkpoint is the highest ES_TIMESTAMP_FIELD value seen plus the ids
+    of the documents carrying it, the tiebreaker that lets the next run
+    resume at that timestamp without fetching them again. It is saved in the
+    same transaction as the documents. The field must change whenever a
+    document is created or updated; documents without it are only fetched
+    by full fetches. Deleted documents are only dropped by a full fetch;
+    set FETCH_FULL_REFRESH to force one.
+    Documents become searchable some time after their timestamp (ingest
+    lag, the index refresh interval), so each run also re-reads the
+    ES_INCREMENTAL_LAG seconds before the checkpoint. Re-read documents the
+    snapshot already holds with the same timestamp are skipped; the others
+    were indexed late and are merged. A document indexed later than that
+    is only picked up by a full fetch.
+    If a page still fails after its retries, the pages before it are saved
+    with a checkpoint at the last document they hold, so the next run
+    resumes there, and the output files are marked partial. Returns the
+    keys of the partial files.
+    """
+    timestamp_field = get_env_var("ES_TIMESTAMP_FIELD", "timestamp")
+    page_size = int(get_env_var("ES_PAGE_SIZE", "1000"))
+    keep_alive = get_env_var("ES_PIT_KEEP_ALIVE", "1m")
+    lag_seconds = int(get_env_var("ES_INCREMENTAL_LAG", "300"))
+    full_refresh = get_env_var("FETCH_FULL_REFRESH", "false").lower() in ("1", "true", "yes")
+    
+    store = SnapshotStore(get_snapshot_db(output_files))
+    try:
+        scope = {"index": es_index, "issue_types": sorted(issue_types), "timestamp_field": timestamp_field}
+        checkpoint = None if full_refresh else load_checkpoint(store, scope)
+        
+        if checkpoint is None:
+            since = None
+            seen_ids = set()
+            store.clear()
+            print("INCREMENTAL FETCH: no checkpoint, fetching every P1/P2 document")
+        else:
+            since = checkpoint["timestamp"]
+            seen_ids = set(checkpoint["ids"])
+            print(f"INCREMENTAL FETCH: {store.count()} documents in snapshot, fetching changes since {since} "
+                  f"and documents indexed late in the {lag_seconds}s before")
+        since_key = timestamp_key(since) if since is not None else None
+        
+        query = build_incremental_query(issue_types, timestamp_field,
+                                        lag_window_start(since, lag_seconds) if since is not None else None)
+        sort = [
+            {timestamp_field: {"order": "asc", "format": "strict_date_optional_time_nanos"}},
+            {"_shard_doc": "asc"}
+        ]
+        
+        high_water = since
+        high_water_ids = set(seen_ids)
+        changes = 0
+        removed = 0
+        late = 0
+        page_timings = []
+        error = None
+        fetch_start = time.monotonic()
+        
+        try:
+            for page_number, result, elapsed in iter_search_pages(
+                    es_host, es_index, query, auth, page_size, 0, keep_alive, sort=sort):
                 hits = result.get("hits", {}).get("hits", [])
-                total = result.get("hits", {}).get("total", {}).get("value", 0)
-                print(f"Total P1/P2 documents: {total}")
-                print(f"Retrieved {len(hits)} documents")
+                changed = []
+                for hit in hits:
+                    timestamp = hit.pop("sort")[0]
+                    key = timestamp_key(timestamp)
+                    source = hit.get("_source", {})
+                    wanted = source.get("priority") in ("P1", "P2") and \
+                        (not issue_types or source.get("issueType") in issue_types)
+                    if since_key is not None and key < since_key:
+                        # Re-read from the lag window: only documents indexed late are changes
+                        stored = store.get(hit["_id"])
+                        if stored is None and not wanted:
+                            continue
+                        if stored is not None and stored["_source"].get(timestamp_field) == source.get(timestamp_field):
+                            continue
+                        late += 1
+                    else:
+                        if key == since_key and hit["_id"] in seen_ids:
+                            continue
+                        
+                        # Hits arrive in timestamp order, so the last one holds the high-water mark
+                        if timestamp != high_water:
+                            high_water = timestamp
+                            high_water_ids = set()
+                        high_water_ids.add(hit["_id"])
+                    
+                    changes += 1
+                    if wanted:
+                        changed.append(hit)
+                    elif store.delete(hit["_id"]):
+                        removed += 1
+                store.upsert(changed)
                 
-                if hits:
-                    print("Sample document structure:")
-                    sample_source = hits[0].get("_source", {})
-                    print(f"Available fields: {list(sample_source.keys())}")
-                else:
-                    print("No documents returned, but continuing with empty result set")
+                page_timings.append(round(elapsed, 3))
+                print(f"Page {page_number}: {len(hits)} documents in {elapsed:.2f}s")
+        except Exception as e:
+            error = str(e)
+            print(f"ERROR: Fetch failed after page {len(page_timings)}, saving the changes fetched so far: {error}")
+        
+        if high_water is not None:
+            store.set_meta("checkpoint", {
+                "scope": scope,
+                "timestamp": high_water,
+                "ids": sorted(high_water_ids),
+                "updated_at": datetime.now().isoformat()
+            })
+        store.set_meta("partial", {key or "": partial_marker(key, error, store.count(key)) for key in output_files}
+                       if error is not None else None)
+        store.commit()
+        
+        fetch_stats = {
+            "mode": "incremental",
+            "since": since,
+            "checkpoint": high_water,
+            "changes": changes,
+            "removed": removed,
+            "late": late,
+            "lag_seconds": lag_seconds,
+            "documents": store.count(),
+            "pages": len(page_timings),
+            "page_seconds": page_timings,
+            "total_seconds": round(time.monotonic() - fetch_start, 3)
+        }
+        write_store_outputs(store, output_files, fetch_stats, start_date, end_date, error)
+    finally:
+        store.close()
+    
+    print(f"Fetched {changes} changed documents in {fetch_stats['pages']} pages "
+          f"({fetch_stats['total_seconds']:.2f}s), {removed} left P1/P2, "
+          f"{fetch_stats['documents']} documents in snapshot")
+    if late:
+        print(f"Warning: {late} document(s) were indexed after the checkpoint had passed their timestamp and "
+              f"were picked up from the {lag_seconds}s lag window; raise ES_INCREMENTAL_LAG if this recurs")
+    print(f"Checkpoint saved to {store.path}: {high_water}")
+    return list(output_files) if error is not None else []
+
+def build_composite_aggregation(size, after=None):
+    """Build the issue_buckets composite aggregation, resuming after a previous page's after_key"""
+    composite = {
+        "size": size,
+        "sources": [
+            {field: {"terms": {"field": f"{field}.keyword", "missing_bucket": True}}}
+            for field in COMPOSITE_FIELDS
+        ]
+    }
+    if after is not None:
+        composite["after"] = after
+    return {"issue_buckets": {"composite": composite}}
+
+def iter_issue_bucket_pages(es_host, es_index, query, auth, bucket_size=1000):
+    """Page through every issue bucket of the query with a composite aggregation
+    
+    Yields (page_number, response, elapsed_seconds) for each page of buckets.
+    The first page also carries the query's own aggregations.
+    """
+    after = None
+    page_number = 0
+    
+    while True:
+        aggs = build_composite_aggregation(bucket_size, after)
+        if page_number == 0 and "aggs" in query:
+            aggs.update(query["aggs"])
+        body = {
+            "query": query["query"],
+            "size": 0,
+            "track_total_hits": True,
+            "aggs": aggs
+        }
+        
+        page_start = time.monotonic()
+        result = search(es_host, es_index, body, auth)
+        elapsed = time.monotonic() - page_start
+        
+        composite = result.get("aggregations", {}).get("issue_buckets", {})
+        buckets = composite.get("buckets", [])
+        after = composite.get("after_key")
+        
+        page_number += 1
+        yield page_number, result, elapsed
+        
+        if len(buckets) < bucket_size or after is None:
+            break
+
+def high_severity_filter(buckets):
+    """Build a query clause matching the documents of the buckets that resolve to critical or high
+    
+    Built from the bucket keys actually seen, so the severity values and the
+    issue types whose missing severity is inferred as high are exact.
+    """
+    severities = set()
+    inferred_issue_types = set()
+    for bucket in buckets:
+        source = bucket_source(bucket["key"])
+        if resolve_severity(source) not in ("critical", "high"):
+            continue
+        severity = bucket["key"].get("severity")
+        if severity and severity != "null":
+            severities.add(severity)
         else:
-            print(f"ERROR: Elasticsearch returned status code {response.status_code}")
-            print(f"Response: {result}")
-            # Create empty result file for non-200 responses
-            output_file = get_env_var("OUTPUT_FILE", "")
-            if output_file:
-                empty_result = {
-                    "hits": {"hits": [], "total": {"value": 0}},
-                    "aggregations": {},
-                    "error": f"HTTP {response.status_code}: {result}",
-                    "date_range": {
-                        "start_date": start_date,
-                        "end_date": end_date
-                    }
+            inferred_issue_types.add(source.get("issueType"))
+    
+    clauses = []
+    if severities:
+        clauses.append({"terms": {"severity.keyword": sorted(severities)}})
+    if inferred_issue_types:
+        clauses.append({
+            "bool": {
+                "filter": [{"terms": {"issueType.keyword": sorted(inferred_issue_types)}}],
+                "should": [
+                    {"bool": {"must_not": {"exists": {"field": "severity.keyword"}}}},
+                    {"terms": {"severity.keyword": ["", "null"]}}
+                ],
+                "minimum_should_match": 1
+            }
+        })
+    if not clauses:
+        return None
+    return {"bool": {"should": clauses, "minimum_should_match": 1}}
+
+def fetch_aggregated(es_host, es_index, issue_types, auth, output_files, start_date, end_date):
+    """Build reports from server-side aggregations, fetching only high severity documents
+    
+    Issue counts per app code, issue type, severity and custodian come from
+    a composite aggregation paged ES_BUCKET_SIZE buckets at a time, and are
+    written to each output file as issue_buckets. The documents behind the
+    critical and high buckets are then walked with a point-in-time for the
+    report detail rows; no other document is transferred. If that walk
+    fails after its retries, the files keep the counts and the detail rows
+    fetched so far and are marked partial. Returns the keys of the partial
+    files.
+    """
+    bucket_size = int(get_env_var("ES_BUCKET_SIZE", "1000"))
+    page_size = int(get_env_var("ES_PAGE_SIZE", "1000"))
+    keep_alive = get_env_var("ES_PIT_KEEP_ALIVE", "1m")
+    by_issue_type = None not in output_files
+    
+    print(f"AGGREGATE FETCH: {bucket_size} buckets per page, high severity documents only")
+    
+    query = build_query(issue_types)
+    if by_issue_type:
+        partition_aggregations(query, issue_types)
+    
+    buckets = {key: [] for key in output_files}
+    aggregations = {}
+    bucket_pages = 0
+    fetch_start = time.monotonic()
+    
+    for page_number, result, elapsed in iter_issue_bucket_pages(es_host, es_index, query, auth, bucket_size):
+        result_aggregations = result.get("aggregations", {})
+        if page_number == 1:
+            if by_issue_type:
+                per_issue_type = result_aggregations.get("per_issue_type", {}).get("buckets", {})
+                for issue_type in output_files:
+                    aggregations[issue_type] = dict(per_issue_type.get(issue_type, {}))
+                    aggregations[issue_type].pop("doc_count", None)
+            else:
+                aggregations[None] = {
+                    name: aggregation for name, aggregation in result_aggregations.items()
+                    if name != "issue_buckets"
                 }
-                with open(output_file, 'w') as f:
-                    json.dump(empty_result, f, indent=2)
-                print(f"Created empty result file at {output_file} due to HTTP error")
         
+        page_buckets = result_aggregations.get("issue_buckets", {}).get("buckets", [])
+        for bucket in page_buckets:
+            key = bucket["key"].get("issueType") if by_issue_type else None
+            if key in buckets:
+                buckets[key].append(bucket)
+        bucket_pages = page_number
+        print(f"Bucket page {page_number}: {len(page_buckets)} buckets in {elapsed:.2f}s")
+    
+    writers = {}
+    for key, output_file in output_files.items():
+        total = sum(bucket["doc_count"] for bucket in buckets[key])
+        writers[key] = open_raw_writer(
+            output_file, {"value": total, "relation": "eq"},
+            aggregations=aggregations.get(key, {}),
+            issue_buckets=buckets[key],
+            date_range={"start_date": start_date, "end_date": end_date}
+        )
+    
+    detail_pages = 0
+    documents = 0
+    error = None
+    try:
+        detail_filter = high_severity_filter(
+            bucket for key_buckets in buckets.values() for bucket in key_buckets)
+        if detail_filter is not None:
+            detail_query = {key: value for key, value in query.items() if key != "aggs"}
+            detail_query["query"] = {"bool": {"must": query["query"]["bool"]["must"] + [detail_filter]}}
+            
+            for page_number, result, elapsed in iter_search_pages(
+                    es_host, es_index, detail_query, auth, page_size, 0, keep_alive):
+                hits = result.get("hits", {}).get("hits", [])
+                for hit in hits:
+                    hit.pop("sort", None)
+                    source = hit.get("_source", {})
+                    key = source.get("issueType") if by_issue_type else None
+                    if key in writers and resolve_severity(source) in ("critical", "high"):
+                        writers[key].write_hit(hit)
+                        documents += 1
+                detail_pages = page_number
+                print(f"Detail page {page_number}: {len(hits)} documents in {elapsed:.2f}s")
+    except Exception as e:
+        error = str(e)
+        print(f"ERROR: Detail fetch failed after page {detail_pages}: {error}")
+    
+    fetch_stats = {
+        "mode": "aggregate",
+        "bucket_size": bucket_size,
+        "bucket_pages": bucket_pages,
+        "buckets": sum(len(key_buckets) for key_buckets in buckets.values()),
+        "detail_pages": detail_pages,
+        "documents": documents,
+        "total_seconds": round(time.monotonic() - fetch_start, 3)
+    }
+    
+    for key, writer in writers.items():
+        total = sum(bucket["doc_count"] for bucket in buckets[key])
+        if error is None:
+            writer.close(fetch_stats=fetch_stats)
+        else:
+            close_partial(writer, key, error, fetch_stats=fetch_stats)
+        if key is not None:
+            print(f"Issue type: {key}")
+        print_fetch_summary({"aggregations": aggregations.get(key, {})}, writer.output_file,
+                            total, writer.documents, writer.sample_hit)
+    
+    print(f"Fetched {fetch_stats['buckets']} issue buckets in {bucket_pages} pages and "
+          f"{documents} high severity documents in {detail_pages} pages "
+          f"({fetch_stats['total_seconds']:.2f}s total)")
+    return list(writers) if error is not None else []
+
+def update_snapshot_store(output_files, failed=()):
+    """Load the hits staged for the successfully fetched output files into the SNAPSHOT_DB store, if one is set
+    
+    The stored documents of the failed keys are kept and flagged with the
+    partial marker of their output file. Returns False if the store could
+    not be updated.
+    """
+    snapshot_db = get_env_var("SNAPSHOT_DB", "")
+    if not snapshot_db or not output_files:
+        staging.close()
+        return True
+    partial = {
+        key: partial_outputs.get(output_file) or partial_marker(key, "Fetch failed")
+        for key, output_file in output_files.items() if key in failed
+    }
+    try:
+        with metrics.timer("snapshot_store"):
+            store = staging.finish()
+            try:
+                load_snapshot_store(store, output_files, partial)
+            finally:
+                store.close()
         return True
     except Exception as e:
-        print(f"ERROR: Failed to query Elasticsearch: {str(e)}")
+        print(f"ERROR: Failed to update snapshot store {snapshot_db}: {str(e)}")
+        return False
+    finally:
+        staging.close()
+
+def query_elasticsearch():
+    """Query Elasticsearch using environment variables for configuration
+    
+    PRIORITY FILTER: This query only fetches P1 and P2 priority issues.
+    All other priorities (P3, P4, etc.) will be excluded from results.
+    
+    Set FETCH_MODE=paginated to walk the whole result set with a
+    point-in-time and search_after instead of a single 1000-hit search, or
+    FETCH_MODE=concurrent to walk every issue type at once with
+    FETCH_WORKERS parallel requests and FETCH_SLICES slices per issue type.
+    FETCH_MODE=incremental only fetches documents changed since the
+    checkpoint kept in the snapshot store and merges them into it.
+    FETCH_MODE=aggregate counts issues in Elasticsearch and only fetches
+    the high severity documents.
+    Set ISSUE_TYPES to fetch several issue types in one pass, writing
+    OUTPUT_DIR/<issue type>_report_raw.<RAW_FORMAT> for each of them.
+    Only SOURCE_FIELDS are fetched unless ES_FULL_SOURCE is set.
+    RAW_FORMAT selects json or ndjson output, gzip-compressed with a .gz suffix.
+    With SNAPSHOT_DB set, the fetched documents also replace those of the
+    same issue types in that snapshot store; they are staged in it as each
+    page is written, see SnapshotStaging.
+    With METRICS_FILE set, the request timings, bytes received, parse time,
+    documents per second, peak RSS and output sizes are saved there as JSON.
+    FETCH_BACKEND=elasticsearch sends the requests through the official
+    client instead of requests; see get_client(). Either way requests are
+    retried with backoff and guarded by a circuit breaker; see
+    with_retries(). Output files that could not be fetched in full are still
+    written, with a "partial" section saying why, and listed in
+    partial_outputs.
+    """
+    
+    # Get environment variables
+    es_host = get_env_var("ES_HOST", required=True)
+    es_index = get_env_var("ES_INDEX", required=True)
+    fetch_mode = get_env_var("FETCH_MODE", "single").lower()
+    issue_types = get_issue_types()
+    output_files = get_output_files(issue_types)
+    metrics.info.update(fetch_mode=fetch_mode, fetch_backend=get_fetch_backend(), issue_types=issue_types,
+                        raw_format=get_raw_format())
+    
+    # date range for last week
+    start_date, end_date = get_date_range()
+    print(f"Fetching P1/P2 priority data from {start_date} to {end_date}")
+    if issue_types:
+        print(f"Issue types to fetch: {', '.join(issue_types)}")
+    
+    # Get authentication if provided
+    username = get_env_var("ES_USERNAME", "")
+    password = get_env_var("ES_PASSWORD", "")
+    auth = None
+    if username and password:
+        auth = (username, password)
+    
+    # Prepare the query - simplified to match actual data structure
+    query = build_query(issue_types)
+    
+    # Incremental fetches merge into the store themselves and aggregated
+    # files are never loaded into it
+    snapshot_db = get_env_var("SNAPSHOT_DB", "")
+    if snapshot_db and output_files and fetch_mode not in ("incremental", "aggregate"):
+        staging.start(snapshot_db)
+    
+    try:
+        if fetch_mode == "concurrent":
+            if not output_files:
+                print("ERROR: OUTPUT_FILE or ISSUE_TYPES is required for concurrent fetch mode")
+                return False
+            failed = fetch_concurrent(es_host, es_index, auth, output_files, start_date, end_date)
+            return update_snapshot_store(output_files, failed) and not failed
+        
+        if fetch_mode == "incremental":
+            if not output_files:
+                print("ERROR: OUTPUT_FILE or ISSUE_TYPES is required for incremental fetch mode")
+                return False
+            # Incremental fetches merge into the snapshot store themselves
+            failed = fetch_incremental(es_host, es_index, issue_types, auth, output_files, start_date, end_date)
+            return not failed
+        
+        if fetch_mode == "aggregate":
+            if not output_files:
+                print("ERROR: OUTPUT_FILE or ISSUE_TYPES is required for aggregate fetch mode")
+                return False
+            # Aggregated files only hold high severity documents, so they are
+            # not loaded into the snapshot store
+            failed = fetch_aggregated(es_host, es_index, issue_types, auth, output_files, start_date, end_date)
+            return not failed
         
-        # Still create an empty output file to avoid failing the pipeline
+        if fetch_mode == "paginated":
+            if not output_files:
+                print("ERROR: OUTPUT_FILE or ISSUE_TYPES is required for paginated fetch mode")
+                return False
+            if issue_types:
+                partition_aggregations(query, issue_types)
+            failed = fetch_paginated(es_host, es_index, query, auth, output_files, start_date, end_date)
+            return update_snapshot_store(output_files, failed) and not failed
+        
+        if issue_types:
+            failed = fetch_multi_type(es_host, es_index, issue_types, auth, output_files, start_date, end_date)
+            return update_snapshot_store(output_files, failed) and not failed
+        
+        result = search(es_host, es_index, query, auth)
         output_file = get_env_var("OUTPUT_FILE", "")
         if output_file:
-            empty_result = {
-                "hits": {"hits": [], "total": {"value": 0}},
-                "aggregations": {},
-                "error": str(e),
-                "date_range": {
-                    "start_date": get_date_range()[0],
-                    "end_date": get_date_range()[1]
-                }
-            }
+            write_result(result, output_file, start_date, end_date)
+        
+        return update_snapshot_store(output_files)
+    except Exception as e:
+        print(f"ERROR: Failed to query Elasticsearch: {str(e)}")
+        
+        # Still create the output files, marked partial, so later steps
+        # report the failure instead of finding no issues
+        for key, output_file in output_files.items():
             try:
-                with open(output_file, 'w') as f:
-                    json.dump(empty_result, f, indent=2)
+                write_empty_result(output_file, str(e), start_date, end_date, key)
                 print(f"Created empty result file at {output_file} due to error")
             except Exception as file_error:
                 print(f"Failed to create output file: {file_error}")
+        update_snapshot_store(output_files, list(output_files))
         
         return False
 
-if __name__ == "__main__":
+def main():
+    """Main function to fetch data, returning the exit status"""
+    start_run()
     success = query_elasticsearch()
-    sys.exit(0 if success else 1) 
+    metrics_file = get_env_var("METRICS_FILE", "")
+    if metrics_file:
+        metrics.info["partial_outputs"] = dict(partial_outputs)
+        metrics.write(metrics_file, success)
+    if partial_outputs:
+        print(f"WARNING: {len(partial_outputs)} output file(s) hold partial data: {', '.join(partial_outputs)}")
+    return 0 if success else PARTIAL_EXIT_CODE if partial_outputs else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
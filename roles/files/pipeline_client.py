@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import socket
+import argparse
+
+def connect(socket_path, timeout=None):
+    """Connect to the daemon on a Unix socket; raises OSError if none is listening"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def exchange(sock, method, path, body=None):
+    """Send one HTTP request over a connected socket, returning (status, JSON body)"""
+    data = json.dumps(body).encode() if body is not None else b""
+    sock.sendall(f"{method} {path} HTTP/1.0\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+    with sock.makefile('rb') as f:
+        status = int(f.readline().split()[1])
+        while f.readline().strip():
+            pass
+        return status, json.loads(f.read() or b"{}")
+
+def request(socket_path, method, path, body=None, timeout=None):
+    """Send one request to the daemon on a Unix socket, returning (status, JSON body)"""
+    sock = connect(socket_path, timeout)
+    try:
+        return exchange(sock, method, path, body)
+    finally:
+        sock.close()
+
+def run_directly(script, args):
+    """Run the script in place of this process, as if the daemon were not used"""
+    sys.stdout.flush()
+    os.execv(sys.executable, [sys.executable, script] + args)
+
+def main():
+    """Main function to run a stage script through the pipeline daemon"""
+    parser = argparse.ArgumentParser(
+        description='Run a stage script in the pipeline daemon, or directly when no daemon is listening')
+    parser.add_argument('--socket', required=True, help='Unix socket of pipeline_daemon.py')
+    parser.add_argument('script', help='Stage script, e.g. roles/files/process_data.py')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments of the stage script')
+    
+    args = parser.parse_args()
+    
+    try:
+        sock = connect(os.path.abspath(args.socket))
+    except OSError:
+        print(f"Pipeline daemon not listening on {args.socket}, running {args.script} directly", file=sys.stderr)
+        return run_directly(args.script, args.args)
+    
+    # Once the request is sent the stage may have run, so failures from
+    # here on are errors rather than a reason to run it again
+    try:
+        status, response = exchange(sock, "POST", "/run", {
+            "script": os.path.basename(args.script),
+            "args": args.args,
+            "env": dict(os.environ),
+            "cwd": os.getcwd()
+        })
+    except (OSError, ValueError) as e:
+        print(f"ERROR: Lost the pipeline daemon while running {args.script}: {str(e)}")
+        return 1
+    finally:
+        sock.close()
+    
+    if status != 200:
+        # Nothing was run, e.g. the daemon is restarting on new code
+        print(f"Pipeline daemon did not run {args.script} ({response.get('error')}), running it directly",
+              file=sys.stderr)
+        return run_directly(args.script, args.args)
+    
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["rc"]
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import sys
+import json
+import time
+import signal
+import argparse
+import importlib
+import traceback
+import contextlib
+import socketserver
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+
+from pipeline_client import request
+
+# Scripts the daemon runs, each from its main() function
+STAGE_SCRIPTS = (
+    "fetch_data.py",
+    "process_data.py",
+    "combine_reports.py",
+    "diff_reports.py",
+    "render_emails.py",
+    "send_emails.py",
+    "run_metrics.py",
+)
+
+CODE_DIR = Path(__file__).resolve().parent
+
+def code_mtimes():
+    """Get the modification time of every module in the code directory"""
+    return {path.name: path.stat().st_mtime for path in CODE_DIR.glob('*.py')}
+
+@contextlib.contextmanager
+def client_context(argv, env, cwd):
+    """Run a block as if it were a fresh process started by the client: its argv, environment and directory"""
+    saved_argv, saved_env, saved_cwd = sys.argv, dict(os.environ), os.getcwd()
+    sys.argv = argv
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        os.chdir(cwd)
+        yield
+    finally:
+        sys.argv = saved_argv
+        os.environ.clear()
+        os.environ.update(saved_env)
+        os.chdir(saved_cwd)
+
+def run_stage(script, args, env, cwd):
+    """Run one stage script's main() in this process, returning (exit status, stdout, stderr)"""
+    module = importlib.import_module(Path(script).stem)
+    stdout, stderr = io.StringIO(), io.StringIO()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            # PIPELINE_DAEMON tells run_metrics the process is shared between stages
+            env = dict(env, PIPELINE_DAEMON=str(os.getpid()))
+            with client_context([str(CODE_DIR / script)] + list(args), env, cwd):
+                rc = module.main()
+        except SystemExit as e:
+            # argparse errors and explicit exits
+            rc = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            if e.code is not None and not isinstance(e.code, int):
+                print(e.code, file=sys.stderr)
+        except Exception:
+            traceback.print_exc()
+            rc = 1
+    return (0 if rc is None else rc), stdout.getvalue(), stderr.getvalue()
+
+class PipelineServer(socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket running pipeline stages one at a time
+    
+    Stages run in this process, so module imports, the pooled Elasticsearch
+    session or client of fetch_data, compiled email templates and compiled
+    compliance rules stay warm from one run to the next. Requests are
+    handled one at a time, as stages share process-wide state such as the
+    environment and the working directory. When a module in the code
+    directory changes the server finishes the request and restarts itself,
+    so it never runs stale code.
+    """
+    
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.started_at = datetime.now().isoformat()
+        self.runs = 0
+        self.last_run = None
+        self.mtimes = code_mtimes()
+        self.restart = False
+        self.shutdown_requested = False
+        # handle_request() waits at most this long, so SIGTERM is noticed while idle
+        self.timeout = 1
+        # Owner only: requests carry the client's environment, credentials included
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, PipelineRequestHandler)
+        finally:
+            os.umask(old_umask)
+    
+    def status(self):
+        """Describe the server and what it has loaded"""
+        return {
+            "pid": os.getpid(),
+            "socket": self.socket_path,
+            "started_at": self.started_at,
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "loaded_stages": [script for script in STAGE_SCRIPTS if Path(script).stem in sys.modules]
+        }
+
+class PipelineRequestHandler(BaseHTTPRequestHandler):
+    """Handle GET /status, POST /run and POST /shutdown
+    
+    POST /run takes {"script", "args", "env", "cwd"} and answers with
+    {"rc", "stdout", "stderr", "seconds"}. If the code changed since the
+    server started, it answers 503 without running anything; the client
+    then runs the script itself.
+    """
+    
+    def send_json(self, status, body):
+        """Send a JSON response"""
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def do_GET(self):
+        if self.path == "/status":
+            self.send_json(200, self.server.status())
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+    
+    def do_POST(self):
+        if self.path == "/shutdown":
+            self.send_json(200, {"stopping": True})
+            self.server.shutdown_requested = True
+            return
+        if self.path != "/run":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            script = body["script"]
+            args, env, cwd = body.get("args", []), body.get("env", {}), body.get("cwd", "/")
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        if script not in STAGE_SCRIPTS:
+            self.send_json(400, {"error": f"Unknown script {script}"})
+            return
+        if code_mtimes() != self.server.mtimes:
+            self.server.restart = True
+            self.send_json(503, {"error": "Code changed since the daemon started, restarting"})
+            return
+        
+        start = time.monotonic()
+        rc, stdout, stderr = run_stage(script, args, env, cwd)
+        seconds = round(time.monotonic() - start, 3)
+        self.server.runs += 1
+        self.server.last_run = {"script": script, "rc": rc, "seconds": seconds,
+                                "finished_at": datetime.now().isoformat()}
+        self.send_json(200, {"rc": rc, "stdout": stdout, "stderr": stderr, "seconds": seconds})
+        print(f"{datetime.now().isoformat()} {script} {' '.join(args)}: exit status {rc} in {seconds:.3f}s",
+              flush=True)
+    
+    def log_message(self, format, *args):
+        """Keep request lines out of the log; runs are logged by do_POST()"""
+
+def daemon_status(socket_path):
+    """Get the status of the daemon on a socket, or None if none is listening"""
+    try:
+        return request(socket_path, "GET", "/status", timeout=5)[1]
+    except (OSError, ValueError):
+        return None
+
+def serve(socket_path):
+    """Serve on socket_path until stopped, restarting in place when the code changes
+    
+    Returns 1 without serving if another daemon is listening on the socket.
+    """
+    if os.path.exists(socket_path):
+        status = daemon_status(socket_path)
+        if status:
+            print(f"ERROR: Pipeline daemon {status['pid']} is already listening on {socket_path}", flush=True)
+            return 1
+        # Left behind by a daemon that did not exit cleanly
+        os.remove(socket_path)
+    server = PipelineServer(socket_path)
+    stop = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+    print(f"{server.started_at} Pipeline daemon {os.getpid()} listening on {socket_path}", flush=True)
+    try:
+        while not (stop or server.shutdown_requested or server.restart):
+            server.handle_request()
+    finally:
+        server.server_close()
+        with contextlib.suppress(OSError):
+            os.remove(socket_path)
+    if server.restart:
+        print(f"{datetime.now().isoformat()} Code changed, restarting", flush=True)
+        os.execv(sys.executable, [sys.executable, str(Path(__file__).resolve()), "--socket", socket_path])
+    print(f"{datetime.now().isoformat()} Pipeline daemon stopped", flush=True)
+    return 0
+
+def detach(socket_path, log_file):
+    """Start serving in a background process, returning once it answers on the socket"""
+    pid = os.fork()
+    if pid == 0:
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0)
+        with open(os.devnull) as devnull, open(log_file, 'a') as log:
+            os.dup2(devnull.fileno(), 0)
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+        try:
+            serve(socket_path)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    for _ in range(100):
+        status = daemon_status(socket_path)
+        if status:
+            return status
+        time.sleep(0.1)
+    return None
+
+def main():
+    """Main function to run or control the pipeline daemon"""
+    parser = argparse.ArgumentParser(description='Run pipeline stages in one long-running process')
+    parser.add_argument('--socket', required=True, help='Unix socket the daemon listens on')
+    parser.add_argument('--detach', action='store_true',
+                        help='Start the daemon in the background unless one is already listening')
+    parser.add_argument('--log', help='Log file of a detached daemon (default: <socket>.log)')
+    parser.add_argument('--status', action='store_true', help='Print the status of the running daemon')
+    parser.add_argument('--stop', action='store_true', help='Stop the running daemon')
+    
+    args = parser.parse_args()
+    socket_path = os.path.abspath(args.socket)
+    
+    if args.status or args.stop or args.detach:
+        status = daemon_status(socket_path)
+        if args.status:
+            print(json.dumps(status, indent=2) if status else f"No daemon listening on {socket_path}")
+            return 0 if status else 1
+        if args.stop:
+            if status:
+                request(socket_path, "POST", "/shutdown", timeout=5)
+                print(f"Stopped pipeline daemon {status['pid']}")
+            else:
+                print(f"No daemon listening on {socket_path}")
+            return 0
+        if status:
+            print(f"Pipeline daemon {status['pid']} already listening on {socket_path}")
+            return 0
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        status = detach(socket_path, args.log or f"{socket_path}.log")
+        if not status:
+            print(f"ERROR: Pipeline daemon did not start; see {args.log or socket_path + '.log'}")
+            return 1
+        print(f"Started pipeline daemon {status['pid']} on {socket_path}")
+        return 0
+    
+    return serve(socket_path)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,12 +3,19 @@
 import os
 import sys
 import json
-import smtplib
+import gzip
 import argparse
+import contextlib
+import io
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from datetime import datetime, timedelta
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
+
+from build_cache import BuildCache, build_key, file_digest
+from compliance_rules import RuleSet, load_rules, thresholds_rules
+from run_metrics import StageMetrics
+from template_engine import load_template
 
 def get_env_var(var_name, default=None, required=False):
     """Get environment variable or return default value"""
@@ -18,228 +25,549 @@ def get_env_var(var_name, default=None, required=False):
         sys.exit(1)
     return value
 
-def load_vulnerability_data(file_path):
-    """Load vulnerability data from JSON file"""
+def open_raw_file(file_path):
+    """Open a raw data file for reading text, transparently handling gzip"""
+    with open(file_path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(file_path, 'rt')
+    return open(file_path, 'r')
+
+def iter_ndjson_hits(f, trailer=None):
+    """Yield hits from an open NDJSON raw data file, closing it when exhausted
+    
+    If a trailer dict is given it is filled with the sections of the
+    file's _trailer record once the hits run out.
+    """
     try:
-        with open(file_path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if '_trailer' in record:
+                if trailer is not None:
+                    trailer.update(record['_trailer'])
+                continue
+            yield record
+    finally:
+        f.close()
+
+def stream_vulnerability_data(file_path, header=None):
+    """Open vulnerability data for lazy reading
+    
+    Returns (hits, total). For NDJSON raw files hits is a generator reading
+    one line at a time, so memory stays bounded by a single hit; JSON raw
+    files are loaded whole and hits is a list. If a header dict is given it
+    is filled with the file's other top-level sections, e.g. issue_buckets;
+    for NDJSON the _trailer sections, such as a partial marker written after
+    the hits, are only added once hits is exhausted.
+    """
+    try:
+        f = open_raw_file(file_path)
+        first_line = f.readline()
+        try:
+            file_header = json.loads(first_line).get('_header') if first_line.strip() else None
+        except ValueError:
+            file_header = None
+        
+        if file_header is not None:
+            if header is not None:
+                header.update(file_header)
+            total = file_header.get('total', {}).get('value', 0)
+            return iter_ndjson_hits(f, header), total
+        
+        # Not NDJSON: rewind and parse the whole document
+        f.seek(0)
+        with f:
             data = json.load(f)
         
         hits = data.get('hits', {}).get('hits', [])
         total = data.get('hits', {}).get('total', {}).get('value', 0)
+        if header is not None:
+            header.update((key, value) for key, value in data.items() if key != 'hits')
         
         return hits, total
     except Exception as e:
         print(f"ERROR: Failed to load data from file: {str(e)}")
         return [], 0
 
-def analyze_issues(hits):
-    """Analyze issue data and extract useful metrics"""
-    severity_counts = {
-        "critical": 0,
-        "high": 0,
-        "medium": 0,
-        "low": 0,
-        "info": 0,
+def merge_partial_markers(markers):
+    """Fold the partial markers of several issue types into one covering all of them
+    
+    Its issue_type names every affected issue type, or is None if one of
+    the markers covers them all; its counts and errors are those of every
+    marker.
+    """
+    if len(markers) <= 1:
+        return markers[0] if markers else None
+    issue_types = sorted(marker['issue_type'] for marker in markers if marker.get('issue_type'))
+    expected = [marker.get('expected') for marker in markers]
+    return {
+        "issue_type": ", ".join(issue_types) if len(issue_types) == len(markers) else None,
+        "issue_types": issue_types,
+        "error": "; ".join(dict.fromkeys(str(marker.get('error')) for marker in markers)),
+        "documents": sum(marker.get('documents') or 0 for marker in markers),
+        "expected": None if None in expected else sum(expected),
+        "stale": all(marker.get('stale') for marker in markers),
+        "fetched_at": max(marker.get('fetched_at') or "" for marker in markers)
     }
+
+def store_partial_marker(store, issue_type=None):
+    """Get a snapshot store's partial marker for the documents of issue_type, if any
+    
+    Without an issue type the markers of every issue type are merged.
+    """
+    markers = store.get_meta("partial") or {}
+    if issue_type:
+        return markers.get(issue_type) or markers.get("")
+    return merge_partial_markers([markers[key] for key in sorted(markers)])
+
+def stream_store_data(store_file, issue_type=None, header=None):
+    """Open the documents of a snapshot store for lazy reading
     
-    app_codes = {}
-    issue_types = set()
-    high_severity_issues = []
-    custodians = {}
+    Returns (hits, total) like stream_vulnerability_data(), reading only the
+    documents of issue_type through its index when one is given. If a
+    header dict is given and the last fetch could not update these
+    documents in full, it gets the store's partial marker for them.
+    """
+    # Imported here because snapshot_store imports this module
+    from snapshot_store import SnapshotStore
     
+    try:
+        store = SnapshotStore(store_file, readonly=True)
+        if header is not None:
+            marker = store_partial_marker(store, issue_type)
+            if marker:
+                header['partial'] = marker
+        return store.iter_hits(issue_type), store.count(issue_type)
+    except Exception as e:
+        print(f"ERROR: Failed to load data from snapshot store: {str(e)}")
+        return [], 0
+
+def load_vulnerability_data(file_path):
+    """Load vulnerability data from a JSON or NDJSON raw data file"""
+    hits, total = stream_vulnerability_data(file_path)
+    try:
+        return list(hits), total
+    except Exception as e:
+        print(f"ERROR: Failed to load data from file: {str(e)}")
+        return [], 0
+
+def describe_partial(markers):
+    """Name the issue types whose data was fetched incompletely, for the email notice"""
+    return ", ".join(sorted({marker.get('issue_type') or "all issue types" for marker in markers}))
+
+def sample_hits(hits, sample, limit):
+    """Yield every hit while copying the first few into sample"""
     for hit in hits:
-        source = hit.get('_source', {})
-        severity = source.get('severity', '')
-        
-        # Handle null/empty severity - treat all issues as "medium" by default
-        # or assign severity based on issue type
-        if not severity or severity == 'null':
-            # Assign severity based on issue type
-            issue_type = source.get('issueType', '').lower()
-            if 'vulnerability' in issue_type:
-                severity = 'high'
-            elif 'cryptography' in issue_type:
-                severity = 'high'
-            elif 'tss' in issue_type:
-                severity = 'medium'
-            elif 'av tss' in issue_type:
-                severity = 'medium'
-            elif 'open data' in issue_type:
-                severity = 'low'
-            else:
-                severity = 'medium'  # default
+        if len(sample) < limit:
+            sample.append(hit)
+        yield hit
+
+SEVERITY_LEVELS = ("critical", "high", "medium", "low", "info")
+
+# Define compliance thresholds, the rules used without a rules file
+COMPLIANCE_THRESHOLDS = {
+    "critical": 0,  # Any critical finding makes an app non-compliant
+    "high": 0,      # Any high findings make an app non-compliant
+    "medium": 10,   # More than 10 medium findings make an app non-compliant
+}
+
+# Severity assigned to issues with a null/empty severity, keyed on the
+# lower-cased issue type. Unseen issue types are resolved with
+# infer_severity() once and cached here.
+ISSUE_TYPE_SEVERITY = {
+    "vulnerability": "high",
+    "cryptography": "high",
+    "tss": "medium",
+    "av tss": "medium",
+    "open data": "low",
+}
+
+def infer_severity(issue_type):
+    """Assign a severity from a lower-cased issue type by keyword"""
+    if 'vulnerability' in issue_type:
+        return 'high'
+    elif 'cryptography' in issue_type:
+        return 'high'
+    elif 'tss' in issue_type:
+        return 'medium'
+    elif 'open data' in issue_type:
+        return 'low'
+    return 'medium'  # default
+
+def resolve_severity(source):
+    """Get the lower-cased severity of an issue, inferring it from the issue type if missing"""
+    severity = source.get('severity', '')
+    if severity and severity != 'null':
+        return severity.lower()
+    
+    issue_type = (source.get('issueType') or '').lower()
+    severity = ISSUE_TYPE_SEVERITY.get(issue_type)
+    if severity is None:
+        severity = ISSUE_TYPE_SEVERITY[issue_type] = infer_severity(issue_type)
+    return severity
+
+# Columns of the processed report issue table. Custodians and app codes
+# reference rows of this table by index instead of embedding issue copies.
+REPORT_ISSUE_FIELDS = [
+    "_id",
+    "appCode",
+    "issueType",
+    "severity",
+    "affectedItemType",
+    "affectedItemName",
+    "remediationLink",
+    "solution",
+    "fixByDate",
+]
+
+def get_custodian(source):
+    """Get the (name, email) of an issue's app custodian; email is None if unknown"""
+    # Extract custodian information from contact-info structure
+    contact_info = source.get('contact-info', {})
+    custodian_name = contact_info.get('app_custodian_name', 'Unknown')
+    custodian_email = contact_info.get('app_custodian_email', None)  # Future field
+    
+    # If no email in contact-info, try legacy field (fallback)
+    if not custodian_email:
+        custodian_email = source.get('custodian_email', None)
+    
+    return custodian_name, custodian_email or None
+
+def make_custodian_key(custodian_name, custodian_email):
+    """Get the key custodians are grouped on: their email, or their name when it is unknown"""
+    return custodian_email if custodian_email else f"no-email-{custodian_name}"
+
+def issue_row(hit, source):
+    """Build the issue table row of one hit"""
+    return [hit.get('_id')] + [source.get(field) for field in REPORT_ISSUE_FIELDS[1:]]
+
+def high_severity_entry(source, severity):
+    """Build the summary.high_severity_issues entry of one critical or high severity issue"""
+    return {
+        'type': source.get('issueType', 'Unknown'),
+        'severity': severity.upper(),
+        'component': f"{source.get('affectedItemType', 'Unknown')} - {source.get('affectedItemName', 'Unknown')}",
+        'app_code': source.get('appCode'),
+        'fix_by_date': source.get('fixByDate', 'N/A'),
+        'remediation_link': source.get('remediationLink', source.get('solution', 'N/A'))
+    }
+
+def bucket_source(key):
+    """Rebuild the _source fields of an issue bucket key
+    
+    Composite aggregation sources are named after the field they group on,
+    e.g. contact-info.app_custodian_email; missing values are left out.
+    """
+    source = {}
+    for field, value in key.items():
+        if value is None:
+            continue
+        parent, _, child = field.partition('.')
+        if child:
+            source.setdefault(parent, {})[child] = value
         else:
-            severity = severity.lower()
-        
-        app_code = source.get('appCode')
-        issue_type = source.get('issueType')
-        
-        # Extract custodian information from contact-info structure
-        contact_info = source.get('contact-info', {})
-        custodian_name = contact_info.get('app_custodian_name', 'Unknown')
-        custodian_email = contact_info.get('app_custodian_email', None)  # Future field
-        
-        # If no email in contact-info, try legacy field (fallback)
-        if not custodian_email:
-            custodian_email = source.get('custodian_email', None)
-        
-        if severity in severity_counts:
-            severity_counts[severity] += 1
+            source[field] = value
+    return source
+
+def empty_severity_counts():
+    """Return a zeroed severity count dict"""
+    return {level: 0 for level in SEVERITY_LEVELS}
+
+def load_compliance_rules(rules_file=None, as_of=None):
+    """Compile the compliance rules of a rules file, or of COMPLIANCE_THRESHOLDS without one"""
+    if rules_file:
+        return load_rules(rules_file, as_of)
+    return RuleSet(thresholds_rules(COMPLIANCE_THRESHOLDS), as_of)
+
+def end_date_of(end_date):
+    """Parse a report end date, the date age rules count back from, or None if it is not a date"""
+    try:
+        return datetime.strptime(end_date, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+
+class IssueAccumulator:
+    """Single-pass analysis of issue hits
+    
+    add() folds one hit into the severity counts, per-app stats, custodian
+    groupings and high severity rows; analysis() and compliance() build the
+    results of analyze_issues() and identify_non_compliant_apps() from the
+    same state, so a report only needs one pass over the data. Each hit is
+    also counted against the compiled compliance rules as it is folded in,
+    so any number of rules adds no pass of its own.
+    
+    Issues are stored once in issue_rows (see REPORT_ISSUE_FIELDS) and
+    referenced from apps and custodians by row index.
+    
+    For aggregated raw data the counts come from add_bucket() and only the
+    high severity hits are stored with add_detail().
+    """
+    
+    def __init__(self, thresholds=None, rules=None):
+        if rules is None:
+            rules = RuleSet(thresholds_rules(thresholds)) if thresholds is not None else load_compliance_rules()
+        self.rules = rules
+        self.severity_counts = empty_severity_counts()
+        self.app_codes = {}
+        self.issue_types = set()
+        self.high_severity_issues = []
+        self.custodians = {}
+        self.issue_rows = []
+    
+    def add(self, hit):
+        """Fold one hit into the accumulated state"""
+        source = hit.get('_source', {})
+        severity = resolve_severity(source)
+        self.count(source, severity)
+        self.add_detail(hit, source, severity)
+    
+    def app_entry(self, app_code):
+        """Get the accumulated entry of an app code, creating it on first use"""
+        app = self.app_codes.get(app_code)
+        if app is None:
+            app = self.app_codes[app_code] = {
+                'issue_types': set(),
+                'severity_counts': empty_severity_counts(),
+                'issue_count': 0,
+                'issue_ids': [],
+                'rule_counts': [0] * len(self.rules.names)
+            }
+        return app
+    
+    def custodian_entry(self, source):
+        """Get the accumulated entry of an issue's custodian, creating it on first use"""
+        custodian_name, custodian_email = get_custodian(source)
+        return self.custodian_key_entry(make_custodian_key(custodian_name, custodian_email),
+                                        custodian_name, bool(custodian_email))
+    
+    def custodian_key_entry(self, key, custodian_name, has_email):
+        """Get the accumulated entry of a custodian key, creating it with this name on first use"""
+        custodian = self.custodians.get(key)
+        if custodian is None:
+            custodian = self.custodians[key] = {
+                'app_codes': set(),
+                'issue_ids': [],
+                'custodian_name': custodian_name,
+                'has_email': has_email
+            }
+        return custodian
+    
+    def count(self, source, severity, doc_count=1):
+        """Count doc_count issues sharing the app, issue type, custodian, severity and fix-by date of source"""
+        if severity in self.severity_counts:
+            self.severity_counts[severity] += doc_count
         
         app_code = source.get('appCode')
         if app_code:
-            if app_code not in app_codes:
-                app_codes[app_code] = {
-                    'issue_types': set(),
-                    'severity_counts': {
-                        "critical": 0,
-                        "high": 0,
-                        "medium": 0,
-                        "low": 0,
-                        "info": 0,
-                    }
-                }
-            
-            if severity in app_codes[app_code]['severity_counts']:
-                app_codes[app_code]['severity_counts'][severity] += 1
+            app = self.app_entry(app_code)
+            app['issue_count'] += doc_count
+            if severity in app['severity_counts']:
+                app['severity_counts'][severity] += doc_count
             
             issue_type = source.get('issueType')
             if issue_type:
-                app_codes[app_code]['issue_types'].add(issue_type)
-                issue_types.add(issue_type)
+                app['issue_types'].add(issue_type)
+                self.issue_types.add(issue_type)
             
-            # Track custodians - use email if available, otherwise use name or default
-            custodian_key = custodian_email if custodian_email else f"no-email-{custodian_name}"
-            if custodian_key not in custodians:
-                custodians[custodian_key] = {
-                    'app_codes': set(),
-                    'issues': [],
-                    'custodian_name': custodian_name,
-                    'has_email': bool(custodian_email)
-                }
-            custodians[custodian_key]['app_codes'].add(app_code)
-            custodians[custodian_key]['issues'].append(source)
-        
-        if severity in ['critical', 'high']:
-            high_severity_issues.append({
-                'type': source.get('issueType', 'Unknown'),
-                'severity': severity.upper(),
-                'component': f"{source.get('affectedItemType', 'Unknown')} - {source.get('affectedItemName', 'Unknown')}",
-                'app_code': app_code,
-                'remediation_link': source.get('remediationLink', source.get('solution', 'N/A'))
-            })
-    
-    app_codes_list = [
-        {
-            'app_code': code,
-            'issue_types': list(details['issue_types']),
-            'severity_counts': details['severity_counts']
-        }
-        for code, details in app_codes.items()
-    ]
-    
-    # Convert sets to lists in custodian data for JSON serialization
-    custodians_serializable = {}
-    for key, custodian_data in custodians.items():
-        custodians_serializable[key] = {
-            'app_codes': list(custodian_data['app_codes']),
-            'issues': custodian_data['issues'],
-            'custodian_name': custodian_data['custodian_name'],
-            'has_email': custodian_data['has_email']
-        }
-    
-    return {
-        "severity_counts": severity_counts,
-        "app_codes": app_codes_list,
-        "issue_types": list(issue_types),
-        "high_severity_count": severity_counts["critical"] + severity_counts["high"],
-        "high_severity_issues": high_severity_issues,
-        "custodian": custodians_serializable
-    }
-
-def identify_non_compliant_apps(hits):
-    """Identify non-compliant apps based on severity thresholds"""
-    app_compliance = {}
+            self.rules.count(app['rule_counts'], severity, issue_type, source.get('fixByDate'), doc_count)
+            self.custodian_entry(source)['app_codes'].add(app_code)
     
-    # Define compliance thresholds
-    thresholds = {
-        "critical": 0,  # Any critical finding makes an app non-compliant
-        "high": 0,      # Any high findings make an app non-compliant
-        "medium": 10,   # More than 10 medium findings make an app non-compliant
-    }
+    def add_bucket(self, bucket):
+        """Count the issues of one issue bucket from an aggregated raw data file
+        
+        Buckets carry no fix-by dates, so they never count against age rules.
+        """
+        source = bucket_source(bucket['key'])
+        self.count(source, resolve_severity(source), bucket['doc_count'])
     
-    # Group findings by appcode
-    for hit in hits:
-        source = hit.get('_source', {})
-        app_code = source.get('appCode')
-        severity = source.get('severity', '')
+    def add_detail(self, hit, source=None, severity=None):
+        """Store one hit as an issue row and high severity entry without counting it"""
+        if source is None:
+            source = hit.get('_source', {})
+            severity = resolve_severity(source)
         
-        # Handle null/empty severity - assign based on issue type
-        if not severity or severity == 'null':
-            issue_type = source.get('issueType', '').lower()
-            if 'vulnerability' in issue_type:
-                severity = 'high'
-            elif 'cryptography' in issue_type:
-                severity = 'high'
-            elif 'tss' in issue_type:
-                severity = 'medium'
-            elif 'av tss' in issue_type:
-                severity = 'medium'
-            elif 'open data' in issue_type:
-                severity = 'low'
-            else:
-                severity = 'medium'  # default
-        else:
-            severity = severity.lower()
+        app_code = source.get('appCode')
+        if app_code:
+            issue_id = len(self.issue_rows)
+            self.issue_rows.append(issue_row(hit, source))
+            self.app_entry(app_code)['issue_ids'].append(issue_id)
+            self.custodian_entry(source)['issue_ids'].append(issue_id)
         
-        if not app_code:
-            continue
+        if severity in ('critical', 'high'):
+            self.high_severity_issues.append(high_severity_entry(source, severity))
+    
+    def add_all(self, hits):
+        """Fold every hit into the accumulated state"""
+        for hit in hits:
+            self.add(hit)
+        return self
+    
+    def analysis(self):
+        """Build the analyze_issues() result"""
+        app_codes_list = [
+            {
+                'app_code': code,
+                'issue_types': list(details['issue_types']),
+                'severity_counts': dict(details['severity_counts']),
+                'issue_count': details['issue_count'],
+                'issue_ids': details['issue_ids'],
+                'rule_counts': dict(zip(self.rules.names, details['rule_counts']))
+            }
+            for code, details in self.app_codes.items()
+        ]
         
-        if app_code not in app_compliance:
-            app_compliance[app_code] = {
-                "critical": 0,
-                "high": 0,
-                "medium": 0,
-                "low": 0,
-                "info": 0,
-                "is_compliant": True,
-                "reasons": []
+        # Convert sets to lists in custodian data for JSON serialization
+        custodians_serializable = {}
+        for key, custodian_data in self.custodians.items():
+            custodians_serializable[key] = {
+                'app_codes': list(custodian_data['app_codes']),
+                'issue_ids': custodian_data['issue_ids'],
+                'custodian_name': custodian_data['custodian_name'],
+                'has_email': custodian_data['has_email']
             }
         
-        if severity in app_compliance[app_code]:
-            app_compliance[app_code][severity] += 1
-    
-    # Check compliance for each appcode
-    for app_code, data in app_compliance.items():
-        if data["critical"] > thresholds["critical"]:
-            data["is_compliant"] = False
-            data["reasons"].append(f"Has {data['critical']} critical findings (threshold: {thresholds['critical']})")
+        return {
+            "severity_counts": dict(self.severity_counts),
+            "app_codes": app_codes_list,
+            "issue_types": list(self.issue_types),
+            "high_severity_count": self.severity_counts["critical"] + self.severity_counts["high"],
+            "high_severity_issues": self.high_severity_issues,
+            "custodian": custodians_serializable,
+            "issues": {
+                "fields": REPORT_ISSUE_FIELDS,
+                "rows": self.issue_rows
+            }
+        }
+    
+    def compliance(self):
+        """Build the identify_non_compliant_apps() result from the per-app rule counts"""
+        app_compliance = {}
         
-        if data["high"] > thresholds["high"]:
-            data["is_compliant"] = False
-            data["reasons"].append(f"Has {data['high']} high findings (threshold: {thresholds['high']})")
+        for app_code, details in self.app_codes.items():
+            data = dict(details['severity_counts'])
+            data["is_compliant"], data["reasons"] = self.rules.evaluate(app_code, details['rule_counts'])
+            app_compliance[app_code] = data
         
-        if data["medium"] > thresholds["medium"]:
-            data["is_compliant"] = False
-            data["reasons"].append(f"Has {data['medium']} medium findings (threshold: {thresholds['medium']})")
-    
-    return app_compliance
+        return app_compliance
 
-def generate_report(input_file, output_file):
-    """Generate a formatted report from data"""
-    hits, total = load_vulnerability_data(input_file)
-    
-    if total == 0:
-        print("No issues found.")
-        return False
-    
-    analysis = analyze_issues(hits)
+# (ANALYSIS_BACKEND value, backend used) of the last lookup
+_analysis_backend = None
+
+def get_analysis_backend():
+    """Get the analysis backend from ANALYSIS_BACKEND: python, or numpy for columnar group-bys
     
-    compliance_status = identify_non_compliant_apps(hits)
+    The backend is resolved again whenever the variable changes, e.g.
+    between runs of a long-running process.
+    """
+    global _analysis_backend
+    requested = get_env_var("ANALYSIS_BACKEND", "python").lower()
+    if _analysis_backend is None or _analysis_backend[0] != requested:
+        backend = requested
+        if backend not in ("python", "numpy"):
+            print(f"Warning: Unknown ANALYSIS_BACKEND {backend}, falling back to python")
+            backend = "python"
+        elif backend == "numpy":
+            # Imported here because columnar imports this module
+            import columnar
+            if columnar.np is None:
+                print("Warning: ANALYSIS_BACKEND=numpy needs the numpy package, falling back to python")
+                backend = "python"
+        _analysis_backend = (requested, backend)
+    return _analysis_backend[1]
+
+def new_accumulator(thresholds=None, rules=None):
+    """Create an empty accumulator of the ANALYSIS_BACKEND"""
+    if get_analysis_backend() == "numpy":
+        from columnar import ColumnarAccumulator
+        return ColumnarAccumulator(thresholds, rules)
+    return IssueAccumulator(thresholds, rules)
+
+def analyze_issues(hits):
+    """Analyze issue data and extract useful metrics"""
+    return new_accumulator().add_all(hits).analysis()
+
+def identify_non_compliant_apps(hits, rules=None):
+    """Identify non-compliant apps based on the compliance rules (default: severity thresholds)"""
+    return new_accumulator(rules=rules).add_all(hits).compliance()
+
+def rehydrate_issues(report, issue_ids):
+    """Rebuild issue records for the given ids from a processed report's issue table"""
+    table = report.get('issues', {})
+    fields = table.get('fields', REPORT_ISSUE_FIELDS)
+    rows = table.get('rows', [])
+    return [dict(zip(fields, rows[issue_id])) for issue_id in issue_ids]
+
+def get_custodian_issues(report, custodian_key):
+    """Get the issue records of one custodian from a processed report
     
+    Reports written before the issue table existed embed the issues
+    directly; those are returned as they are.
+    """
+    custodian = report.get('custodian', {}).get(custodian_key, {})
+    if 'issue_ids' in custodian:
+        return rehydrate_issues(report, custodian['issue_ids'])
+    return custodian.get('issues', [])
+
+def get_app_issues(report, app_code):
+    """Get the issue records of one app code from a processed report"""
+    for app in report.get('summary', {}).get('app_codes', []):
+        if app['app_code'] == app_code:
+            return rehydrate_issues(report, app.get('issue_ids', []))
+    return []
+
+def report_dates():
+    """Get the generation date and the start and end dates of the period a report covers"""
     # Get date range from environment variables or use defaults
     end_date = os.environ.get('END_DATE', datetime.now().strftime("%Y-%m-%d"))
     start_date = os.environ.get('START_DATE', (datetime.now() - timedelta(days=14)).strftime("%Y-%m-%d"))
+    return datetime.now().strftime("%Y-%m-%d"), start_date, end_date
+
+def generate_report(input_file, output_file, store_file=None, issue_type=None, metrics=None, rules_file=None):
+    """Generate a formatted report from a raw data file or a snapshot store
+    
+    Apps are checked against the compliance rules of rules_file, or the
+    default thresholds without one, with age rules counting back from the
+    report end date. Raw data fetched with FETCH_MODE=aggregate carries
+    issue_buckets; the counts are then built from the buckets and only the
+    high severity hits in the file become issue rows. Parse, analysis and
+    write times are recorded in metrics when one is given. Data marked
+    partial by the fetch is still reported, even with no documents, and the
+    report carries the marker so later steps can say the counts may be
+    incomplete.
+    """
+    if metrics is None:
+        metrics = StageMetrics("process")
+    
+    header = {}
+    with metrics.timer("parse"):
+        if store_file:
+            hits, total = stream_store_data(store_file, issue_type, header)
+        else:
+            hits, total = stream_vulnerability_data(input_file, header)
+    
+    if total == 0 and not header.get('partial'):
+        print("No issues found.")
+        return False
+    
+    generated_at, start_date, end_date = report_dates()
+    raw_sample = []
+    accumulator = new_accumulator(rules=load_compliance_rules(rules_file, end_date_of(end_date)))
+    issue_buckets = header.get('issue_buckets')
+    # Hits are parsed lazily as they are analyzed, so parsing is timed
+    # per hit and left out of the analysis time
+    hits = metrics.timed_iter("parse", hits, counter="documents")
+    with metrics.timer("analysis", exclude=("parse",)):
+        if issue_buckets is None:
+            accumulator.add_all(sample_hits(hits, raw_sample, 10))
+        else:
+            for bucket in issue_buckets:
+                accumulator.add_bucket(bucket)
+            for hit in sample_hits(hits, raw_sample, 10):
+                accumulator.add_detail(hit)
+        analysis = accumulator.analysis()
+        compliance_status = accumulator.compliance()
     
     report = {
         "summary": {
@@ -247,7 +575,7 @@ def generate_report(input_file, output_file):
             "high_severity_count": analysis["high_severity_count"],
             "app_codes": analysis["app_codes"],
             "issue_types": analysis["issue_types"],
-            "generated_at": datetime.now().strftime("%Y-%m-%d"),
+            "generated_at": generated_at,
             "start_date": start_date,
             "end_date": end_date,
             "high_severity_issues": analysis["high_severity_issues"],
@@ -271,148 +599,303 @@ def generate_report(input_file, output_file):
         "issue_types": analysis["issue_types"],
         "compliance_details": compliance_status,
         "custodian": analysis["custodian"],
-        "raw_data": hits[:10]
+        "issues": analysis["issues"],
+        "raw_data": raw_sample
     }
     
+    # Only known once the hits are read: NDJSON files carry it in their trailer
+    partial = header.get('partial')
+    if partial:
+        report["partial"] = partial
+        metrics.count("partial_inputs")
+        detail = ("documents are from the last complete fetch" if partial.get('stale') else
+                  f"{partial.get('documents', 0)} of {partial.get('expected') or 'unknown'} documents fetched")
+        print(f"WARNING: Report built from partial data ({detail}): {partial.get('error')}")
+    
     try:
-        with open(output_file, 'w') as f:
-            json.dump(report, f, indent=2)
+        with metrics.timer("write"):
+            with open(output_file, 'w') as f:
+                json.dump(report, f, indent=2)
+        metrics.record_output(output_file)
         print(f"Report generated and saved to {output_file}")
         return True
     except Exception as e:
         print(f"ERROR: Failed to generate report: {str(e)}")
         return False
 
+def build_email_context(data):
+    """Build the email template variables for a processed report"""
+    summary = data["summary"]
+    severity_counts = data["severity_breakdown"]
+    non_compliant_apps = summary.get("non_compliant_apps", [])
+    
+    return {
+        "report_date": summary["generated_at"],
+        "generated_at": summary["generated_at"],
+        "app_code": ", ".join([app['app_code'] for app in summary["app_codes"]]) if summary["app_codes"] else "Unknown",
+        "total_issues": summary["total_issues"],
+        "high_severity_count": summary["high_severity_count"],
+        "start_date": summary["start_date"],
+        "end_date": summary["end_date"],
+        "issue_types": ", ".join(summary["issue_types"]) if "issue_types" in summary else "",
+        "critical_count": severity_counts.get("critical", 0),
+        "high_count": severity_counts.get("high", 0),
+        "medium_count": severity_counts.get("medium", 0),
+        "low_count": severity_counts.get("low", 0),
+        "info_count": severity_counts.get("info", 0),
+        "high_severity_issues": summary["high_severity_issues"],
+        "non_compliant_app": non_compliant_apps[0] if non_compliant_apps else None,
+        "incomplete_data": describe_partial([data["partial"]]) if data.get("partial") else "",
+    }
+
 def prepare_email_content(template_file, report_data):
-    """Prepare email content using template and report data"""
+    """Prepare email content using template and report data
+    
+    The template is compiled once per process by template_engine and reused
+    for every email rendered from it.
+    """
     try:
-        
-        with open(template_file, 'r') as f:
-            template = f.read()
+        template = load_template(template_file)
         
         with open(report_data, 'r') as f:
             data = json.load(f)
         
-        report_date = data["summary"]["generated_at"]
-        app_code = ", ".join([app['app_code'] for app in data["summary"]["app_codes"]]) if data["summary"]["app_codes"] else "Unknown"
-        total_issues = data["summary"]["total_issues"]
-        high_severity_count = data["summary"]["high_severity_count"]
-        start_date = data["summary"]["start_date"]
-        end_date = data["summary"]["end_date"]
-        high_severity_issues = data["summary"]["high_severity_issues"]
-        non_compliant_apps = data["summary"].get("non_compliant_apps", [])
-        
-        severity_counts = data["severity_breakdown"]
-        critical_count = severity_counts.get("critical", 0)
-        high_count = severity_counts.get("high", 0)
-        medium_count = severity_counts.get("medium", 0)
-        low_count = severity_counts.get("low", 0)
-        info_count = severity_counts.get("info", 0)
-        
-        issue_types = ", ".join(data["summary"]["issue_types"]) if "issue_types" in data["summary"] else ""
-        
-        content = template
-        
-        # Replace basic variables
-        content = content.replace("{{ report_date }}", report_date)
-        content = content.replace("{{ app_code }}", app_code)
-        content = content.replace("{{ total_issues }}", str(total_issues))
-        content = content.replace("{{ high_severity_count }}", str(high_severity_count))
-        content = content.replace("{{ start_date }}", start_date)
-        content = content.replace("{{ end_date }}", end_date)
-        content = content.replace("{{ issue_types }}", issue_types)
-        content = content.replace("{{ critical_count }}", str(critical_count))
-        content = content.replace("{{ high_count }}", str(high_count))
-        content = content.replace("{{ medium_count }}", str(medium_count))
-        content = content.replace("{{ low_count }}", str(low_count))
-        content = content.replace("{{ info_count }}", str(info_count))
-        content = content.replace("{{ generated_at }}", report_date)
-        
-        # Process high severity issues table
-        if high_severity_issues:
-            table_rows = []
-            for issue in high_severity_issues:
-                remediation_link = issue.get('remediation_link', 'N/A')
-                app_code_val = issue.get('app_code', 'N/A')
-                component = issue.get('component', 'Unknown')
-                issue_type = issue.get('type', 'Unknown')
-                severity = issue.get('severity', 'Unknown')
-                
-                table_row = f"| {issue_type} | {severity} | {component} | {app_code_val} | {remediation_link} |"
-                table_rows.append(table_row)
-            
-            # Replace the template loop with actual table rows
-            loop_pattern = "{% for issue in high_severity_issues %}\n| {{ issue.type }} | {{ issue.severity }} | {{ issue.component }} | {{ issue.app_code | default('N/A') }} | {{ issue.remediation_link | default('N/A') }} |\n{% endfor %}"
-            table_content = "\n".join(table_rows)
-            content = content.replace(loop_pattern, table_content)
-        else:
-            # Remove the entire table section if no high severity issues
-            start_marker = "{% for issue in high_severity_issues %}"
-            end_marker = "{% endfor %}"
-            start_pos = content.find(start_marker)
-            end_pos = content.find(end_marker)
-            if start_pos != -1 and end_pos != -1:
-                content = content[:start_pos] + "No high severity issues found." + content[end_pos + len(end_marker):]
-        
-        # Process non-compliant apps section
-        if non_compliant_apps:
-            # Keep the non-compliant apps section
-            content = content.replace("{% if non_compliant_apps %}", "")
-            content = content.replace("{% endif %}", "")
-            
-            # Process reasons loop
-            if non_compliant_apps:
-                reasons = non_compliant_apps[0]["reasons"]
-                reasons_text = "\n".join([f"- {reason}" for reason in reasons])
-                
-                # Replace the reasons loop
-                reasons_pattern = "{% for reason in non_compliant_apps[0].reasons %}\n- {{ reason }}\n{% endfor %}"
-                content = content.replace(reasons_pattern, reasons_text)
-                
-                # Replace severity counts for non-compliant apps
-                severity_counts_nc = non_compliant_apps[0]["severity_counts"]
-                content = content.replace("{{ non_compliant_apps[0].severity_counts.critical }}", str(severity_counts_nc.get("critical", 0)))
-                content = content.replace("{{ non_compliant_apps[0].severity_counts.high }}", str(severity_counts_nc.get("high", 0)))
-                content = content.replace("{{ non_compliant_apps[0].severity_counts.medium }}", str(severity_counts_nc.get("medium", 0)))
-                content = content.replace("{{ non_compliant_apps[0].severity_counts.low }}", str(severity_counts_nc.get("low", 0)))
-                content = content.replace("{{ non_compliant_apps[0].severity_counts.info }}", str(severity_counts_nc.get("info", 0)))
-        else:
-            # Remove the entire non-compliant apps section
-            start_marker = "{% if non_compliant_apps %}"
-            end_marker = "{% endif %}"
-            start_pos = content.find(start_marker)
-            end_pos = content.find(end_marker)
-            if start_pos != -1 and end_pos != -1:
-                content = content[:start_pos] + content[end_pos + len(end_marker):]
-        
-        return content
+        return template.render(build_email_context(data))
     except Exception as e:
         print(f"ERROR: Failed to prepare email content: {str(e)}")
         return None
 
+def write_email_content(template_file, report_file, email_output, metrics=None):
+    """Render the email of a processed report and save it, returning whether it was saved"""
+    if metrics is None:
+        metrics = StageMetrics("process")
+    with metrics.timer("email"):
+        email_content = prepare_email_content(template_file, report_file)
+    if not email_content:
+        return False
+    try:
+        with open(email_output, 'w') as f:
+            f.write(email_content)
+        metrics.record_output(email_output)
+        print(f"Email content generated and saved to {email_output}")
+        return True
+    except Exception as e:
+        print(f"ERROR: Failed to save email content: {str(e)}")
+        return False
+
+def report_cache_key(input_file, store_file=None, issue_type=None, rules_file=None):
+    """Get the build cache key of a report: its input data, its dates, its rules and the code building it"""
+    if store_file:
+        # Imported here because snapshot_store imports this module
+        from snapshot_store import SnapshotStore
+        store = SnapshotStore(store_file, readonly=True)
+        try:
+            source = [store.digest(issue_type), store_partial_marker(store, issue_type)]
+        finally:
+            store.close()
+    else:
+        source = file_digest(input_file)
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    return build_key("report", source, issue_type, report_dates(), rules_file and file_digest(rules_file),
+                     file_digest(__file__), file_digest(os.path.join(code_dir, 'compliance_rules.py')),
+                     file_digest(os.path.join(code_dir, 'columnar.py')))
+
+def email_cache_key(template_file, report_file):
+    """Get the build cache key of an email: its report, its template and the code rendering it"""
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    return build_key("email", file_digest(report_file), file_digest(template_file),
+                     file_digest(__file__), file_digest(os.path.join(code_dir, 'template_engine.py')))
+
+def cached_build(cache, output_file, get_key, build, metrics):
+    """Run build() unless the build cache has output_file as built from inputs with the same key
+    
+    Returns whether output_file is available. A key that cannot be worked
+    out just means building as if there were no cache.
+    """
+    key = None
+    if cache is not None:
+        with metrics.timer("cache"):
+            try:
+                key = get_key()
+                if cache.is_fresh(output_file, key):
+                    print(f"{output_file} is up to date, skipping")
+                    metrics.count("cached_outputs")
+                    metrics.record_output(output_file)
+                    return True
+            except Exception as e:
+                print(f"Warning: Build cache check failed for {output_file}: {str(e)}")
+            cache.forget(output_file)
+    success = build()
+    if success and key is not None:
+        cache.record(output_file, key)
+    return success
+
+def build_report(input_file, output_file, store_file=None, issue_type=None, template_file=None,
+                 email_output=None, metrics=None, cache=None, rules_file=None):
+    """Generate a report and, given a template and email output, its email content
+    
+    With a build cache, the report is only regenerated when its input data,
+    dates, rules or code changed since it was last built, and the email
+    only when the report, template or rendering code did. Returns whether
+    the report is available.
+    """
+    if metrics is None:
+        metrics = StageMetrics("process")
+    success = cached_build(
+        cache, output_file, partial(report_cache_key, input_file, store_file, issue_type, rules_file),
+        partial(generate_report, input_file, output_file, store_file, issue_type, metrics, rules_file), metrics)
+    if success and template_file and email_output:
+        cached_build(
+            cache, email_output, partial(email_cache_key, template_file, output_file),
+            partial(write_email_content, template_file, output_file, email_output, metrics), metrics)
+    return success
+
+def partition_paths(issue_type, output_dir, input_template=None):
+    """Get the raw data, processed report and email content paths of one issue type"""
+    return (
+        input_template.format(issue_type=issue_type) if input_template else None,
+        os.path.join(output_dir, f"{issue_type}_report_processed.json"),
+        os.path.join(output_dir, f"{issue_type}_email_content.txt")
+    )
+
+def process_partition(issue_type, output_dir, input_template=None, store_file=None, template_file=None,
+                      cache_dir=None, rules_file=None):
+    """Generate the report and email content of one issue type
+    
+    Outputs whose inputs are unchanged in the build cache at cache_dir, if
+    one is given, are kept as they are. Runs in a worker process, so its
+    output and metrics are captured and returned as (success, output,
+    metrics report) for the parent to print in issue type order.
+    """
+    input_file, output_file, email_output = partition_paths(issue_type, output_dir, input_template)
+    metrics = StageMetrics(issue_type)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        if store_file is None and not os.path.exists(input_file):
+            print(f"Warning: Raw data file {input_file} not found, skipping")
+            success = False
+        else:
+            success = build_report(input_file, output_file, store_file, issue_type if store_file else None,
+                                   template_file, email_output, metrics,
+                                   BuildCache(cache_dir) if cache_dir else None, rules_file)
+    return success, output.getvalue(), metrics.report(success)
+
+def print_partition_results(issue_types, results, metrics):
+    """Print the output of each partition in order, returning the issue types that failed
+    
+    results holds one callable per issue type returning (success, output,
+    metrics report); the reports are added to metrics as its partitions.
+    """
+    failed = []
+    for issue_type, result in zip(issue_types, results):
+        print(f"Issue type: {issue_type}")
+        try:
+            success, output, report = result()
+        except Exception as e:
+            success, output, report = False, f"ERROR: Failed to process {issue_type}: {str(e)}\n", None
+        print(output, end='')
+        if not success:
+            failed.append(issue_type)
+        if report is not None:
+            metrics.partitions[issue_type] = report
+            for name, value in report["counters"].items():
+                metrics.count(name, value)
+            for name, seconds in report["timings"].items():
+                metrics.add_time(name, seconds)
+            metrics.outputs.update(report["outputs"])
+    return failed
+
+def process_partitions(issue_types, output_dir, input_template=None, store_file=None,
+                       template_file=None, workers=0, metrics=None, cache_dir=None, rules_file=None):
+    """Generate the reports and email contents of several issue types in parallel
+    
+    Issue types are independent, so each is analyzed in its own worker
+    process, up to workers at a time (0 for one per CPU). Returns the issue
+    types whose report could not be generated. Each issue type's metrics
+    are added to metrics when one is given, with timings and counters summed
+    across them. With a cache_dir, the outputs of issue types whose inputs
+    are unchanged are skipped rather than rebuilt.
+    """
+    if metrics is None:
+        metrics = StageMetrics("process")
+    workers = min(workers or os.cpu_count() or 1, len(issue_types))
+    metrics.info.update(issue_types=issue_types, workers=max(1, workers))
+    start = time.monotonic()
+    
+    if workers <= 1:
+        results = [
+            partial(process_partition, issue_type, output_dir, input_template, store_file, template_file,
+                    cache_dir, rules_file)
+            for issue_type in issue_types
+        ]
+        failed = print_partition_results(issue_types, results, metrics)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(process_partition, issue_type, output_dir, input_template,
+                                store_file, template_file, cache_dir, rules_file)
+                for issue_type in issue_types
+            ]
+            failed = print_partition_results(issue_types, [future.result for future in futures], metrics)
+    
+    print(f"Processed {len(issue_types) - len(failed)} of {len(issue_types)} issue types "
+          f"on {max(1, workers)} worker process(es) in {time.monotonic() - start:.2f}s")
+    return failed
+
 def main():
     """Main function to process data"""
     parser = argparse.ArgumentParser(description='Process data from Elasticsearch')
-    parser.add_argument('--input', required=True, help='Input JSON file with data')
-    parser.add_argument('--output', required=True, help='Output file for the processed report')
+    parser.add_argument('--input', help='Input JSON or NDJSON (optionally gzipped) file with data')
+    parser.add_argument('--store', help='Snapshot store to read documents from instead of --input')
+    parser.add_argument('--issue-type', help='Only process documents of this issue type from --store')
+    parser.add_argument('--output', help='Output file for the processed report')
+    parser.add_argument('--issue-types', nargs='+',
+                        help='Process these issue types in parallel, one report and email per issue type')
+    parser.add_argument('--input-template',
+                        help='Raw data file of each of --issue-types, e.g. "output/{issue_type}_report_raw.json"')
+    parser.add_argument('--output-dir', help='Directory for the reports and emails of --issue-types')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Worker processes for --issue-types (0 for one per CPU)')
     parser.add_argument('--email-template', help='Email template file for notifications')
     parser.add_argument('--email-output', help='Output file for the email content')
+    parser.add_argument('--metrics', help='Output file for the stage timing and memory metrics')
+    parser.add_argument('--build-cache',
+                        help='Build cache directory; reports and emails whose inputs are unchanged are skipped')
+    parser.add_argument('--rules', help='JSON compliance rules file (default: the built-in severity thresholds)')
     
     args = parser.parse_args()
+    metrics = StageMetrics("process")
     
-    success = generate_report(args.input, args.output)
+    if args.rules:
+        try:
+            load_compliance_rules(args.rules)
+        except ValueError as e:
+            print(f"ERROR: {str(e)}")
+            return 1
     
-    if success and args.email_template and args.email_output:
-        email_content = prepare_email_content(args.email_template, args.output)
-        if email_content:
-            try:
-                with open(args.email_output, 'w') as f:
-                    f.write(email_content)
-                print(f"Email content generated and saved to {args.email_output}")
-            except Exception as e:
-                print(f"ERROR: Failed to save email content: {str(e)}")
+    if args.issue_types:
+        if not args.output_dir:
+            parser.error('--issue-types requires --output-dir')
+        if not args.input_template and not args.store:
+            parser.error('--issue-types requires one of --input-template or --store')
+        failed = process_partitions(args.issue_types, args.output_dir, args.input_template,
+                                    args.store, args.email_template, args.workers, metrics,
+                                    args.build_cache, args.rules)
+        success = not failed
+    else:
+        if not args.output:
+            parser.error('--output is required without --issue-types')
+        if not args.input and not args.store:
+            parser.error('one of --input or --store is required')
+        
+        success = build_report(args.input, args.output, args.store, args.issue_type, args.email_template,
+                               args.email_output, metrics, BuildCache(args.build_cache) if args.build_cache else None,
+                               args.rules)
+    
+    if args.metrics:
+        metrics.write(args.metrics, success)
     
     return 0 if success else 1
 
 if __name__ == "__main__":
-    sys.exit(main()) 
+    sys.exit(main())
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, timezone
+
+from process_data import (SEVERITY_LEVELS, describe_partial, get_custodian_issues, load_compliance_rules,
+                          rehydrate_issues, resolve_severity)
+from snapshot_store import SnapshotStore
+from template_engine import load_template
+
+DEFAULT_RECIPIENT = "compliance-team@company.com"
+
+def build_custodian_index(custodians):
+    """Map each app code to the key of the first custodian that owns it"""
+    index = {}
+    for custodian_key, custodian in custodians.items():
+        for app_code in custodian.get('app_codes', []):
+            index.setdefault(app_code, custodian_key)
+    return index
+
+def merge_app_entries(app_codes):
+    """Fold summary.app_codes entries into one entry per app code
+    
+    combine_reports.py already writes one entry per app code, but older
+    combined reports list the same app once per issue type; issue types,
+    severity counts, issue counts and issue ids are merged so each app gets
+    one email. The issue count and rule counts are None if a report
+    predates them. The compliance verdict of combine_reports.py is kept for
+    apps with a single entry; it is None for the others.
+    """
+    apps = {}
+    for entry in app_codes:
+        app = apps.get(entry['app_code'])
+        if app is None:
+            app = apps[entry['app_code']] = {
+                'app_code': entry['app_code'],
+                'issue_types': [],
+                'severity_counts': {level: 0 for level in SEVERITY_LEVELS},
+                'issue_count': 0,
+                'issue_ids': [],
+                'rule_counts': {},
+                'compliance': entry.get('compliance')
+            }
+        else:
+            app['compliance'] = None
+        for issue_type in entry.get('issue_types', []):
+            if issue_type not in app['issue_types']:
+                app['issue_types'].append(issue_type)
+        for level, count in entry.get('severity_counts', {}).items():
+            app['severity_counts'][level] = app['severity_counts'].get(level, 0) + count
+        if app['issue_count'] is not None and entry.get('issue_count') is not None:
+            app['issue_count'] += entry['issue_count']
+        else:
+            app['issue_count'] = None
+        app['issue_ids'].extend(entry.get('issue_ids', []))
+        if app['rule_counts'] is not None and entry.get('rule_counts') is not None:
+            for name, count in entry['rule_counts'].items():
+                app['rule_counts'][name] = app['rule_counts'].get(name, 0) + count
+        else:
+            app['rule_counts'] = None
+    return apps
+
+def get_issues_for_app(report, app, custodian_key, store=None):
+    """Get the issue records of one app, falling back to its custodian's embedded issues
+    
+    With a snapshot store the records are read from it by app code instead.
+    """
+    if store is not None:
+        return [dict(hit['_source'], _id=hit['_id']) for hit in store.hits_for_app(app['app_code'])]
+    if app['issue_ids']:
+        return rehydrate_issues(report, app['issue_ids'])
+    if custodian_key is None:
+        return []
+    return [
+        issue for issue in get_custodian_issues(report, custodian_key)
+        if issue.get('appCode', app['app_code']) == app['app_code']
+    ]
+
+def app_compliance(app, rules):
+    """Check an app without a combined compliance verdict against the compliance rules"""
+    is_compliant, reasons = rules.evaluate(app['app_code'],
+                                           rules.counts_from_report(app.get('rule_counts'), app['severity_counts']))
+    return {'is_compliant': is_compliant, 'reasons': reasons}
+
+def build_app_email_context(app, issues, report_date, generated_at, incomplete_data="", changes="", rules=None):
+    """Build the email template variables for one app code
+    
+    Reports built from aggregations only carry the high severity issues, so
+    the total comes from the app's issue count when it has one.
+    incomplete_data names the issue types fetched incompletely, if any, and
+    changes describes the app's changes since the last notified run.
+    Apps without a combined compliance verdict are checked against rules,
+    by default the built-in severity thresholds.
+    """
+    severity_counts = app['severity_counts']
+    high_severity_issues = [
+        {
+            'type': issue.get('issueType') or 'N/A',
+            'severity': resolve_severity(issue).upper(),
+            'component': issue.get('affectedItemName') or 'N/A',
+            'app_code': app['app_code'],
+            'fix_by_date': issue.get('fixByDate') or 'N/A',
+            'remediation_link': issue.get('solution') or 'N/A'
+        }
+        for issue in issues
+        if resolve_severity(issue) in ('critical', 'high')
+    ]
+    
+    compliance = app.get('compliance') or app_compliance(app, rules or load_compliance_rules())
+    non_compliant_app = None
+    if not compliance['is_compliant']:
+        non_compliant_app = {
+            'reasons': compliance['reasons'],
+            'severity_counts': severity_counts
+        }
+    
+    return {
+        "report_date": report_date,
+        "app_code": app['app_code'],
+        "start_date": report_date,
+        "end_date": report_date,
+        "generated_at": generated_at,
+        "total_issues": app['issue_count'] if app.get('issue_count') is not None else len(issues),
+        "high_severity_count": len(high_severity_issues),
+        "issue_types": ", ".join(app['issue_types']),
+        "critical_count": severity_counts.get('critical', 0),
+        "high_count": severity_counts.get('high', 0),
+        "medium_count": severity_counts.get('medium', 0),
+        "low_count": severity_counts.get('low', 0),
+        "info_count": severity_counts.get('info', 0),
+        "high_severity_issues": high_severity_issues,
+        "non_compliant_app": non_compliant_app,
+        "incomplete_data": incomplete_data,
+        "changes": changes,
+    }
+
+def resolved_app_entry(app_code):
+    """Build the app entry of an app whose issues were all resolved since the last notified run"""
+    return {
+        'app_code': app_code,
+        'issue_types': [],
+        'severity_counts': {level: 0 for level in SEVERITY_LEVELS},
+        'issue_count': 0,
+        'issue_ids': [],
+        'compliance': {'is_compliant': True, 'reasons': []}
+    }
+
+def render_app_emails(report_file, template_file, output_dir, manifest_file=None,
+                      fallback_recipient=DEFAULT_RECIPIENT, store_file=None, delta_file=None, rules_file=None):
+    """Render one email per app code from a combined report and write a send manifest
+    
+    With a delta from diff_reports.py only the apps with material changes
+    since the last notified run get an email, including apps whose issues
+    were all resolved, and each email says what changed; a digest delta
+    still renders every app. Apps without a combined compliance verdict
+    are checked against the rules of rules_file, which should be the rules
+    the report was built with. Returns the manifest entries in report order.
+    """
+    with open(report_file, 'r') as f:
+        report = json.load(f)
+    
+    template = load_template(template_file)
+    rules = load_compliance_rules(rules_file)
+    custodians = report.get('custodian', {})
+    custodian_index = build_custodian_index(custodians)
+    apps = merge_app_entries(report.get('summary', {}).get('app_codes', []))
+    store = SnapshotStore(store_file, readonly=True) if store_file else None
+    # Any missing documents could belong to any app, so every email says so
+    incomplete_data = describe_partial(report.get('partial', []))
+    
+    delta_apps = None
+    notify_all = True
+    if delta_file:
+        with open(delta_file) as f:
+            delta = json.load(f)
+        delta_apps = delta.get('apps', {})
+        notify_all = delta.get('digest', False)
+        for app_code, entry in delta_apps.items():
+            if entry['status'] == "resolved" and app_code not in apps:
+                apps[app_code] = resolved_app_entry(app_code)
+    
+    now = datetime.now()
+    report_date = now.strftime("%Y-%m-%d")
+    generated_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    
+    manifest = []
+    skipped = 0
+    for app_code, app in apps.items():
+        change = delta_apps.get(app_code) if delta_apps is not None else None
+        if delta_apps is not None and not notify_all and not (change and change['material']):
+            skipped += 1
+            continue
+        
+        custodian_key = custodian_index.get(app_code)
+        custodian = custodians.get(custodian_key, {})
+        custodian_email = custodian_key if custodian.get('has_email') else None
+        custodian_name = custodian.get('custodian_name', 'Unknown Custodian')
+        if change and change['status'] == "resolved":
+            # No longer in the report: no issues left, and the custodian is the baseline's
+            custodian_email = change.get('custodian_email')
+            custodian_name = change.get('custodian_name') or custodian_name
+            issues = []
+        else:
+            issues = get_issues_for_app(report, app, custodian_key, store)
+        context = build_app_email_context(app, issues, report_date, generated_at, incomplete_data,
+                                          change['summary'] if change else "", rules)
+        
+        body_file = os.path.join(output_dir, f"{app_code}_email_content.txt")
+        with open(body_file, 'w') as f:
+            f.write(template.render(context))
+        
+        manifest.append({
+            "app_code": app_code,
+            "custodian_name": custodian_name,
+            "custodian_email": custodian_email,
+            "recipient": custodian_email or fallback_recipient,
+            "subject": f"Server Compliance Report - {report_date} - {app_code}",
+            "body_file": body_file,
+            "total_issues": context["total_issues"],
+            "high_severity_count": context["high_severity_count"],
+            "incomplete_data": incomplete_data,
+            "change": change['status'] if change else None
+        })
+    
+    if store is not None:
+        store.close()
+    
+    if manifest_file is None:
+        manifest_file = os.path.join(output_dir, "email_manifest.json")
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    
+    print(f"Rendered {len(manifest)} app emails to {output_dir}")
+    if skipped:
+        print(f"Skipped {skipped} apps without material changes since the last notified run")
+    if incomplete_data:
+        print(f"Warning: Emails note incomplete data for {incomplete_data}")
+    print(f"Email manifest saved to {manifest_file}")
+    return manifest
+
+def main():
+    """Main function to render all app emails"""
+    parser = argparse.ArgumentParser(description='Render per-app custodian emails from a combined report')
+    parser.add_argument('--report', required=True, help='Combined processed report JSON file')
+    parser.add_argument('--email-template', required=True, help='Email template file')
+    parser.add_argument('--output-dir', required=True, help='Directory for the <app_code>_email_content.txt files')
+    parser.add_argument('--manifest', help='Output file for the email manifest (default: <output-dir>/email_manifest.json)')
+    parser.add_argument('--fallback-recipient', default=DEFAULT_RECIPIENT,
+                        help='Recipient for apps whose custodian has no email')
+    parser.add_argument('--store', help='Snapshot store to read each app\'s issues from')
+    parser.add_argument('--delta', help='Per-app delta from diff_reports.py; only changed apps are rendered')
+    parser.add_argument('--rules', help='JSON compliance rules file (default: the built-in severity thresholds)')
+    
+    args = parser.parse_args()
+    
+    try:
+        render_app_emails(args.report, args.email_template, args.output_dir,
+                          args.manifest, args.fallback_recipient, args.store, args.delta, args.rules)
+    except Exception as e:
+        print(f"ERROR: Failed to render app emails: {str(e)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlsplit
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Stage metrics files collected from a metrics directory, in pipeline order
+STAGE_ORDER = ["fetch", "process", "combine"]
+
+# Run report figures compared against the baseline, as (label, path) pairs
+# into each stage report
+COMPARED_METRICS = [
+    ("wall_seconds", ("wall_seconds",)),
+    ("cpu_seconds", ("cpu_seconds",)),
+    ("peak_rss_bytes", ("peak_rss_bytes",)),
+    ("request_seconds", ("requests", "seconds")),
+    ("bytes_received", ("requests", "bytes_received")),
+]
+
+def in_shared_process():
+    """Whether this stage runs inside pipeline_daemon.py, which sets PIPELINE_DAEMON for its stages"""
+    return bool(os.environ.get("PIPELINE_DAEMON"))
+
+def peak_rss_bytes(who="self"):
+    """Get the peak resident set size of this process or of its waited-for children"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if who == "children" else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+def cpu_seconds():
+    """Get the user plus system CPU time of this process and its waited-for children"""
+    if resource is None:
+        return round(time.process_time(), 3)
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return round(total, 3)
+
+def percentile(values, fraction):
+    """Get the nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class StageMetrics:
+    """Timings, counters, request log and output sizes of one pipeline stage
+    
+    Safe to update from several threads. report() adds the wall and CPU
+    time since the stage started and the peak RSS, and write() saves it as
+    the stage's JSON metrics file.
+    
+    The peak RSS of a process cannot be reset, so in pipeline_daemon.py it
+    covers every stage the daemon ran so far. There the per-stage peak RSS
+    figures are None, which keeps them out of run comparisons, and the
+    daemon's lifetime peak is reported as daemon_peak_rss_bytes instead.
+    """
+    
+    def __init__(self, stage):
+        self.stage = stage
+        self.reset()
+    
+    def reset(self):
+        """Start the stage over, dropping everything recorded so far"""
+        self.started_at = datetime.now().isoformat()
+        self.start = time.monotonic()
+        self.cpu_start = cpu_seconds()
+        self.info = {}
+        self.timings = {}
+        self.counters = {}
+        self.requests = []
+        self.outputs = {}
+        self.partitions = {}
+        self._lock = threading.Lock()
+    
+    def add_time(self, name, seconds):
+        """Add seconds to a named timing"""
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+    
+    @contextmanager
+    def timer(self, name, exclude=()):
+        """Time a block into a named timing, minus the time the block spent in the excluded timings"""
+        excluded = sum(self.timings.get(other, 0.0) for other in exclude)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            elapsed -= sum(self.timings.get(other, 0.0) for other in exclude) - excluded
+            self.add_time(name, elapsed)
+    
+    def timed_iter(self, name, items, counter=None):
+        """Yield from items, timing how long producing each one takes
+        
+        The number of items yielded is added to counter once they run out.
+        """
+        iterator = iter(items)
+        produced = 0
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.monotonic() - start)
+                if counter:
+                    self.count(counter, produced)
+                return
+            self.add_time(name, time.monotonic() - start)
+            produced += 1
+            yield item
+    
+    def count(self, name, value=1):
+        """Add value to a named counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def record_request(self, method, url, status, seconds, bytes_received, error=None):
+        """Log one HTTP request"""
+        entry = {
+            "method": method,
+            "path": urlsplit(url).path,
+            "status": status,
+            "seconds": round(seconds, 4),
+            "bytes": bytes_received
+        }
+        if error is not None:
+            entry["error"] = error
+        with self._lock:
+            self.requests.append(entry)
+    
+    def record_output(self, path):
+        """Record the size of an output file"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        with self._lock:
+            self.outputs[str(path)] = size
+    
+    def request_summary(self):
+        """Summarize the request log"""
+        seconds = sorted(entry["seconds"] for entry in self.requests)
+        return {
+            "count": len(self.requests),
+            "errors": sum(1 for entry in self.requests
+                          if entry["status"] is None or entry["status"] >= 400),
+            "seconds": round(sum(seconds), 3),
+            "bytes_received": sum(entry["bytes"] or 0 for entry in self.requests),
+            "p50_seconds": percentile(seconds, 0.5),
+            "p95_seconds": percentile(seconds, 0.95),
+            "max_seconds": seconds[-1] if seconds else None,
+            "log": self.requests
+        }
+    
+    def report(self, success=None):
+        """Build the stage report"""
+        wall_seconds = time.monotonic() - self.start
+        report = {
+            "stage": self.stage,
+            "started_at": self.started_at,
+            "finished_at": datetime.now().isoformat(),
+            "success": success,
+            "wall_seconds": round(wall_seconds, 3),
+            "cpu_seconds": round(cpu_seconds() - self.cpu_start, 3),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "peak_rss_children_bytes": peak_rss_bytes("children"),
+            "info": self.info,
+            "timings": {name: round(seconds, 3) for name, seconds in self.timings.items()},
+            "counters": self.counters,
+            "outputs": self.outputs
+        }
+        if in_shared_process():
+            report["daemon_peak_rss_bytes"] = report["peak_rss_bytes"]
+            report["peak_rss_bytes"] = report["peak_rss_children_bytes"] = None
+        if "documents" in self.counters and wall_seconds > 0:
+            report["documents_per_second"] = round(self.counters["documents"] / wall_seconds, 1)
+        if self.requests:
+            report["requests"] = self.request_summary()
+        if self.partitions:
+            report["partitions"] = self.partitions
+        return report
+    
+    def write(self, path, success=None):
+        """Save the stage report as JSON, returning it"""
+        report = self.report(success)
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"Metrics saved to {path}")
+        except Exception as e:
+            print(f"Warning: Failed to save metrics to {path}: {str(e)}")
+        return report
+
+def instrument_session(session, metrics):
+    """Log the wall time, status and response size of every request made through a requests session
+    
+    The response body is read inside the timing, so the wall time covers
+    the whole transfer rather than just the response headers. The size is
+    the Content-Length sent, i.e. the compressed size of a gzipped response,
+    or the body size when there is none.
+    """
+    request = session.request
+    
+    def timed_request(method, url, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            response = request(method, url, *args, **kwargs)
+            body = response.content
+        except Exception as e:
+            metrics.record_request(method, url, None, time.monotonic() - start, 0, type(e).__name__)
+            raise
+        length = response.headers.get("Content-Length")
+        metrics.record_request(method, url, response.status_code, time.monotonic() - start,
+                               int(length) if length else len(body))
+        return response
+    
+    session.request = timed_request
+    return session
+
+def get_path(report, path):
+    """Follow a path of keys into a report, or return None where it stops"""
+    for key in path:
+        if not isinstance(report, dict):
+            return None
+        report = report.get(key)
+    return report
+
+def compare_runs(run, baseline, threshold=0.25):
+    """List the stage figures that grew by more than threshold since the baseline run"""
+    regressions = []
+    for stage, report in run["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if previous is None:
+            continue
+        names = [(label, path) for label, path in COMPARED_METRICS]
+        names += [(f"timings.{name}", ("timings", name)) for name in report.get("timings", {})]
+        for label, path in names:
+            current, before = get_path(report, path), get_path(previous, path)
+            if not isinstance(current, (int, float)) or not isinstance(before, (int, float)) or before <= 0:
+                continue
+            change = (current - before) / before
+            if change > threshold:
+                regressions.append({
+                    "stage": stage,
+                    "metric": label,
+                    "baseline": before,
+                    "current": current,
+                    "change": round(change, 3)
+                })
+    return regressions
+
+def collect_run(metrics_dir):
+    """Collect the stage metrics files of one run into a run report"""
+    stages = {}
+    for metrics_file in sorted(Path(metrics_dir).glob('*_metrics.json')):
+        try:
+            with open(metrics_file) as f:
+                report = json.load(f)
+        except Exception as e:
+            print(f"Warning: Could not read {metrics_file}: {e}")
+            continue
+        stages[report.get("stage", metrics_file.stem)] = report
+    
+    ordered = sorted(stages, key=lambda stage: (
+        STAGE_ORDER.index(stage) if stage in STAGE_ORDER else len(STAGE_ORDER), stage))
+    return {
+        "generated_at": datetime.now().isoformat(),
+        "wall_seconds": round(sum(stages[stage].get("wall_seconds") or 0 for stage in ordered), 3),
+        "peak_rss_bytes": max((stages[stage]["peak_rss_bytes"] for stage in ordered
+                               if stages[stage].get("peak_rss_bytes") is not None), default=None),
+        "stages": {stage: stages[stage] for stage in ordered}
+    }
+
+def main():
+    """Main function to collect stage metrics into a run report and compare it with the previous run"""
+    parser = argparse.ArgumentParser(description='Collect per-stage metrics into a run report')
+    parser.add_argument('--metrics-dir', required=True, help='Directory holding the <stage>_metrics.json files')
+    parser.add_argument('--output', required=True, help='Output file for the run report')
+    parser.add_argument('--baseline', help='Run report of a previous run to compare against (may be --output)')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Relative growth reported as a regression (default 0.25)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit 1 if any regression is found')
+    
+    args = parser.parse_args()
+    
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except Exception as e:
+            print(f"Warning: Could not read baseline {args.baseline}: {e}")
+    
+    run = collect_run(args.metrics_dir)
+    run["regressions"] = compare_runs(run, baseline, args.threshold) if baseline else []
+    
+    with open(args.output, 'w') as f:
+        json.dump(run, f, indent=2)
+    
+    for stage, report in run["stages"].items():
+        peak_rss = f"{report['peak_rss_bytes'] / 1048576:.1f} MiB" if report.get('peak_rss_bytes') is not None \
+            else "not measured per stage"
+        print(f"{stage}: {report.get('wall_seconds')}s wall, {report.get('cpu_seconds')}s CPU, peak RSS {peak_rss}")
+    for regression in run["regressions"]:
+        print(f"REGRESSION: {regression['stage']} {regression['metric']} "
+              f"{regression['baseline']} -> {regression['current']} (+{regression['change']:.0%})")
+    print(f"Run report saved to {args.output}")
+    
+    return 1 if args.fail_on_regression and run["regressions"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import queue
+import smtplib
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+
+def get_env_var(var_name, default=None, required=False):
+    """Get environment variable or return default value"""
+    value = os.environ.get(var_name, default)
+    if required and value is None:
+        print(f"ERROR: Required environment variable {var_name} is not set.")
+        sys.exit(1)
+    return value
+
+class SMTPConnectionPool:
+    """A fixed-size pool of persistent SMTP connections
+    
+    Connections are opened lazily up to size, authenticated once and reused
+    for every message. A connection that fails is discarded and replaced on
+    the next acquire().
+    """
+    
+    def __init__(self, host, port, size=1, username=None, password=None,
+                 starttls=False, use_ssl=False, timeout=30):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.connections_opened = 0
+        self._idle = queue.Queue()
+        self._open = 0
+        self._lock = threading.Lock()
+    
+    def connect(self):
+        """Open and authenticate a new SMTP connection"""
+        if self.use_ssl:
+            connection = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                connection.starttls()
+        if self.username and self.password:
+            connection.login(self.username, self.password)
+        return connection
+    
+    def acquire(self):
+        """Take an idle connection, opening a new one while the pool is below size"""
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            
+            with self._lock:
+                if self._open < self.size:
+                    self._open += 1
+                    break
+            
+            # Pool is full: wait for a release, re-checking in case a broken
+            # connection was dropped and freed a slot instead
+            try:
+                return self._idle.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        
+        try:
+            connection = self.connect()
+        except Exception:
+            with self._lock:
+                self._open -= 1
+            raise
+        with self._lock:
+            self.connections_opened += 1
+        return connection
+    
+    def release(self, connection, broken=False):
+        """Return a connection to the pool, or drop it if it failed"""
+        if not broken:
+            self._idle.put(connection)
+            return
+        
+        with self._lock:
+            self._open -= 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+    
+    def close(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                connection.quit()
+            except Exception:
+                pass
+
+class RateLimiter:
+    """Space sends evenly so no more than rate messages start per second"""
+    
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate else 0
+        self._next_time = 0
+        self._lock = threading.Lock()
+    
+    def wait(self):
+        """Block until the next send slot"""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_time)
+            self._next_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def build_message(sender, recipient, subject, body, attachments=None):
+    """Build a plain-text email with optional file attachments"""
+    message = MIMEMultipart()
+    message['From'] = sender
+    message['To'] = recipient
+    message['Subject'] = subject
+    message.attach(MIMEText(body, 'plain', 'utf-8'))
+    
+    for attachment in attachments or []:
+        with open(attachment, 'rb') as f:
+            part = MIMEApplication(f.read(), Name=os.path.basename(attachment))
+        part['Content-Disposition'] = f'attachment; filename="{os.path.basename(attachment)}"'
+        message.attach(part)
+    
+    return message
+
+def is_permanent_failure(error):
+    """Whether retrying a failed send cannot succeed (5xx replies, refused recipients)"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+def send_with_retry(pool, limiter, message, max_retries=3, backoff=1.0):
+    """Send one message over a pooled connection, retrying transient failures
+    
+    Returns (attempts, error); error is None when the message was accepted.
+    Retries wait backoff * 2 ** (attempt - 1) seconds on a fresh connection.
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        limiter.wait()
+        connection = None
+        try:
+            connection = pool.acquire()
+            connection.send_message(message)
+            pool.release(connection)
+            return attempts, None
+        except (smtplib.SMTPException, OSError) as e:
+            if connection is not None:
+                # A reply from the server means the connection is still usable,
+                # except 421, on which smtplib closes it
+                replied = isinstance(e, smtplib.SMTPRecipientsRefused) or \
+                    (isinstance(e, smtplib.SMTPResponseException) and e.smtp_code != 421)
+                pool.release(connection, broken=not replied)
+            if attempts > max_retries or is_permanent_failure(e):
+                return attempts, f"{type(e).__name__}: {e}"
+            time.sleep(backoff * 2 ** (attempts - 1))
+
+def deliver(entry, pool, limiter, sender, max_retries, backoff):
+    """Build and send one manifest entry, returning its delivery result"""
+    start = time.monotonic()
+    try:
+        with open(entry['body_file'], 'r') as f:
+            body = f.read()
+        message = build_message(sender, entry['recipient'], entry['subject'], body,
+                                entry.get('attachments'))
+    except Exception as e:
+        attempts, error = 0, f"{type(e).__name__}: {e}"
+    else:
+        attempts, error = send_with_retry(pool, limiter, message, max_retries, backoff)
+    
+    return {
+        "app_code": entry.get('app_code'),
+        "recipient": entry['recipient'],
+        "subject": entry['subject'],
+        "status": "sent" if error is None else "failed",
+        "attempts": attempts,
+        "error": error,
+        "seconds": round(time.monotonic() - start, 3)
+    }
+
+def send_manifest(manifest, pool, sender, concurrency=4, max_retries=3, backoff=1.0, rate_limit=0):
+    """Send every manifest entry with at most concurrency messages in flight
+    
+    Returns one delivery result per entry, in manifest order.
+    """
+    limiter = RateLimiter(rate_limit)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [
+            executor.submit(deliver, entry, pool, limiter, sender, max_retries, backoff)
+            for entry in manifest
+        ]
+        return [future.result() for future in futures]
+
+def main():
+    """Main function to send rendered emails from a manifest"""
+    parser = argparse.ArgumentParser(description='Send rendered emails over pooled SMTP connections')
+    parser.add_argument('--manifest', required=True, help='Email manifest JSON file from render_emails.py')
+    parser.add_argument('--delivery-report', required=True, help='Output file for the delivery report')
+    parser.add_argument('--smtp-host', default=get_env_var("SMTP_HOST", "localhost"), help='SMTP server host')
+    parser.add_argument('--smtp-port', type=int, default=int(get_env_var("SMTP_PORT", "25")), help='SMTP server port')
+    parser.add_argument('--starttls', action='store_true', help='Upgrade connections with STARTTLS')
+    parser.add_argument('--ssl', action='store_true', help='Connect with implicit TLS')
+    parser.add_argument('--sender', default=get_env_var("SMTP_SENDER", "root"), help='From address')
+    parser.add_argument('--concurrency', type=int, default=4, help='SMTP connections and messages in flight')
+    parser.add_argument('--max-retries', type=int, default=3, help='Retries per message on transient failures')
+    parser.add_argument('--backoff', type=float, default=1.0, help='Initial retry delay in seconds, doubled per retry')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Maximum messages per second (0 for no limit)')
+    parser.add_argument('--timeout', type=float, default=30, help='SMTP socket timeout in seconds')
+    
+    args = parser.parse_args()
+    
+    try:
+        with open(args.manifest, 'r') as f:
+            manifest = json.load(f)
+    except Exception as e:
+        print(f"ERROR: Failed to load email manifest: {str(e)}")
+        return 1
+    
+    pool = SMTPConnectionPool(
+        args.smtp_host, args.smtp_port,
+        size=max(1, args.concurrency),
+        username=get_env_var("SMTP_USERNAME", ""),
+        password=get_env_var("SMTP_PASSWORD", ""),
+        starttls=args.starttls,
+        use_ssl=args.ssl,
+        timeout=args.timeout
+    )
+    
+    start = time.monotonic()
+    try:
+        results = send_manifest(manifest, pool, args.sender, args.concurrency,
+                                args.max_retries, args.backoff, args.rate_limit)
+    finally:
+        pool.close()
+    
+    sent = sum(1 for result in results if result["status"] == "sent")
+    report = {
+        "generated_at": datetime.now().isoformat(),
+        "smtp_host": args.smtp_host,
+        "sent": sent,
+        "failed": len(results) - sent,
+        "connections_opened": pool.connections_opened,
+        "seconds": round(time.monotonic() - start, 3),
+        "results": results
+    }
+    
+    try:
+        with open(args.delivery_report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Delivery report saved to {args.delivery_report}")
+    except Exception as e:
+        print(f"ERROR: Failed to save delivery report: {str(e)}")
+    
+    print(f"Sent {sent} of {len(results)} emails over {pool.connections_opened} SMTP connection(s) "
+          f"in {report['seconds']:.2f}s")
+    for result in results:
+        if result["status"] != "sent":
+            print(f"FAILED: {result['app_code']} to {result['recipient']} after "
+                  f"{result['attempts']} attempt(s): {result['error']}")
+    
+    return 0 if sent == len(results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import json
+import hashlib
+import sqlite3
+from pathlib import Path
+
+from process_data import get_custodian, resolve_severity
+
+# One row per document with the fields lookups filter on pulled out into
+# indexed columns; the full _source is kept as JSON
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    app_code TEXT,
+    issue_type TEXT,
+    severity TEXT,
+    priority TEXT,
+    custodian_email TEXT,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_app_code ON documents (app_code);
+CREATE INDEX IF NOT EXISTS documents_issue_type ON documents (issue_type);
+CREATE INDEX IF NOT EXISTS documents_severity ON documents (severity);
+CREATE INDEX IF NOT EXISTS documents_custodian_email ON documents (custodian_email);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Updating in place keeps a document's rowid, so documents are read back in
+# the order they were first fetched
+UPSERT_CONFLICT = """
+ON CONFLICT (id) DO UPDATE SET
+    app_code = excluded.app_code,
+    issue_type = excluded.issue_type,
+    severity = excluded.severity,
+    priority = excluded.priority,
+    custodian_email = excluded.custodian_email,
+    source = excluded.source
+"""
+UPSERT = """
+INSERT INTO documents (id, app_code, issue_type, severity, priority, custodian_email, source)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+""" + UPSERT_CONFLICT
+
+# Rows of documents fetched this run, kept apart from the stored documents
+# until their output file is known to be complete. TEMP tables live only as
+# long as the connection and never lock the store file.
+STAGING_SCHEMA = """
+CREATE TEMP TABLE IF NOT EXISTS staged_documents (
+    output_file TEXT NOT NULL,
+    id TEXT,
+    app_code TEXT,
+    issue_type TEXT,
+    severity TEXT,
+    priority TEXT,
+    custodian_email TEXT,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS temp.staged_documents_output_file ON staged_documents (output_file);
+"""
+
+# The WHERE clause keeps SQLite from reading ON CONFLICT as a join constraint
+LOAD_STAGED = """
+INSERT INTO documents (id, app_code, issue_type, severity, priority, custodian_email, source)
+SELECT id, app_code, issue_type, severity, priority, custodian_email, source
+FROM staged_documents WHERE output_file = ? ORDER BY rowid
+""" + UPSERT_CONFLICT
+
+def document_row(hit):
+    """Build the documents table row of one hit"""
+    source = hit.get('_source', {})
+    custodian_name, custodian_email = get_custodian(source)
+    return (
+        hit['_id'],
+        source.get('appCode'),
+        source.get('issueType'),
+        resolve_severity(source),
+        source.get('priority'),
+        custodian_email,
+        json.dumps(source)
+    )
+
+def terms_buckets(rows):
+    """Turn (key, count) rows into terms aggregation buckets"""
+    return [{"key": key, "doc_count": count} for key, count in rows]
+
+class SnapshotStore:
+    """Local SQLite store of fetched compliance documents
+    
+    Documents are keyed on their id and indexed on app code, issue type,
+    resolved severity and custodian email, so per-app and per-custodian
+    lookups are index reads. Changes are only saved by commit(). A store
+    opened read-only must already exist. A shared store may be used from
+    several threads, which must not use it at the same time.
+    """
+    
+    def __init__(self, path, readonly=False, shared=False):
+        self.path = path
+        self.staging = False
+        if readonly:
+            self.conn = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True,
+                                        check_same_thread=not shared)
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=not shared)
+            self.conn.executescript(SCHEMA)
+    
+    def upsert(self, hits):
+        """Insert or update hits"""
+        self.conn.executemany(UPSERT, (document_row(hit) for hit in hits))
+    
+    def stage(self, output_file, hits):
+        """Stage the hits written to an output file, without changing the stored documents"""
+        if not self.staging:
+            self.conn.executescript(STAGING_SCHEMA)
+            self.staging = True
+        self.conn.executemany(
+            "INSERT INTO staged_documents VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((output_file,) + document_row(hit) for hit in hits)
+        )
+    
+    def load_staged(self, output_file):
+        """Insert or update the hits staged for an output file, in the order they were staged"""
+        if self.staging:
+            self.conn.execute(LOAD_STAGED, (output_file,))
+    
+    def discard_staged(self, output_file=None):
+        """Drop the hits staged for one output file, or every staged hit"""
+        if not self.staging:
+            return
+        if output_file is None:
+            self.conn.execute("DELETE FROM staged_documents")
+        else:
+            self.conn.execute("DELETE FROM staged_documents WHERE output_file = ?", (output_file,))
+    
+    def delete(self, document_id):
+        """Delete one document, returning whether it was stored"""
+        return self.conn.execute("DELETE FROM documents WHERE id = ?", (document_id,)).rowcount > 0
+    
+    def clear(self, issue_type=None):
+        """Delete every document, or every document of one issue type"""
+        if issue_type is None:
+            self.conn.execute("DELETE FROM documents")
+        else:
+            self.conn.execute("DELETE FROM documents WHERE issue_type = ?", (issue_type,))
+    
+    def select(self, where="", params=()):
+        """Yield the hits matching a WHERE clause in fetch order"""
+        cursor = self.conn.execute(f"SELECT id, source FROM documents {where} ORDER BY rowid", params)
+        for document_id, source in cursor:
+            yield {"_id": document_id, "_source": json.loads(source)}
+    
+    def get(self, document_id):
+        """Get one stored hit, or None if it is not stored"""
+        return next(self.select("WHERE id = ?", (document_id,)), None)
+    
+    def iter_hits(self, issue_type=None):
+        """Yield every hit, or every hit of one issue type"""
+        if issue_type is None:
+            return self.select()
+        return self.select("WHERE issue_type = ?", (issue_type,))
+    
+    def hits_for_app(self, app_code):
+        """Get the hits of one app code"""
+        return list(self.select("WHERE app_code = ?", (app_code,)))
+    
+    def hits_for_custodian(self, custodian_email):
+        """Get the hits of one custodian email"""
+        return list(self.select("WHERE custodian_email = ?", (custodian_email,)))
+    
+    def count(self, issue_type=None):
+        """Count every document, or the documents of one issue type"""
+        if issue_type is None:
+            return self.conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        return self.conn.execute("SELECT COUNT(*) FROM documents WHERE issue_type = ?",
+                                 (issue_type,)).fetchone()[0]
+    
+    def digest(self, issue_type=None):
+        """Get a SHA-256 hex digest of every document, or of every document of one issue type
+        
+        The digest changes whenever a document is added, changed or removed,
+        without parsing any of them.
+        """
+        where, params = ("", ()) if issue_type is None else ("WHERE issue_type = ?", (issue_type,))
+        digest = hashlib.sha256()
+        for document_id, source in self.conn.execute(
+                f"SELECT id, source FROM documents {where} ORDER BY rowid", params):
+            digest.update(json.dumps([document_id, source]).encode())
+        return digest.hexdigest()
+    
+    def aggregations(self, issue_type=None):
+        """Build the aggregations of fetch_data.build_query() from the stored documents"""
+        where, params = ("", ()) if issue_type is None else ("WHERE issue_type = ?", (issue_type,))
+        
+        def group(columns):
+            return self.conn.execute(
+                f"SELECT {columns}, COUNT(*) FROM documents {where} "
+                f"GROUP BY {columns} ORDER BY COUNT(*) DESC", params).fetchall()
+        
+        app_issue_types = {}
+        for app_code, value, count in group("app_code, issue_type"):
+            if value is not None:
+                app_issue_types.setdefault(app_code, []).append((value, count))
+        app_priorities = {}
+        for app_code, value, count in group("app_code, priority"):
+            if value is not None:
+                app_priorities.setdefault(app_code, []).append((value, count))
+        
+        return {
+            "by_app_code": {"buckets": [
+                {
+                    "key": app_code,
+                    "doc_count": count,
+                    "issue_types": {"buckets": terms_buckets(app_issue_types.get(app_code, []))},
+                    "priorities": {"buckets": terms_buckets(app_priorities.get(app_code, []))}
+                }
+                for app_code, count in group("app_code")[:1000]
+                if app_code is not None
+            ]},
+            "all_issue_types": {"buckets": terms_buckets(row for row in group("issue_type") if row[0] is not None)},
+            "priority_distribution": {"buckets": terms_buckets(row for row in group("priority") if row[0] is not None)}
+        }
+    
+    def get_meta(self, key, default=None):
+        """Get a JSON value stored alongside the documents"""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+    
+    def set_meta(self, key, value):
+        """Store a JSON value alongside the documents, or delete it if value is None"""
+        if value is None:
+            self.conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+        else:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+    
+    def commit(self):
+        """Save the changes made since the last commit"""
+        self.conn.commit()
+    
+    def close(self):
+        """Close the store, discarding uncommitted changes"""
+        self.conn.close()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+import os
+import re
+
+# Jinja-style tags: {{ expression }} and {% statement %}
+TAG_PATTERN = re.compile(r'({{.*?}}|{%.*?%})', re.DOTALL)
+
+# Tokens of the expression language: string and integer literals, names and punctuation
+EXPRESSION_TOKEN = re.compile(r"""\s*(?:('[^']*'|"[^"]*")|(\d+)|([A-Za-z_][A-Za-z0-9_]*)|([.\[\]|(),]))""")
+
+class TemplateSyntaxError(Exception):
+    """Raised when a template cannot be parsed"""
+
+class Undefined:
+    """Value of a name or attribute that is missing from the render context"""
+    
+    def __str__(self):
+        return ""
+    
+    def __bool__(self):
+        return False
+    
+    def __iter__(self):
+        return iter(())
+
+UNDEFINED = Undefined()
+
+def filter_default(value, default_value=""):
+    """Replace an undefined value"""
+    return default_value if value is UNDEFINED else value
+
+def filter_join(value, separator=""):
+    """Join the items of a list as strings"""
+    return separator.join(str(item) for item in value)
+
+def filter_length(value):
+    """Length of a list, dict or string"""
+    return 0 if value is UNDEFINED else len(value)
+
+FILTERS = {
+    "default": filter_default,
+    "d": filter_default,
+    "join": filter_join,
+    "length": filter_length,
+    "upper": lambda value: str(value).upper(),
+    "lower": lambda value: str(value).lower(),
+    "string": str,
+}
+
+def lookup(value, key):
+    """Get a key or attribute of value, or UNDEFINED if there is none"""
+    if value is UNDEFINED or value is None:
+        return UNDEFINED
+    try:
+        return value[key]
+    except (KeyError, IndexError, TypeError):
+        if isinstance(key, str):
+            return getattr(value, key, UNDEFINED)
+        return UNDEFINED
+
+def tokenize_expression(text):
+    """Split an expression into (kind, value) tokens"""
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = EXPRESSION_TOKEN.match(text, position)
+        if not match or match.end() == position:
+            raise TemplateSyntaxError(f"Unexpected character in expression: {text!r}")
+        string, number, name, op = match.groups()
+        if string is not None:
+            tokens.append(("literal", string[1:-1]))
+        elif number is not None:
+            tokens.append(("literal", int(number)))
+        elif name is not None:
+            tokens.append(("name", name))
+        else:
+            tokens.append(("op", op))
+        position = match.end()
+    return tokens
+
+def compile_expression(text):
+    """Compile an expression into a function of the render context
+    
+    Supports names, literals, attribute and index access (a.b, a[0], a['b']),
+    filters with literal arguments (a | default('N/A')) and a leading not.
+    """
+    tokens = tokenize_expression(text)
+    position = 0
+    
+    def peek():
+        return tokens[position] if position < len(tokens) else (None, None)
+    
+    def take(kind=None, value=None):
+        nonlocal position
+        token = peek()
+        if token[0] is None or (kind and token[0] != kind) or (value and token[1] != value):
+            raise TemplateSyntaxError(f"Invalid expression: {text!r}")
+        position += 1
+        return token[1]
+    
+    negate = False
+    if peek() == ("name", "not"):
+        take()
+        negate = True
+    
+    kind, value = peek()
+    if kind == "literal":
+        take()
+        base = lambda context, value=value: value
+        steps = []
+    else:
+        name = take("name")
+        base = lambda context, name=name: context.get(name, UNDEFINED)
+        steps = []
+        while peek() in (("op", "."), ("op", "[")):
+            if take("op") == ".":
+                steps.append(take("name"))
+            else:
+                steps.append(take("literal"))
+                take("op", "]")
+    
+    filters = []
+    while peek() == ("op", "|"):
+        take()
+        filter_name = take("name")
+        if filter_name not in FILTERS:
+            raise TemplateSyntaxError(f"Unknown filter {filter_name!r} in {text!r}")
+        args = []
+        if peek() == ("op", "("):
+            take()
+            while peek() != ("op", ")"):
+                args.append(take("literal"))
+                if peek() == ("op", ","):
+                    take()
+            take("op", ")")
+        filters.append((FILTERS[filter_name], args))
+    
+    if position != len(tokens):
+        raise TemplateSyntaxError(f"Invalid expression: {text!r}")
+    
+    def evaluate(context):
+        value = base(context)
+        for step in steps:
+            value = lookup(value, step)
+        for function, args in filters:
+            value = function(value, *args)
+        return (not value) if negate else value
+    
+    return evaluate
+
+def parse(source):
+    """Parse template source into a node tree
+    
+    Nodes are ("text", str), ("var", expression), ("for", name, expression,
+    body) and ("if", expression, body, else_body). As with Ansible's template
+    module (trim_blocks), the first newline after a {% %} tag is dropped.
+    """
+    root = []
+    stack = [("root", root)]
+    trim_newline = False
+    
+    for part in TAG_PATTERN.split(source):
+        if not part:
+            continue
+        body = stack[-1][1]
+        
+        if part.startswith("{%"):
+            statement = part[2:-2].strip()
+            keyword = statement.split(None, 1)[0] if statement else ""
+            if keyword == "for":
+                match = re.match(r'for\s+([A-Za-z_][A-Za-z0-9_]*)\s+in\s+(.+)$', statement, re.DOTALL)
+                if not match:
+                    raise TemplateSyntaxError(f"Invalid for statement: {statement!r}")
+                node = ["for", match.group(1), compile_expression(match.group(2)), []]
+                body.append(node)
+                stack.append(("for", node[3]))
+            elif keyword == "if":
+                node = ["if", compile_expression(statement[2:]), [], []]
+                body.append(node)
+                stack.append(("if", node[2], node))
+            elif keyword == "else":
+                if stack[-1][0] != "if":
+                    raise TemplateSyntaxError("{% else %} outside of {% if %}")
+                stack[-1] = ("else", stack[-1][2][3])
+            elif keyword in ("endfor", "endif"):
+                expected = ("for",) if keyword == "endfor" else ("if", "else")
+                if stack[-1][0] not in expected:
+                    raise TemplateSyntaxError(f"Unexpected {{% {keyword} %}}")
+                stack.pop()
+            else:
+                raise TemplateSyntaxError(f"Unsupported statement: {statement!r}")
+            trim_newline = True
+            continue
+        
+        if trim_newline and part.startswith("\n"):
+            part = part[1:]
+        trim_newline = False
+        
+        if part.startswith("{{"):
+            body.append(("var", compile_expression(part[2:-2])))
+        elif part:
+            body.append(("text", part))
+    
+    if len(stack) != 1:
+        raise TemplateSyntaxError(f"Unclosed {{% {stack[-1][0]} %}} block")
+    return root
+
+def compile_nodes(nodes):
+    """Compile a node list into a function appending rendered text to an output list"""
+    steps = []
+    for node in nodes:
+        if node[0] == "text":
+            steps.append(lambda context, out, text=node[1]: out.append(text))
+        elif node[0] == "var":
+            steps.append(lambda context, out, evaluate=node[1]: out.append(str(evaluate(context))))
+        elif node[0] == "for":
+            steps.append(compile_for(node[1], node[2], compile_nodes(node[3])))
+        elif node[0] == "if":
+            steps.append(compile_if(node[1], compile_nodes(node[2]), compile_nodes(node[3])))
+    
+    if len(steps) == 1:
+        return steps[0]
+    
+    def render_nodes(context, out):
+        for step in steps:
+            step(context, out)
+    
+    return render_nodes
+
+def compile_for(name, evaluate, render_body):
+    """Compile a for loop; the body sees the item and a Jinja-style loop variable"""
+    def render_for(context, out):
+        items = list(evaluate(context))
+        scope = dict(context)
+        for index, item in enumerate(items):
+            scope[name] = item
+            scope["loop"] = {
+                "index": index + 1,
+                "index0": index,
+                "first": index == 0,
+                "last": index == len(items) - 1,
+                "length": len(items),
+            }
+            render_body(scope, out)
+    return render_for
+
+def compile_if(evaluate, render_body, render_else):
+    """Compile an if/else block"""
+    def render_if(context, out):
+        if evaluate(context):
+            render_body(context, out)
+        else:
+            render_else(context, out)
+    return render_if
+
+class Template:
+    """A template compiled once and rendered many times"""
+    
+    def __init__(self, source):
+        self._render = compile_nodes(parse(source))
+    
+    def render(self, context=None, **values):
+        """Render the template with a context dict and/or keyword values"""
+        scope = dict(context or {})
+        scope.update(values)
+        out = []
+        self._render(scope, out)
+        return "".join(out)
+
+_template_cache = {}
+
+def load_template(template_file):
+    """Load and compile a template file, reusing the compiled template until the file changes"""
+    mtime = os.path.getmtime(template_file)
+    cached = _template_cache.get(template_file)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    
+    with open(template_file, 'r') as f:
+        template = Template(f.read())
+    _template_cache[template_file] = (mtime, template)
+    return template
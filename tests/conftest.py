@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The stage scripts import each other by module name, as they run from roles/files
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "roles" / "files"))
@@ -0,0 +1,53 @@
+import random
+from datetime import date
+
+import pytest
+
+pytest.importorskip("numpy")
+from benchmark import synthetic_hit
+from columnar import ColumnarAccumulator
+from compliance_rules import RuleSet
+from process_data import IssueAccumulator
+
+RULES = {
+    "rules": [
+        {"name": "critical", "severities": ["critical"], "max": 0},
+        {"name": "high", "severities": ["high"], "max": 6},
+        {"name": "score", "metric": "score", "max": 100},
+        {"name": "overdue", "severities": ["critical", "high"], "overdue_days": 30, "max": 4},
+        {"name": "crypto", "issue_types": ["Cryptography"], "max": 8}
+    ],
+    "issue_types": {"TSS": {"high": 5}},
+    "apps": {"APP00001": {"critical": None}, "APP00002": {"score": 100}}
+}
+
+def generate_hits(count, seed=7):
+    """Generated hits plus the odd ones: no app code, no custodian email, an unknown severity"""
+    rng = random.Random(seed)
+    hits = [synthetic_hit(number, 12, 5, rng) for number in range(count)]
+    hits[3]["_source"].pop("appCode")
+    hits[5]["_source"]["contact-info"].pop("app_custodian_email")
+    hits[8]["_source"]["severity"] = "unknown"
+    hits[13]["_source"].pop("fixByDate")
+    return hits
+
+@pytest.mark.parametrize("flush_every", [None, 37])
+def test_columnar_accumulator_matches_python(flush_every):
+    rules = RuleSet(RULES, as_of=date(2026, 6, 1))
+    expected = IssueAccumulator(rules=rules)
+    columnar = ColumnarAccumulator(rules=rules)
+    for number, hit in enumerate(generate_hits(500)):
+        expected.add(hit)
+        columnar.add(hit)
+        if flush_every and number % flush_every == 0:
+            columnar.flush()
+    
+    assert columnar.analysis() == expected.analysis()
+    assert columnar.compliance() == expected.compliance()
+    assert columnar.issue_rows == expected.issue_rows
+
+def test_empty_columnar_accumulator_matches_python():
+    rules = RuleSet(RULES)
+    
+    assert ColumnarAccumulator(rules=rules).analysis() == IssueAccumulator(rules=rules).analysis()
+    assert ColumnarAccumulator(rules=rules).compliance() == IssueAccumulator(rules=rules).compliance()
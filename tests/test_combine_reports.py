@@ -0,0 +1,49 @@
+import json
+import random
+
+from benchmark import synthetic_hit
+from combine_reports import combine_reports
+from process_data import generate_report
+
+RULES = {"rules": [
+    {"name": "critical", "severities": ["critical"], "max": 0},
+    {"name": "score", "metric": "score", "max": 30},
+    {"name": "overdue", "overdue_days": 30, "max": 2}
+]}
+
+def write_raw(path, hits):
+    path.write_text(json.dumps({"hits": {"total": {"value": len(hits)}, "hits": hits}}))
+
+def app_counts(report_file):
+    """Get the counts and document ids of every app of a report, by app code"""
+    report = json.loads(report_file.read_text())
+    rows = report["issues"]["rows"]
+    return {
+        app["app_code"]: (app["severity_counts"], app["issue_count"], app["rule_counts"],
+                          sorted(rows[issue_id][0] for issue_id in app["issue_ids"]))
+        for app in report["summary"]["app_codes"]
+    }
+
+def test_documents_in_two_reports_are_counted_once(tmp_path, monkeypatch):
+    monkeypatch.setenv("END_DATE", "2026-06-01")
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps(RULES))
+    rng = random.Random(3)
+    hits = [synthetic_hit(number, 4, 2, rng) for number in range(60)]
+    combined_dir, whole_dir = tmp_path / "combined", tmp_path / "whole"
+    combined_dir.mkdir()
+    whole_dir.mkdir()
+    # Documents 30-39 are in both reports
+    for name, part in (("first", hits[:40]), ("second", hits[30:])):
+        write_raw(tmp_path / f"{name}_raw.json", part)
+        assert generate_report(str(tmp_path / f"{name}_raw.json"),
+                               str(combined_dir / f"{name}_report_processed.json"), rules_file=str(rules_file))
+    write_raw(tmp_path / "whole_raw.json", hits)
+    assert generate_report(str(tmp_path / "whole_raw.json"), str(whole_dir / "whole_report_processed.json"),
+                           rules_file=str(rules_file))
+    
+    assert combine_reports(str(combined_dir), rules_file=str(rules_file))
+    
+    combined = app_counts(combined_dir / "combined_report_processed.json")
+    assert combined == app_counts(whole_dir / "whole_report_processed.json")
+    assert sum(issue_count for _, issue_count, _, _ in combined.values()) == 60
@@ -0,0 +1,111 @@
+import json
+from datetime import date
+
+import pytest
+
+from compliance_rules import RuleSet, RulesError, load_rules
+from render_emails import build_app_email_context, merge_app_entries, render_app_emails
+
+RULES = {"rules": [
+    {"name": "critical", "severities": ["critical"], "max": 0},
+    {"name": "crypto", "issue_types": ["Cryptography"], "max": 0}
+]}
+
+def test_counts_from_report_warns_about_rules_it_cannot_count(capsys):
+    rules = RuleSet(RULES)
+    assert rules.counts_from_report(None, {"critical": 2, "high": 1}) == [2, 0]
+    assert "Rule crypto counted as 0 because the report only has severity counts" in capsys.readouterr().out
+    
+    rules = RuleSet(RULES)
+    assert rules.counts_from_report({"critical": 1}, {}) == [1, 0]
+    assert "Rule crypto counted as 0 because the report was processed without it" in capsys.readouterr().out
+    # Warned about once per rule
+    assert rules.counts_from_report({"critical": 4}, {}) == [4, 0]
+    assert capsys.readouterr().out == ""
+    assert rules.counts_from_report({"critical": 1, "crypto": 3}, {}) == [1, 3]
+
+def test_merged_apps_are_checked_against_the_rules_file(tmp_path):
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps({"rules": [{"name": "medium", "severities": ["medium"], "max": 2}]}))
+    report = tmp_path / "report.json"
+    report.write_text(json.dumps({"custodian": {}, "summary": {"app_codes": [
+        {"app_code": "APP1", "issue_types": ["Vulnerability"], "severity_counts": {"medium": 2},
+         "issue_count": 2, "rule_counts": {"medium": 2}, "compliance": {"is_compliant": True, "reasons": []}},
+        {"app_code": "APP1", "issue_types": ["TSS"], "severity_counts": {"medium": 1},
+         "issue_count": 1, "rule_counts": {"medium": 1}, "compliance": {"is_compliant": True, "reasons": []}}
+    ]}}))
+    template = tmp_path / "template.txt"
+    template.write_text("{% if non_compliant_app %}{% for reason in non_compliant_app.reasons %}{{ reason }}{% endfor %}"
+                        "{% else %}Compliant{% endif %}")
+    
+    [entry] = render_app_emails(str(report), str(template), str(tmp_path), rules_file=str(rules_file))
+    with open(entry["body_file"]) as f:
+        assert f.read() == "Has 3 medium findings (threshold: 2)"
+    
+    # Against the built-in thresholds 3 medium findings are compliant
+    [app] = merge_app_entries(json.loads(report.read_text())["summary"]["app_codes"]).values()
+    assert build_app_email_context(app, [], "2026-01-01", "2026-01-01T00:00:00Z")["non_compliant_app"] is None
+
+def counted(rules, findings):
+    """Count (severity, issue type, fixByDate) findings against every rule"""
+    counts = [0] * len(rules.names)
+    for severity, issue_type, fix_by_date in findings:
+        rules.count(counts, severity, issue_type, fix_by_date)
+    return counts
+
+def test_rules_count_their_severities_issue_types_and_dates():
+    rules = RuleSet({
+        "severity_weights": {"critical": 10, "high": 5, "medium": 2, "low": 1, "info": 0},
+        "rules": [
+            {"name": "high", "severities": ["critical", "high"], "max": 1},
+            {"name": "score", "metric": "score", "max": 20},
+            {"name": "overdue", "overdue_days": 30, "max": 0},
+            {"name": "crypto", "issue_types": ["Cryptography"], "max": 5}
+        ],
+        "issue_types": {"TSS": {"high": 3}}
+    }, as_of=date(2026, 3, 1))
+    findings = [("critical", "Vulnerability", "2026-01-01"), ("high", "TSS", None),
+                ("high", "TSS", "2026-02-20"), ("medium", "Cryptography", "2026-01-30")]
+    
+    assert rules.names == ["high", "high/TSS", "score", "overdue", "crypto"]
+    assert counted(rules, findings) == [1, 2, 22, 1, 1]
+    
+    is_compliant, reasons = rules.evaluate("APP1", counted(rules, findings))
+    assert not is_compliant
+    assert reasons == [
+        "Has a weighted severity score of 22 (threshold: 20)",
+        "Has 1 findings more than 30 days past their fix-by date (threshold: 0)"
+    ]
+
+def test_app_overrides_change_or_turn_off_a_rule():
+    rules = RuleSet({
+        "rules": [{"name": "high", "severities": ["high"], "max": 0, "reason": "{name}: {count} > {max}"}],
+        "issue_types": {"TSS": {"high": 1}},
+        "apps": {"APP1": {"high": None}, "APP2": {"high": 2}}
+    })
+    counts = counted(rules, [("high", "Vulnerability", None), ("high", "TSS", None)])
+    
+    assert rules.evaluate("APP0", counts) == (False, ["high: 1 > 0"])
+    assert rules.evaluate("APP1", counts) == (True, [])
+    assert rules.evaluate("APP2", [3, 1]) == (False, ["high: 3 > 2"])
+
+@pytest.mark.parametrize("config", [
+    {"rules": [{"severities": ["high"], "max": 0}]},
+    {"rules": [{"name": "a", "max": 0}, {"name": "a", "max": 1}]},
+    {"rules": [{"name": "a", "severities": ["urgent"], "max": 0}]},
+    {"rules": [{"name": "a", "metric": "sum", "max": 0}]},
+    {"rules": [{"name": "a", "max": "0"}]},
+    {"rules": [{"name": "a", "max": 0}], "issue_types": {"TSS": {"a": 1.5}}},
+    {"rules": [{"name": "a", "max": 0}], "apps": {"APP1": {"b": 1}}}
+])
+def test_invalid_rules_are_rejected(config):
+    with pytest.raises(RulesError):
+        RuleSet(config)
+
+def test_load_rules_reads_a_rules_file(tmp_path):
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps({"rules": [{"name": "critical", "severities": ["critical"], "max": 0}]}))
+    
+    assert load_rules(str(rules_file)).names == ["critical"]
+    with pytest.raises(RulesError):
+        load_rules(str(tmp_path / "missing.json"))
@@ -0,0 +1,41 @@
+import json
+
+from diff_reports import accept_report, load_baseline, write_delta
+
+def write_report(path, severity_counts):
+    """Write a combined report with one summary entry per app, {app code: severity counts}"""
+    path.write_text(json.dumps({
+        "custodian": {},
+        "summary": {"app_codes": [
+            {"app_code": app_code, "issue_types": ["Vulnerability"], "severity_counts": counts}
+            for app_code, counts in severity_counts.items()
+        ]}
+    }))
+
+def write_delivery_report(path, statuses):
+    """Write a send_emails.py delivery report, {app code: status}"""
+    path.write_text(json.dumps({"results": [
+        {"app_code": app_code, "recipient": f"{app_code}@example.com", "status": status}
+        for app_code, status in statuses.items()
+    ]}))
+
+def test_accept_keeps_baseline_of_undelivered_apps(tmp_path):
+    report, baseline, delta = tmp_path / "report.json", tmp_path / "baseline.json", tmp_path / "delta.json"
+    write_report(report, {"APP1": {"high": 1}, "APP2": {"high": 1}})
+    accept_report(str(report), str(baseline))
+    
+    write_report(report, {"APP1": {"high": 2}, "APP2": {"high": 3}, "APP3": {"low": 1}})
+    write_delta(str(report), str(baseline), str(delta))
+    delivery_report = tmp_path / "delivery_report.json"
+    write_delivery_report(delivery_report, {"APP1": "sent", "APP2": "failed", "APP3": "failed"})
+    accept_report(str(report), str(baseline), str(delta), str(delivery_report))
+    
+    apps = load_baseline(str(baseline))["apps"]
+    assert apps["APP1"]["severity_counts"]["high"] == 2
+    assert apps["APP2"]["severity_counts"]["high"] == 1
+    assert "APP3" not in apps
+    
+    # The next run notifies the undelivered apps of the same changes again
+    statuses = {app_code: entry["status"] for app_code, entry in
+                write_delta(str(report), str(baseline), str(delta))["apps"].items()}
+    assert statuses == {"APP1": "unchanged", "APP2": "changed", "APP3": "new"}
@@ -0,0 +1,122 @@
+import json
+import threading
+
+import pytest
+
+import es_stub
+import fetch_data
+from fetch_data import lag_window_start, timestamp_key
+from snapshot_store import SnapshotStore
+
+@pytest.fixture
+def es_server():
+    """Serve a small generated index, returning its corpus and URL"""
+    corpus = es_stub.Corpus(300, 10, 5)
+    server = es_stub.serve(es_stub.StubState(corpus), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield corpus, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+def run_incremental(tmp_path, monkeypatch, es_url, lag_seconds):
+    """Run one incremental fetch, returning the checkpoint and the stored document ids"""
+    for name, value in {
+        "ES_HOST": es_url, "ES_INDEX": "compliance", "ES_USERNAME": "user", "ES_PASSWORD": "password",
+        "OUTPUT_DIR": str(tmp_path), "ISSUE_TYPES": json.dumps(["Vulnerability", "TSS"]),
+        "FETCH_MODE": "incremental", "FETCH_BACKEND": "requests", "ES_INCREMENTAL_LAG": str(lag_seconds)
+    }.items():
+        monkeypatch.setenv(name, value)
+    assert fetch_data.main() == 0
+    store = SnapshotStore(str(tmp_path / "compliance_snapshot.db"))
+    try:
+        return store.get_meta("checkpoint")["timestamp"], {hit["_id"] for hit in store.iter_hits()}
+    finally:
+        store.close()
+
+def index_late(corpus, timestamp):
+    """Make a P3 Vulnerability document P1 with an old timestamp, as if it was indexed late"""
+    hit = next(hit for hit in corpus.hits
+               if hit["_source"]["issueType"] == "Vulnerability" and hit["_source"]["priority"] == "P3")
+    hit["_source"].update(priority="P1", timestamp=timestamp)
+    corpus._cache.clear()
+    return hit["_id"]
+
+def test_timestamp_key_orders_any_fraction():
+    assert timestamp_key("2026-01-01T00:00:00.5Z") == timestamp_key("2026-01-01T00:00:00.500000000Z")
+    assert timestamp_key("2026-01-01T00:00:00Z") < timestamp_key("2026-01-01T00:00:00.000000001Z")
+    assert timestamp_key("2026-01-01T01:00:00+01:00") == timestamp_key("2026-01-01T00:00:00Z")
+    assert timestamp_key(1767225600000) == timestamp_key("2026-01-01T00:00:00Z")
+
+def test_lag_window_start():
+    assert lag_window_start("2026-01-01T00:05:00.123456789Z", 300) == "2026-01-01T00:00:00Z"
+    assert lag_window_start("2026-01-01T00:05:00Z", 0) == "2026-01-01T00:05:00Z"
+
+def test_lag_window_picks_up_late_documents(tmp_path, monkeypatch, es_server):
+    corpus, es_url = es_server
+    checkpoint, ids = run_incremental(tmp_path, monkeypatch, es_url, 300)
+    
+    late_id = index_late(corpus, "2026-01-01T00:04:00Z")
+    assert late_id not in ids
+    assert timestamp_key("2026-01-01T00:04:00Z") < timestamp_key(checkpoint)
+    checkpoint_after, ids_after = run_incremental(tmp_path, monkeypatch, es_url, 300)
+    
+    assert ids_after == ids | {late_id}
+    assert timestamp_key(checkpoint_after) >= timestamp_key(checkpoint)
+
+def test_without_lag_late_documents_are_missed(tmp_path, monkeypatch, es_server):
+    corpus, es_url = es_server
+    checkpoint, ids = run_incremental(tmp_path, monkeypatch, es_url, 0)
+    
+    late_id = index_late(corpus, "2026-01-01T00:04:00Z")
+    assert run_incremental(tmp_path, monkeypatch, es_url, 0)[1] == ids
+    assert late_id not in ids
+
+def test_concurrent_point_in_times_outlive_queued_slices(tmp_path, monkeypatch):
+    # One worker walks the issue types in turn, for longer than the keep-alive
+    corpus = es_stub.Corpus(400, 10, 5)
+    server = es_stub.serve(es_stub.StubState(corpus, latency=0.02), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for name, value in {
+            "ES_HOST": f"http://127.0.0.1:{server.server_address[1]}", "ES_INDEX": "compliance",
+            "ES_USERNAME": "user", "ES_PASSWORD": "password", "OUTPUT_DIR": str(tmp_path),
+            "ISSUE_TYPES": json.dumps(["Vulnerability", "TSS"]), "FETCH_MODE": "concurrent",
+            "FETCH_BACKEND": "requests", "FETCH_WORKERS": "1", "FETCH_SLICES": "2", "ES_PAGE_SIZE": "5",
+            "ES_PIT_KEEP_ALIVE": "300ms", "ES_MAX_RETRIES": "0"
+        }.items():
+            monkeypatch.setenv(name, value)
+        assert fetch_data.main() == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+    
+    for issue_type in ("Vulnerability", "TSS"):
+        with open(tmp_path / f"{issue_type}_report_raw.json") as f:
+            raw = json.load(f)
+        assert "partial" not in raw
+        assert len(raw["hits"]["hits"]) == raw["hits"]["total"]["value"] > 0
+
+def test_full_fetch_loads_the_store_from_the_fetched_pages(tmp_path, monkeypatch, es_server):
+    corpus, es_url = es_server
+    snapshot_db = tmp_path / "snapshot.db"
+    for name, value in {
+        "ES_HOST": es_url, "ES_INDEX": "compliance", "ES_USERNAME": "user", "ES_PASSWORD": "password",
+        "OUTPUT_DIR": str(tmp_path), "ISSUE_TYPES": json.dumps(["Vulnerability", "TSS"]),
+        "FETCH_MODE": "paginated", "FETCH_BACKEND": "requests", "ES_PAGE_SIZE": "20", "SNAPSHOT_DB": str(snapshot_db)
+    }.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(fetch_data.SnapshotStaging, "batch_size", 7)
+    assert fetch_data.main() == 0
+    
+    store = SnapshotStore(str(snapshot_db))
+    try:
+        for issue_type in ("Vulnerability", "TSS"):
+            with open(tmp_path / f"{issue_type}_report_raw.json") as f:
+                hits = json.load(f)["hits"]["hits"]
+            assert hits
+            assert [(hit["_id"], hit["_source"]) for hit in store.iter_hits(issue_type)] == [
+                (hit["_id"], hit["_source"]) for hit in hits
+            ]
+    finally:
+        store.close()
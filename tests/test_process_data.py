@@ -0,0 +1,40 @@
+import os
+
+import process_data
+from process_data import describe_partial, report_cache_key, stream_store_data
+from snapshot_store import SnapshotStore
+
+def test_store_partial_marker_covers_every_issue_type(tmp_path):
+    store_file = str(tmp_path / "snapshot.db")
+    store = SnapshotStore(store_file)
+    store.set_meta("partial", {
+        "TSS": {"issue_type": "TSS", "error": "HTTP 503", "documents": 10, "expected": None, "stale": True},
+        "Vulnerability": {"issue_type": "Vulnerability", "error": "HTTP 503", "documents": 5, "expected": None,
+                          "stale": True}
+    })
+    store.commit()
+    store.close()
+    
+    header = {}
+    stream_store_data(store_file, header=header)
+    
+    assert header["partial"]["issue_types"] == ["TSS", "Vulnerability"]
+    assert header["partial"]["documents"] == 15
+    assert header["partial"]["error"] == "HTTP 503"
+    assert header["partial"]["stale"]
+    assert describe_partial([header["partial"]]) == "TSS, Vulnerability"
+    
+    header = {}
+    stream_store_data(store_file, "TSS", header)
+    assert header["partial"]["issue_type"] == "TSS"
+
+def test_report_cache_key_covers_the_analysis_code(tmp_path, monkeypatch):
+    input_file = tmp_path / "raw.json"
+    input_file.write_text("{}")
+    hashed = []
+    file_digest = process_data.file_digest
+    monkeypatch.setattr(process_data, "file_digest", lambda path: hashed.append(os.path.basename(path)) or file_digest(path))
+    
+    report_cache_key(str(input_file))
+    
+    assert {"process_data.py", "compliance_rules.py", "columnar.py"} <= set(hashed)
@@ -0,0 +1,19 @@
+from run_metrics import StageMetrics, compare_runs
+
+def test_peak_rss_is_not_per_stage_in_the_daemon(monkeypatch):
+    monkeypatch.delenv("PIPELINE_DAEMON", raising=False)
+    standalone = StageMetrics("process").report()
+    monkeypatch.setenv("PIPELINE_DAEMON", "1234")
+    shared = StageMetrics("process").report()
+    
+    assert standalone["peak_rss_bytes"] > 0
+    assert "daemon_peak_rss_bytes" not in standalone
+    assert shared["peak_rss_bytes"] is None
+    assert shared["peak_rss_children_bytes"] is None
+    assert shared["daemon_peak_rss_bytes"] > 0
+
+def test_compare_runs_skips_figures_missing_from_either_run():
+    baseline = {"stages": {"process": {"wall_seconds": 1.0, "peak_rss_bytes": 1000}}}
+    run = {"stages": {"process": {"wall_seconds": 2.0, "peak_rss_bytes": None}}}
+    
+    assert [regression["metric"] for regression in compare_runs(run, baseline)] == ["wall_seconds"]
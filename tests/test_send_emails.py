@@ -0,0 +1,147 @@
+import sys
+import json
+import socket
+
+import pytest
+
+pytest.importorskip("aiosmtpd")
+from aiosmtpd.controller import Controller
+
+import send_emails
+from send_emails import SMTPConnectionPool, send_manifest
+
+class RecordingHandler:
+    """SMTP handler keeping every accepted message and the connection it came on
+    
+    replies maps a recipient to SMTP replies given in place of accepting
+    its message, one per attempt, e.g. ["451 Try again later"].
+    """
+    
+    def __init__(self, replies=None):
+        self.replies = {recipient: list(codes) for recipient, codes in (replies or {}).items()}
+        self.messages = []
+        self.peers = set()
+    
+    async def handle_DATA(self, server, session, envelope):
+        self.peers.add(session.peer)
+        replies = self.replies.get(envelope.rcpt_tos[0])
+        if replies:
+            return replies.pop(0)
+        self.messages.append(envelope)
+        return "250 OK"
+
+def free_port():
+    """Get a local port nothing listens on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def smtp_server():
+    """Start a local SMTP server, returning a function that sets its handler and gives its port"""
+    controllers = []
+    
+    def start(handler):
+        controller = Controller(handler, hostname="127.0.0.1", port=free_port())
+        controller.start()
+        controllers.append(controller)
+        return controller.port
+    
+    yield start
+    for controller in controllers:
+        controller.stop()
+
+def write_manifest(tmp_path, recipients):
+    """Write one rendered email per recipient and their manifest, returning the manifest entries"""
+    manifest = []
+    for index, recipient in enumerate(recipients):
+        body_file = tmp_path / f"email_{index}.txt"
+        body_file.write_text(f"Issues of APP{index}")
+        manifest.append({"app_code": f"APP{index}", "recipient": recipient,
+                         "subject": f"Compliance report APP{index}", "body_file": str(body_file)})
+    (tmp_path / "manifest.json").write_text(json.dumps(manifest))
+    return manifest
+
+def test_messages_share_pooled_connections(tmp_path, smtp_server):
+    handler = RecordingHandler()
+    port = smtp_server(handler)
+    manifest = write_manifest(tmp_path, [f"owner{index}@example.com" for index in range(8)])
+    pool = SMTPConnectionPool("127.0.0.1", port, size=2)
+    
+    try:
+        results = send_manifest(manifest, pool, "sender@example.com", concurrency=2, backoff=0)
+    finally:
+        pool.close()
+    
+    assert [result["status"] for result in results] == ["sent"] * 8
+    assert [result["app_code"] for result in results] == [entry["app_code"] for entry in manifest]
+    assert len(handler.messages) == 8
+    assert 1 <= pool.connections_opened <= 2
+    assert len(handler.peers) == pool.connections_opened
+
+def test_transient_failure_is_retried(tmp_path, smtp_server):
+    handler = RecordingHandler({"busy@example.com": ["451 Try again later", "421 Too busy"]})
+    port = smtp_server(handler)
+    manifest = write_manifest(tmp_path, ["busy@example.com"])
+    pool = SMTPConnectionPool("127.0.0.1", port)
+    
+    try:
+        [result] = send_manifest(manifest, pool, "sender@example.com", max_retries=3, backoff=0)
+    finally:
+        pool.close()
+    
+    assert result["status"] == "sent"
+    assert result["attempts"] == 3
+    assert [envelope.rcpt_tos for envelope in handler.messages] == [["busy@example.com"]]
+
+def test_permanent_failure_is_not_retried(tmp_path, smtp_server):
+    handler = RecordingHandler({"gone@example.com": ["550 No such mailbox"]})
+    port = smtp_server(handler)
+    manifest = write_manifest(tmp_path, ["gone@example.com", "owner@example.com"])
+    pool = SMTPConnectionPool("127.0.0.1", port)
+    
+    try:
+        gone, owner = send_manifest(manifest, pool, "sender@example.com", max_retries=3, backoff=0)
+    finally:
+        pool.close()
+    
+    assert gone["status"] == "failed"
+    assert gone["attempts"] == 1
+    assert "550" in gone["error"]
+    assert owner["status"] == "sent"
+    # The 550 reply left the connection usable
+    assert pool.connections_opened == 1
+
+def test_unreachable_server_gives_up_after_retries(tmp_path):
+    manifest = write_manifest(tmp_path, ["owner@example.com"])
+    pool = SMTPConnectionPool("127.0.0.1", free_port(), timeout=5)
+    
+    [result] = send_manifest(manifest, pool, "sender@example.com", max_retries=2, backoff=0)
+    
+    assert result["status"] == "failed"
+    assert result["attempts"] == 3
+    assert pool.connections_opened == 0
+
+def test_main_writes_delivery_report(tmp_path, smtp_server, monkeypatch):
+    handler = RecordingHandler({"gone@example.com": ["550 No such mailbox"]})
+    port = smtp_server(handler)
+    write_manifest(tmp_path, ["owner@example.com", "gone@example.com", "other@example.com"])
+    delivery_report = tmp_path / "delivery_report.json"
+    monkeypatch.setattr(sys, "argv", [
+        "send_emails.py", "--manifest", str(tmp_path / "manifest.json"),
+        "--delivery-report", str(delivery_report), "--smtp-host", "127.0.0.1", "--smtp-port", str(port),
+        "--concurrency", "2", "--backoff", "0"
+    ])
+    
+    assert send_emails.main() == 1
+    
+    report = json.loads(delivery_report.read_text())
+    assert report["sent"] == 2
+    assert report["failed"] == 1
+    assert report["smtp_host"] == "127.0.0.1"
+    assert 1 <= report["connections_opened"] <= 2
+    assert [(result["app_code"], result["status"]) for result in report["results"]] == [
+        ("APP0", "sent"), ("APP1", "failed"), ("APP2", "sent")
+    ]
+    assert report["results"][1]["attempts"] == 1
+    assert len(handler.messages) == 2
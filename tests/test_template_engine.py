@@ -0,0 +1,50 @@
+from pathlib import Path
+
+import pytest
+
+from render_emails import build_app_email_context
+from template_engine import Template, TemplateSyntaxError, load_template
+
+EMAIL_TEMPLATE = Path(__file__).resolve().parent.parent / "roles" / "files" / "email_template.txt"
+
+def test_expressions_and_filters():
+    template = Template("{{ app.code }} {{ items[1] }} {{ app['name'] | upper }} {{ missing | default('N/A') }} "
+                        "{{ items | join(', ') }} {{ items | length }} [{{ missing.attribute }}]")
+    
+    assert template.render(app={"code": "APP1", "name": "billing"}, items=["a", "b"]) == \
+        "APP1 b BILLING N/A a, b 2 []"
+
+def test_blocks_trim_the_newline_after_a_tag():
+    template = Template("{% for item in items %}\n{{ loop.index }}/{{ loop.length }} {{ item }}"
+                        "{% if not loop.last %},{% endif %}\n\n{% endfor %}\n"
+                        "{% if missing %}\nshown\n{% else %}\nhidden\n{% endif %}\n")
+    
+    assert template.render(items=["a", "b"]) == "1/2 a,\n2/2 b\nhidden\n"
+
+@pytest.mark.parametrize("source", [
+    "{% if a %}open", "{% endif %}", "{% else %}", "{% for in items %}{% endfor %}", "{{ a | unknown }}",
+    "{{ a + b }}", "{% while a %}"
+])
+def test_invalid_templates_are_rejected(source):
+    with pytest.raises(TemplateSyntaxError):
+        Template(source)
+
+def test_email_template_renders_like_jinja():
+    jinja2 = pytest.importorskip("jinja2")
+    app = {"app_code": "APP1", "issue_types": ["Vulnerability", "TSS"], "issue_count": 3,
+           "severity_counts": {"critical": 1, "high": 1, "medium": 1, "low": 0, "info": 0},
+           "compliance": {"is_compliant": False, "reasons": ["Has 1 critical findings (threshold: 0)"]}}
+    issues = [
+        {"issueType": "Vulnerability", "severity": "critical", "affectedItemName": "openssl",
+         "fixByDate": "2026-02-01", "solution": "https://example.com/fix"},
+        {"issueType": "TSS", "severity": "high"},
+        {"issueType": "TSS", "severity": "medium"}
+    ]
+    for incomplete_data, changes in (("", ""), ("TSS", "1 new critical finding")):
+        context = build_app_email_context(app, issues, "2026-01-01", "2026-01-01T00:00:00Z",
+                                          incomplete_data, changes)
+        template_file = str(EMAIL_TEMPLATE)
+        with open(template_file) as f:
+            expected = jinja2.Environment(trim_blocks=True, keep_trailing_newline=True).from_string(f.read()).render(context)
+        
+        assert load_template(template_file).render(context) == expected